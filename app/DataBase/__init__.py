@@ -20,12 +20,15 @@ def close_db():
     media_msg_db.close()
 
 
-def init_db():
-    misc_db.init_database()
-    msg_db.init_database()
-    micro_msg_db.init_database()
-    hard_link_db.init_database()
-    media_msg_db.init_database()
+def init_db(read_only=False):
+    """
+    @param read_only: 只读打开（报告服务的 worker 进程）
+    """
+    misc_db.init_database(read_only=read_only)
+    msg_db.init_database(read_only=read_only)
+    micro_msg_db.init_database(read_only=read_only)
+    hard_link_db.init_database(read_only=read_only)
+    media_msg_db.init_database(read_only=read_only)
 
 
 __all__ = ['misc_db', 'micro_msg_db', 'msg_db', 'hard_link_db', 'MsgType', "media_msg_db", "close_db"]
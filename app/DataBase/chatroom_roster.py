@@ -0,0 +1,158 @@
+"""
+群成员名册索引
+
+一次遍历 MicroMsg.db 的 ChatRoom 表，把所有群的 RoomData 解析成 {群: {wxid: 群昵称}}，
+压缩保存在缓存目录里。MicroMsg.db 的大小或修改时间变化后自动重建，
+导出、parser_chatroom_message 和 MongoDB 迁移共用同一份名册。
+"""
+import gzip
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import traceback
+
+from app.config import CACHE_DIR
+from app.log import logger
+from app.util.protocbuf.roomdata_pb2 import ChatRoomData
+
+CACHE_VERSION = 1
+
+lock = threading.Lock()
+_rosters = {}  # MicroMsg.db 绝对路径 -> ChatRoomRoster
+
+
+def get_db_signature(db_path) -> list:
+    """
+    数据库文件的指纹，用于判断缓存是否过期
+    @param db_path:
+    @return: [文件大小, 修改时间(ns)]
+    """
+    stat = os.stat(db_path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def parse_room_data(room_data: bytes) -> dict:
+    """
+    解析 ChatRoom.RoomData
+    @param room_data:
+    @return: {wxid: 群昵称}，没有设置群昵称的成员不在里面
+    """
+    members = {}
+    if not room_data:
+        return members
+    parsechatroom = ChatRoomData()
+    parsechatroom.ParseFromString(room_data)
+    for mem in parsechatroom.members:
+        if mem.displayName:
+            members[mem.wxID] = mem.displayName
+    return members
+
+
+class ChatRoomRoster:
+    def __init__(self, micromsg_db_path, cache_dir=CACHE_DIR):
+        self.db_path = os.path.abspath(micromsg_db_path)
+        name = hashlib.md5(self.db_path.encode('utf-8')).hexdigest()[:16]
+        self.cache_path = os.path.join(cache_dir, f'chatroom_roster_{name}.json.gz')
+        self.signature = None
+        self.rooms = {}  # {群: {wxid: 群昵称}}
+
+    def refresh(self):
+        """
+        MicroMsg.db 有变化时重新加载：先读磁盘缓存，缓存也过期了才重新解析
+        @return:
+        """
+        if not os.path.exists(self.db_path):
+            self.signature = None
+            self.rooms = {}
+            return
+        signature = get_db_signature(self.db_path)
+        if signature == self.signature:
+            return
+        if not self.load_cache(signature):
+            self.build()
+            self.save_cache(signature)
+        self.signature = signature
+
+    def build(self):
+        """
+        遍历 ChatRoom 表，一次性解析所有群的成员
+        @return:
+        """
+        rooms = {}
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT ChatRoomName, RoomData FROM ChatRoom')
+            for chatroom_name, room_data in cursor:
+                try:
+                    rooms[chatroom_name] = parse_room_data(room_data)
+                except Exception:
+                    logger.error(f'群成员解析失败:{chatroom_name}\n{traceback.format_exc()}')
+        except sqlite3.OperationalError:
+            logger.error(traceback.format_exc())
+        finally:
+            conn.close()
+        self.rooms = rooms
+
+    def load_cache(self, signature) -> bool:
+        if not os.path.exists(self.cache_path):
+            return False
+        try:
+            with gzip.open(self.cache_path, 'rt', encoding='utf-8') as f:
+                data = json.load(f)
+        except Exception:
+            logger.error(traceback.format_exc())
+            return False
+        if data.get('version') != CACHE_VERSION or data.get('signature') != signature:
+            return False
+        self.rooms = data.get('rooms', {})
+        return True
+
+    def save_cache(self, signature):
+        data = {
+            'version': CACHE_VERSION,
+            'signature': signature,
+            'rooms': self.rooms,
+        }
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            tmp_path = self.cache_path + '.tmp'
+            with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+            os.replace(tmp_path, self.cache_path)
+        except Exception:
+            logger.error(traceback.format_exc())
+
+    def get_members(self, chatroom) -> dict | None:
+        """
+        @param chatroom: 群 id（xxx@chatroom）
+        @return: {wxid: 群昵称}，ChatRoom 表里没有这个群时返回 None
+        """
+        return self.rooms.get(chatroom)
+
+    def get_display_name(self, chatroom, wxid, default='') -> str:
+        members = self.rooms.get(chatroom)
+        if not members:
+            return default
+        return members.get(wxid, default)
+
+
+def get_roster(micromsg_db_path=None) -> ChatRoomRoster:
+    """
+    获取 MicroMsg.db 对应的群成员名册，同一个数据库共用一个实例
+    每次获取都会检查数据库是否变化，调用方应在一批消息之前获取一次，而不是每条消息都获取
+    @param micromsg_db_path: 默认是当前解密出来的 MicroMsg.db
+    @return:
+    """
+    if micromsg_db_path is None:
+        from app.DataBase.micro_msg import db_path as micromsg_db_path
+    key = os.path.abspath(micromsg_db_path)
+    with lock:
+        roster = _rosters.get(key)
+        if roster is None:
+            roster = ChatRoomRoster(key)
+            _rosters[key] = roster
+        roster.refresh()
+    return roster
@@ -0,0 +1,14 @@
+import os.path
+import sqlite3
+
+
+def connect(path, read_only=False) -> sqlite3.Connection:
+    """
+    打开解密后的数据库
+    @param path:
+    @param read_only: 只读打开，报告服务的多个 worker 进程同时读取时使用
+    @return:
+    """
+    if read_only:
+        return sqlite3.connect(f'file:{os.path.abspath(path)}?mode=ro', uri=True, check_same_thread=False)
+    return sqlite3.connect(path, check_same_thread=False)
@@ -3,10 +3,13 @@ import os.path
 import sqlite3
 import threading
 import traceback
-import xml.etree.ElementTree as ET
 
 from app.log import log, logger
-from app.util.protocbuf.msg_pb2 import MessageBytesExtra
+from .connection import connect
+from app.util.appmsg import parse_xml
+from app.util import file_index
+from app.util.protocbuf import get_fields, get_file_path, get_thumb_path
+from app.util.protocbuf.bytes_extra import FILE_PATH, THUMB_PATH
 
 image_db_lock = threading.Lock()
 video_db_lock = threading.Lock()
@@ -14,22 +17,34 @@ image_db_path = "./app/Database/Msg/HardLinkImage.db"
 video_db_path = "./app/Database/Msg/HardLinkVideo.db"
 root_path = "FileStorage/MsgAttach/"
 video_root_path = "FileStorage/Video/"
+MD5_CACHE_SIZE = 65536  # 缓存的 md5 -> 路径条数，超过后清空重新缓存
+MEDIA_PREFETCH_WINDOW = 2000  # 导出时每读到多少条消息批量查一次路径
+
+image_sql = """
+    select md5_query.MD5,FileName,HardLinkImageID.Dir as DirName1,HardLinkImageID2.Dir as DirName2
+    from md5_query
+    join HardLinkImageAttribute on HardLinkImageAttribute.MD5 = md5_query.MD5
+    join HardLinkImageID on HardLinkImageAttribute.DirID1 = HardLinkImageID.DirID
+    join HardLinkImageID as HardLinkImageID2 on HardLinkImageAttribute.DirID2 = HardLinkImageID2.DirID;
+    """
+video_sql = """
+    select md5_query.MD5,FileName,HardLinkVideoID2.Dir as DirName2
+    from md5_query
+    join HardLinkVideoAttribute on HardLinkVideoAttribute.MD5 = md5_query.MD5
+    join HardLinkVideoID as HardLinkVideoID2 on HardLinkVideoAttribute.DirID2 = HardLinkVideoID2.DirID;
+    """
 
 
 @log
 def get_md5_from_xml(content, type_="img"):
-    try:
-        # 解析XML
-        root = ET.fromstring(content)
-        if type_ == "img":
-            # 提取md5的值
-            md5_value = root.find(".//img").get("md5")
-        elif type_ == "video":
-            md5_value = root.find(".//videomsg").get("md5")
-        # print(md5_value)
-        return md5_value
-    except ET.ParseError:
+    msg = parse_xml(content)
+    if msg is None:
         return None
+    if type_ == "img":
+        # 提取md5的值
+        return msg.img_md5
+    elif type_ == "video":
+        return msg.video_md5
 
 
 def decodeExtraBuf(extra_buf_content: bytes):
@@ -110,19 +125,21 @@ class HardLink:
         self.image_cursor = None
         self.video_cursor = None
         self.open_flag = False
+        self.image_paths = {}  # 图片 md5 -> (原图, 缩略图)，查不到是 None
+        self.video_paths = {}  # 视频 md5 -> (视频, 封面)，查不到是 None
         self.init_database()
 
-    def init_database(self):
+    def init_database(self, read_only=False):
         if not self.open_flag:
             if os.path.exists(image_db_path):
-                self.imageDB = sqlite3.connect(image_db_path, check_same_thread=False)
+                self.imageDB = connect(image_db_path, read_only)
                 # '''创建游标'''
                 self.image_cursor = self.imageDB.cursor()
                 self.open_flag = True
                 if image_db_lock.locked():
                     image_db_lock.release()
             if os.path.exists(video_db_path):
-                self.videoDB = sqlite3.connect(video_db_path, check_same_thread=False)
+                self.videoDB = connect(video_db_path, read_only)
                 # '''创建游标'''
                 self.video_cursor = self.videoDB.cursor()
                 self.open_flag = True
@@ -178,86 +195,223 @@ class HardLink:
         finally:
             video_db_lock.release()
 
-    def get_image_original(self, content, bytesExtra) -> str:
-        msg_bytes = MessageBytesExtra()
-        msg_bytes.ParseFromString(bytesExtra)
-        result = ''
-        for tmp in msg_bytes.message2:
-            if tmp.field1 != 4:
+    def query_md5s(self, db, cursor, db_lock, sql, md5s) -> list:
+        """
+        把一批 md5 写入临时表，和 HardLink 表 join 一次查出来
+        @param md5s: 二进制 md5 列表
+        @return: 查询结果，第一列是二进制 md5
+        """
+        if not md5s or not self.open_flag or db is None:
+            return []
+        try:
+            db_lock.acquire(True)
+            try:
+                cursor.execute('create temp table if not exists md5_query(MD5 blob primary key)')
+                cursor.execute('delete from md5_query')
+                cursor.executemany('insert or ignore into md5_query(MD5) values (?)', [(md5,) for md5 in md5s])
+                cursor.execute(sql)
+                result = cursor.fetchall()
+                cursor.execute('delete from md5_query')
+                db.commit()
+            except sqlite3.OperationalError:
+                logger.error(traceback.format_exc())
+                db.rollback()
+                return []
+            return result
+        finally:
+            db_lock.release()
+
+    @staticmethod
+    def missing_md5s(cache, md5s) -> dict:
+        """
+        @return: 缓存里没有的 {md5: 二进制 md5}，不是合法十六进制的 md5 直接记为查不到
+        """
+        missing = {}
+        for md5 in md5s:
+            if not md5:
                 continue
-            pathh = tmp.field2  # wxid\FileStorage\...
-            pathh = "\\".join(pathh.split("\\")[1:])
-            return pathh
-        md5 = get_md5_from_xml(content)
-        if not md5:
-            pass
-        else:
-            result = self.get_image_by_md5(binascii.unhexlify(md5))
-            if result:
-                dir1 = result[3]
-                dir2 = result[4]
-                data_image = result[2]
-                dir0 = "Image"
-                dat_image = os.path.join(root_path, dir1, dir0, dir2, data_image)
-                result = dat_image
+            md5 = md5.lower()
+            if md5 in cache or md5 in missing:
+                continue
+            try:
+                missing[md5] = binascii.unhexlify(md5)
+            except (binascii.Error, ValueError):
+                cache[md5] = None
+        return missing
+
+    @staticmethod
+    def update_cache(cache, missing, paths):
+        if len(cache) + len(missing) > MD5_CACHE_SIZE:
+            cache.clear()
+        for md5 in missing:
+            cache[md5] = paths.get(md5)
+
+    def resolve_images(self, md5s) -> dict:
+        """
+        批量查询图片路径
+        @param md5s: 图片消息 xml 里的 md5（十六进制字符串）
+        @return: {md5: (原图路径, 缩略图路径)}，查不到的 md5 不在结果里
+        """
+        missing = self.missing_md5s(self.image_paths, md5s)
+        if missing:
+            paths = {}
+            for md5, file_name, dir1, dir2 in self.query_md5s(self.imageDB, self.image_cursor, image_db_lock,
+                                                              image_sql, list(missing.values())):
+                paths[md5.hex()] = (
+                    os.path.join(root_path, dir1, "Image", dir2, file_name),
+                    os.path.join(root_path, dir1, "Thumb", dir2, file_name),
+                )
+            self.update_cache(self.image_paths, missing, paths)
+        return self.lookup(self.image_paths, md5s)
+
+    def resolve_videos(self, md5s) -> dict:
+        """
+        批量查询视频路径
+        @param md5s: 视频消息 xml 里的 md5（十六进制字符串）
+        @return: {md5: (视频路径, 封面路径)}，查不到的 md5 不在结果里
+        """
+        missing = self.missing_md5s(self.video_paths, md5s)
+        if missing:
+            paths = {}
+            for md5, file_name, dir2 in self.query_md5s(self.videoDB, self.video_cursor, video_db_lock,
+                                                        video_sql, list(missing.values())):
+                paths[md5.hex()] = (
+                    os.path.join(video_root_path, dir2, file_name),
+                    os.path.join(video_root_path, dir2, file_name.split(".")[0] + ".jpg"),
+                )
+            self.update_cache(self.video_paths, missing, paths)
+        return self.lookup(self.video_paths, md5s)
+
+    @staticmethod
+    def lookup(cache, md5s) -> dict:
+        result = {}
+        for md5 in md5s:
+            if md5:
+                paths = cache.get(md5.lower())
+                if paths:
+                    result[md5] = paths
         return result
 
-    def get_image_thumb(self, content, bytesExtra) -> str:
-        msg_bytes = MessageBytesExtra()
-        msg_bytes.ParseFromString(bytesExtra)
-        result = ''
-        for tmp in msg_bytes.message2:
-            if tmp.field1 != 3:
+    def resolve_messages(self, messages) -> dict:
+        """
+        一个会话（或一批消息）里的图片、视频路径一次查出来，之后 get_image/get_video 直接用缓存
+        BytesExtra 里已经有原图和缩略图路径的消息不用查
+        @param messages: get_messages 等返回的消息行（2:Type 7:StrContent 10:BytesExtra）
+        @return: {md5: (原图/视频路径, 缩略图/封面路径)}
+        """
+        image_md5s = []
+        video_md5s = []
+        for message in messages or ():
+            type_ = message[2]
+            if type_ != 3 and type_ != 43:
+                continue
+            fields = get_fields(message[10], (THUMB_PATH, FILE_PATH))
+            if fields.get(THUMB_PATH) and fields.get(FILE_PATH):
                 continue
-            pathh = tmp.field2  # wxid\FileStorage\...
-            pathh = "\\".join(pathh.split("\\")[1:])
-            return pathh
+            if type_ == 3:
+                image_md5s.append(get_md5_from_xml(message[7]))
+            else:
+                video_md5s.append(get_md5_from_xml(message[7], type_="video"))
+        result = self.resolve_images(image_md5s)
+        result.update(self.resolve_videos(video_md5s))
+        return result
+
+    def prefetch(self, messages, window=MEDIA_PREFETCH_WINDOW):
+        """
+        边读边导出时使用：每读到 window 条消息批量查一次图片、视频路径，原样返回消息
+        @param messages: 消息迭代器
+        @param window:
+        @return: 消息迭代器
+        """
+        batch = []
+        for message in messages:
+            batch.append(message)
+            if len(batch) >= window:
+                self.resolve_messages(batch)
+                yield from batch
+                batch = []
+        if batch:
+            self.resolve_messages(batch)
+            yield from batch
+
+    def get_image_paths(self, content):
+        """
+        先查 resolve_messages 缓存的结果，没有再单独查询
+        @return: (原图路径, 缩略图路径)，查不到返回 None
+        """
         md5 = get_md5_from_xml(content)
         if not md5:
-            pass
-        else:
+            return None
+        key = md5.lower()
+        if key in self.image_paths:
+            return self.image_paths[key]
+        paths = None
+        try:
             result = self.get_image_by_md5(binascii.unhexlify(md5))
-            if result:
-                dir1 = result[3]
-                dir2 = result[4]
-                data_image = result[2]
-                dir0 = "Thumb"
-                dat_image = os.path.join(root_path, dir1, dir0, dir2, data_image)
-                result = dat_image
-        return result
+        except (binascii.Error, ValueError):
+            result = None
+        if result:
+            paths = (
+                os.path.join(root_path, result[3], "Image", result[4], result[2]),
+                os.path.join(root_path, result[3], "Thumb", result[4], result[2]),
+            )
+        self.update_cache(self.image_paths, (key,), {key: paths})
+        return paths
+
+    def get_video_paths(self, content):
+        """
+        @return: (视频路径, 封面路径)，查不到返回 None
+        """
+        md5 = get_md5_from_xml(content, type_="video")
+        if not md5:
+            return None
+        key = md5.lower()
+        if key in self.video_paths:
+            return self.video_paths[key]
+        paths = None
+        try:
+            result = self.get_video_by_md5(binascii.unhexlify(md5))
+        except (binascii.Error, ValueError):
+            result = None
+        if result:
+            paths = (
+                os.path.join(video_root_path, result[3], result[2]),
+                os.path.join(video_root_path, result[3], result[2].split(".")[0] + ".jpg"),
+            )
+        self.update_cache(self.video_paths, (key,), {key: paths})
+        return paths
+
+    def get_image_original(self, content, bytesExtra) -> str:
+        pathh = get_file_path(bytesExtra)  # wxid\FileStorage\...
+        if pathh:
+            return "\\".join(pathh.split("\\")[1:])
+        paths = self.get_image_paths(content)
+        return paths[0] if paths else ''
+
+    def get_image_thumb(self, content, bytesExtra) -> str:
+        pathh = get_thumb_path(bytesExtra)  # wxid\FileStorage\...
+        if pathh:
+            return "\\".join(pathh.split("\\")[1:])
+        paths = self.get_image_paths(content)
+        return paths[1] if paths else ''
 
     def get_image(self, content, bytesExtra, up_dir="", thumb=False) -> str:
-        msg_bytes = MessageBytesExtra()
-        msg_bytes.ParseFromString(bytesExtra)
         if thumb:
             result = self.get_image_thumb(content, bytesExtra)
         else:
             result = self.get_image_original(content, bytesExtra)
-            if not (result and os.path.exists(os.path.join(up_dir, result))):
+            if not (result and file_index.exists(os.path.join(up_dir, result))):
                 result = self.get_image_thumb(content, bytesExtra)
         return result
 
     def get_video(self, content, bytesExtra, thumb=False):
-        msg_bytes = MessageBytesExtra()
-        msg_bytes.ParseFromString(bytesExtra)
-        for tmp in msg_bytes.message2:
-            if tmp.field1 != (3 if thumb else 4):
-                continue
-            pathh = tmp.field2  # wxid\FileStorage\...
-            pathh = "\\".join(pathh.split("\\")[1:])
-            return pathh
-        md5 = get_md5_from_xml(content, type_="video")
-        if not md5:
-            return ''
-        result = self.get_video_by_md5(binascii.unhexlify(md5))
-        if result:
-            dir2 = result[3]
-            data_image = result[2].split(".")[0] + ".jpg" if thumb else result[2]
-            # dir0 = 'Thumb' if thumb else 'Image'
-            dat_image = os.path.join(video_root_path, dir2, data_image)
-            return dat_image
-        else:
+        pathh = get_thumb_path(bytesExtra) if thumb else get_file_path(bytesExtra)  # wxid\FileStorage\...
+        if pathh:
+            return "\\".join(pathh.split("\\")[1:])
+        paths = self.get_video_paths(content)
+        if not paths:
             return ''
+        return paths[1] if thumb else paths[0]
 
     def close(self):
         if self.open_flag:
@@ -265,6 +419,8 @@ class HardLink:
                 image_db_lock.acquire(True)
                 video_db_lock.acquire(True)
                 self.open_flag = False
+                self.image_paths.clear()
+                self.video_paths.clear()
                 self.imageDB.close()
                 self.videoDB.close()
             finally:
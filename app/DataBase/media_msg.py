@@ -1,29 +1,16 @@
 import os.path
-import subprocess
-import sys
-import traceback
-from os import system
 import sqlite3
 import threading
-import xml.etree.ElementTree as ET
-from pilk import decode
 
 from app.log import logger
+from .connection import connect
+from app.util.appmsg import parse_xml
+from app.util.audio import VoiceTranscoder, get_ffmpeg_path
 
 lock = threading.Lock()
 db_path = "./app/Database/Msg/MediaMSG.db"
 
 
-def get_ffmpeg_path():
-    # 获取打包后的资源目录
-    resource_dir = getattr(sys, '_MEIPASS', os.path.abspath(os.path.dirname(__file__)))
-
-    # 构建 FFmpeg 可执行文件的路径
-    ffmpeg_path = os.path.join(resource_dir, 'app', 'resources','data', 'ffmpeg.exe')
-
-    return ffmpeg_path
-
-
 def singleton(cls):
     _instance = {}
 
@@ -43,10 +30,10 @@ class MediaMsg:
         self.open_flag = False
         self.init_database()
 
-    def init_database(self):
+    def init_database(self, read_only=False):
         if not self.open_flag:
             if os.path.exists(db_path):
-                self.DB = sqlite3.connect(db_path, check_same_thread=False)
+                self.DB = connect(db_path, read_only)
                 # '''创建游标'''
                 self.cursor = self.DB.cursor()
                 self.open_flag = True
@@ -68,61 +55,76 @@ class MediaMsg:
             lock.release()
         return result[0] if result else None
 
+    def get_media_buffers(self, reserved0_list, batch_size=500):
+        """
+        分批读取多条语音数据
+        @param reserved0_list: Reserved0 列表
+        @param batch_size: 每次查询的条数
+        @return: 生成器 (reserved0, buf)
+        """
+        if not self.open_flag:
+            return
+        reserved0_list = list(reserved0_list)
+        for i in range(0, len(reserved0_list), batch_size):
+            batch = reserved0_list[i:i + batch_size]
+            sql = f'''
+                select Reserved0, Buf
+                from Media
+                where Reserved0 in ({','.join('?' * len(batch))})
+            '''
+            try:
+                lock.acquire(True)
+                self.cursor.execute(sql, batch)
+                result = self.cursor.fetchall()
+            finally:
+                lock.release()
+            yield from result
+
     def get_audio(self, reserved0, output_path):
+        audio_path = VoiceTranscoder().get_output_path(reserved0, output_path)
+        if os.path.exists(audio_path):
+            return audio_path
         buf = self.get_media_buffer(reserved0)
         if not buf:
             return ''
-        silk_path = f"{output_path}/{reserved0}.silk"
-        pcm_path = f"{output_path}/{reserved0}.pcm"
-        mp3_path = f"{output_path}/{reserved0}.mp3"
-        if os.path.exists(mp3_path):
-            return mp3_path
-        with open(silk_path, "wb") as f:
-            f.write(buf)
-        # open(silk_path, "wb").write()
-        try:
-            decode(silk_path, pcm_path, 44100)
-            # 调用系统上的 ffmpeg 可执行文件
-            # 获取 FFmpeg 可执行文件的路径
-            ffmpeg_path = get_ffmpeg_path()
-            # # 调用 FFmpeg
-            if os.path.exists(ffmpeg_path):
-                cmd = f'''"{ffmpeg_path}" -loglevel quiet -y -f s16le -i "{pcm_path}" -ar 44100 -ac 1 "{mp3_path}"'''
-                # system(cmd)
-                # 使用subprocess.run()执行命令
-                subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return VoiceTranscoder().transcode(reserved0, buf, output_path)
+
+    def get_audios(self, reserved0_list, output_path, callback=None):
+        """
+        批量导出语音，已经存在的文件不会重复转码
+        @param reserved0_list: Reserved0 列表
+        @param output_path: 输出目录
+        @param callback: 每完成一条调用一次 callback(reserved0, path)
+        @return: {reserved0: path}
+        """
+        transcoder = VoiceTranscoder()
+        todo = []
+        result = {}
+        for reserved0 in reserved0_list:
+            audio_path = transcoder.get_output_path(reserved0, output_path)
+            if os.path.exists(audio_path):
+                result[reserved0] = audio_path
+                if callback:
+                    callback(reserved0, audio_path)
             else:
-                # 源码运行的时候下面的有效
-                # 这里不知道怎么捕捉异常
-                cmd = f'''"{os.path.join(os.getcwd(), 'app', 'resources', 'data','ffmpeg.exe')}" -loglevel quiet -y -f s16le -i "{pcm_path}" -ar 44100 -ac 1 "{mp3_path}"'''
-                # system(cmd)
-                # 使用subprocess.run()执行命令
-                subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            os.remove(silk_path)
-            os.remove(pcm_path)
-        except Exception as e:
-            print(f"Error: {e}")
-            logger.error(f'语音发送错误\n{traceback.format_exc()}')
-            cmd = f'''"{os.path.join(os.getcwd(), 'app', 'resources', 'data', 'ffmpeg.exe')}" -loglevel quiet -y -f s16le -i "{pcm_path}" -ar 44100 -ac 1 "{mp3_path}"'''
-            # system(cmd)
-            # 使用subprocess.run()执行命令
-            subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        finally:
-            print(mp3_path)
-        return mp3_path
+                todo.append(reserved0)
+        result.update(transcoder.transcode_many(self.get_media_buffers(todo), output_path, callback))
+        # Media 表里没有的语音也要回调一次，进度才能走到总数
+        for reserved0 in todo:
+            if reserved0 not in result:
+                result[reserved0] = ''
+                if callback:
+                    callback(reserved0, '')
+        return result
 
     def get_audio_path(self, reserved0, output_path):
-        mp3_path = f"{output_path}\\{reserved0}.mp3"
-        mp3_path = mp3_path.replace("/", "\\")
-        return mp3_path
+        return VoiceTranscoder().get_output_path(reserved0, output_path)
 
     def get_audio_text(self, content):
-        try:
-            root = ET.fromstring(content)
-            transtext = root.find(".//voicetrans").get("transtext")
-            return transtext
-        except:
+        msg = parse_xml(content)
+        if msg is None or msg.voice_transtext is None:
             return ""
+        return msg.voice_transtext
 
     def close(self):
         if self.open_flag:
@@ -2,6 +2,8 @@ import os.path
 import sqlite3
 import threading
 
+from .connection import connect
+
 lock = threading.Lock()
 db_path = "./app/Database/Msg/MicroMsg.db"
 
@@ -28,10 +30,10 @@ class MicroMsg:
         self.open_flag = False
         self.init_database()
 
-    def init_database(self):
+    def init_database(self, read_only=False):
         if not self.open_flag:
             if os.path.exists(db_path):
-                self.DB = sqlite3.connect(db_path, check_same_thread=False)
+                self.DB = connect(db_path, read_only)
                 # '''创建游标'''
                 self.cursor = self.DB.cursor()
                 self.open_flag = True
@@ -108,6 +110,26 @@ class MicroMsg:
 
         return result
 
+    def get_contact_names(self) -> dict:
+        """
+        一次性读出所有联系人的备注和昵称，用于批量处理消息时代替逐条 get_contact_by_username
+        @return: {UserName: (Remark, NickName)}
+        """
+        if not self.open_flag:
+            return {}
+        try:
+            lock.acquire(True)
+            sql = '''
+                   SELECT UserName, Remark, NickName
+                   FROM Contact
+                   INNER JOIN ContactHeadImgUrl ON Contact.UserName = ContactHeadImgUrl.usrName
+                '''
+            self.cursor.execute(sql)
+            result = self.cursor.fetchall()
+        finally:
+            lock.release()
+        return {username: (remark, nickname) for username, remark, nickname in result}
+
     def get_chatroom_info(self, chatroomname):
         '''
         获取群聊信息
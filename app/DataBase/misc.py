@@ -2,6 +2,8 @@ import os.path
 import sqlite3
 import threading
 
+from .connection import connect
+
 lock = threading.Lock()
 DB = None
 cursor = None
@@ -30,10 +32,10 @@ class Misc:
         self.open_flag = False
         self.init_database()
 
-    def init_database(self):
+    def init_database(self, read_only=False):
         if not self.open_flag:
             if os.path.exists(db_path):
-                self.DB = sqlite3.connect(db_path, check_same_thread=False)
+                self.DB = connect(db_path, read_only)
                 # '''创建游标'''
                 self.cursor = self.DB.cursor()
                 self.open_flag = True
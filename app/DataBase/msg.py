@@ -5,11 +5,12 @@ import threading
 import traceback
 from collections import defaultdict
 from datetime import datetime, date
-from typing import Tuple
+from typing import List, Tuple
 
 from app.log import logger
+from .connection import connect
 from app.util.compress_content import parser_reply
-from app.util.protocbuf.msg_pb2 import MessageBytesExtra
+from app.util.protocbuf import get_sender
 
 db_path = "./app/Database/Msg/MSG.db"
 lock = threading.Lock()
@@ -53,12 +54,13 @@ def convert_to_timestamp(time_range) -> Tuple[int, int]:
         return convert_to_timestamp_(time_range[0]), convert_to_timestamp_(time_range[1])
 
 
-def parser_chatroom_message(messages):
+def parser_chatroom_message(messages, chatroom=None):
     from app.DataBase import micro_msg_db, misc_db
-    from app.util.protocbuf.msg_pb2 import MessageBytesExtra
+    from app.DataBase.chatroom_roster import get_roster
     from app.person import Contact, Me, ContactDefault
     '''
     获取一个群聊的聊天记录
+    chatroom: 群 id，传入时没有备注的群成员显示群昵称
     return list
         a[0]: localId,
         a[1]: talkerId, （和strtalker对应的，不是群聊信息发送人）
@@ -75,6 +77,8 @@ def parser_chatroom_message(messages):
         a[12]: DisplayContent,
         a[13]: msg_sender, （ContactPC 或 ContactDefault 类型，这个才是群聊里的信息发送人，不是群聊或者自己是发送者没有这个字段）
     '''
+    roster = get_roster() if chatroom else None
+    contacts = {}  # wxid -> 联系人，同一个人只查一次数据库
     updated_messages = []  # 用于存储修改后的消息列表
     for row in messages:
         message = list(row)
@@ -83,16 +87,10 @@ def parser_chatroom_message(messages):
             updated_messages.append(tuple(message))
             continue
         if message[10] is None:  # BytesExtra是空的跳过
-            message.append(ContactDefault(wxid))
+            message.append(ContactDefault(''))
             updated_messages.append(tuple(message))
             continue
-        msgbytes = MessageBytesExtra()
-        msgbytes.ParseFromString(message[10])
-        wxid = ''
-        for tmp in msgbytes.message2:
-            if tmp.field1 != 1:
-                continue
-            wxid = tmp.field2
+        wxid = get_sender(message[10])
         if wxid == "":  # 系统消息里面 wxid 不存在
             message.append(ContactDefault(wxid))
             updated_messages.append(tuple(message))
@@ -100,23 +98,27 @@ def parser_chatroom_message(messages):
         # todo 解析还是有问题，会出现这种带:的东西
         if ':' in wxid:  # wxid_ewi8gfgpp0eu22:25319:1
             wxid = wxid.split(':')[0]
-        contact_info_list = micro_msg_db.get_contact_by_username(wxid)
-        if contact_info_list is None:  # 群聊中已退群的联系人不会保存在数据库里
-            message.append(ContactDefault(wxid))
-            updated_messages.append(tuple(message))
-            continue
-        contact_info = {
-            'UserName': contact_info_list[0],
-            'Alias': contact_info_list[1],
-            'Type': contact_info_list[2],
-            'Remark': contact_info_list[3],
-            'NickName': contact_info_list[4],
-            'smallHeadImgUrl': contact_info_list[7]
-        }
-        contact = Contact(contact_info)
-        contact.smallHeadImgBLOG = misc_db.get_avatar_buffer(contact.wxid)
-        contact.set_avatar(contact.smallHeadImgBLOG)
-        message.append(contact)
+        if wxid not in contacts:
+            display_name = roster.get_display_name(chatroom, wxid) if roster else ''
+            contact_info_list = micro_msg_db.get_contact_by_username(wxid)
+            if contact_info_list is None:  # 群聊中已退群的联系人不会保存在数据库里
+                contact = ContactDefault(wxid)
+                if display_name:
+                    contact.remark = display_name
+            else:
+                contact_info = {
+                    'UserName': contact_info_list[0],
+                    'Alias': contact_info_list[1],
+                    'Type': contact_info_list[2],
+                    'Remark': contact_info_list[3] or display_name,
+                    'NickName': contact_info_list[4],
+                    'smallHeadImgUrl': contact_info_list[7]
+                }
+                contact = Contact(contact_info)
+                contact.smallHeadImgBLOG = misc_db.get_avatar_buffer(contact.wxid)
+                contact.set_avatar(contact.smallHeadImgBLOG)
+            contacts[wxid] = contact
+        message.append(contacts[wxid])
         updated_messages.append(tuple(message))
     return updated_messages
 
@@ -145,13 +147,13 @@ class Msg:
         self.open_flag = False
         self.init_database()
 
-    def init_database(self, path=None):
+    def init_database(self, path=None, read_only=False):
         global db_path
         if not self.open_flag:
             if path:
                 db_path = path
             if os.path.exists(db_path):
-                self.DB = sqlite3.connect(db_path, check_same_thread=False)
+                self.DB = connect(db_path, read_only)
                 # '''创建游标'''
                 self.cursor = self.DB.cursor()
                 self.open_flag = True
@@ -166,16 +168,7 @@ class Msg:
         new_messages = []
         for message in messages:
             is_sender = message[4]
-            wxid = ''
-            if is_sender:
-                pass
-            else:
-                msgbytes = MessageBytesExtra()
-                msgbytes.ParseFromString(message[10])
-                for tmp in msgbytes.message2:
-                    if tmp.field1 != 1:
-                        continue
-                    wxid = tmp.field2
+            wxid = '' if is_sender else get_sender(message[10])
             new_message = (*message, wxid)
             new_messages.append(new_message)
         return new_messages
@@ -219,10 +212,59 @@ class Msg:
             result = self.cursor.fetchall()
         finally:
             lock.release()
-        return parser_chatroom_message(result) if username_.__contains__('@chatroom') else result
+        return parser_chatroom_message(result, username_) if username_.__contains__('@chatroom') else result
         # result.sort(key=lambda x: x[5])
         # return self.add_sender(result)
 
+    def get_messages_iter(
+            self,
+            username_,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+            batch_size=1000,
+            type_=None,
+    ):
+        """
+        分批读取聊天记录，字段和 get_messages 一样，内存里最多只有 batch_size 条消息
+        用于大群聊导出这类需要遍历全部消息的场景
+        @param username_:
+        @param time_range:
+        @param batch_size: 每批读取的条数
+        @param type_: 只读取这个类型的消息，默认全部
+        @return: 消息生成器
+        """
+        if not self.open_flag:
+            return
+        if time_range:
+            start_time, end_time = convert_to_timestamp(time_range)
+        sql = f'''
+            select localId,TalkerId,Type,SubType,IsSender,CreateTime,Status,StrContent,strftime('%Y-%m-%d %H:%M:%S',CreateTime,'unixepoch','localtime') as StrTime,MsgSvrID,BytesExtra,CompressContent,DisplayContent
+            from MSG
+            where StrTalker=?
+            {'AND Type=' + str(int(type_)) if type_ is not None else ''}
+            {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if time_range else ''}
+            order by CreateTime
+        '''
+        is_chatroom = username_.__contains__('@chatroom')
+        # 单独的游标，避免和其他查询共用 self.cursor 把结果集冲掉
+        cursor = self.DB.cursor()
+        try:
+            try:
+                lock.acquire(True)
+                cursor.execute(sql, [username_])
+            finally:
+                lock.release()
+            while True:
+                try:
+                    lock.acquire(True)
+                    rows = cursor.fetchmany(batch_size)
+                finally:
+                    lock.release()
+                if not rows:
+                    break
+                yield from (parser_chatroom_message(rows, username_) if is_chatroom else rows)
+        finally:
+            cursor.close()
+
     def get_messages_all(self, time_range=None):
         if time_range:
             start_time, end_time = convert_to_timestamp(time_range)
@@ -243,6 +285,42 @@ class Msg:
         result.sort(key=lambda x: x[5])
         return result
 
+    def get_messages_all_iter(self, time_range=None, batch_size=10000):
+        """
+        分批读取全部聊天记录，字段和 get_messages_all 一样
+        @param time_range:
+        @param batch_size: 每批读取的条数
+        @return: 生成器，每次返回一批消息（list）
+        """
+        if not self.open_flag:
+            return
+        if time_range:
+            start_time, end_time = convert_to_timestamp(time_range)
+        sql = f'''
+            select localId,TalkerId,Type,SubType,IsSender,CreateTime,Status,StrContent,strftime('%Y-%m-%d %H:%M:%S',CreateTime,'unixepoch','localtime') as StrTime,MsgSvrID,BytesExtra,StrTalker,Reserved1,CompressContent
+            from MSG
+            {'WHERE CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if time_range else ''}
+            order by CreateTime
+        '''
+        cursor = self.DB.cursor()
+        try:
+            try:
+                lock.acquire(True)
+                cursor.execute(sql)
+            finally:
+                lock.release()
+            while True:
+                try:
+                    lock.acquire(True)
+                    rows = cursor.fetchmany(batch_size)
+                finally:
+                    lock.release()
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+
     def get_messages_group_by_day(
             self,
             username_: str,
@@ -271,7 +349,7 @@ class Msg:
             result = self.cursor.fetchall()
         finally:
             lock.release()
-        result = parser_chatroom_message(result) if username_.__contains__('@chatroom') else result
+        result = parser_chatroom_message(result, username_) if username_.__contains__('@chatroom') else result
 
         # 按天分组存储聊天记录
         grouped_results = defaultdict(list)
@@ -320,7 +398,7 @@ class Msg:
         finally:
             lock.release()
         # result.sort(key=lambda x: x[5])
-        return parser_chatroom_message(result) if username_.__contains__('@chatroom') else result
+        return parser_chatroom_message(result, username_) if username_.__contains__('@chatroom') else result
 
     def get_messages_by_type(
             self,
@@ -381,7 +459,6 @@ class Msg:
             {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if time_range else ''}
             order by CreateTime desc
         '''
-        temp = []
         try:
             lock.acquire(True)
             self.cursor.execute(sql, [username_, max_len, f'%{keyword}%'] if year_ == "all" else [username_, max_len,
@@ -392,6 +469,37 @@ class Msg:
             lock.release()
         if len(messages) > 5:
             messages = random.sample(messages, num)
+        return self.get_dialogs(username_, messages, keyword)
+
+    def get_dialogs_by_local_ids(self, username_, local_ids, keyword):
+        """
+        根据关键词索引找到的消息 localId 获取对话
+        @param username_:
+        @param local_ids: 包含关键词的消息
+        @param keyword:
+        @return: 同 get_messages_by_keyword
+        """
+        if not self.open_flag or not local_ids:
+            return []
+        sql = f'''
+            select localId,TalkerId,Type,SubType,IsSender,CreateTime,Status,StrContent,strftime('%Y-%m-%d %H:%M:%S',CreateTime,'unixepoch','localtime') as StrTime,MsgSvrID,BytesExtra
+            from MSG
+            where localId in ({','.join('?' * len(local_ids))})
+            order by CreateTime desc
+        '''
+        try:
+            lock.acquire(True)
+            self.cursor.execute(sql, list(local_ids))
+            messages = self.cursor.fetchall()
+        finally:
+            lock.release()
+        return self.get_dialogs(username_, messages, keyword)
+
+    def get_dialogs(self, username_, messages, keyword):
+        """
+        每条消息和对方的下一条回复组成一个对话
+        """
+        temp = []
         try:
             lock.acquire(True)
             for msg in messages:
@@ -501,6 +609,138 @@ class Msg:
             lock.release()
         return result
 
+    def get_text_days(
+            self,
+            username_=None,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+            is_send=None,
+    ):
+        """
+        按 (联系人, 日期, 是否自己发送) 统计文本消息，用于判断分词缓存是否需要更新
+        @param username_: 不传时统计全部联系人
+        @param time_range:
+        @param is_send: 1 只统计自己发的，0 只统计对方发的，默认全部
+        @return: [(StrTalker, 日期, IsSender, 条数, 最小 localId, 最大 localId, 总字数)]
+        """
+        if not self.open_flag:
+            return []
+        if time_range:
+            start_time, end_time = convert_to_timestamp(time_range)
+        sql = f'''
+            SELECT StrTalker,strftime('%Y-%m-%d',CreateTime,'unixepoch','localtime') as days,IsSender,
+                   count(*),min(localId),max(localId),sum(length(StrContent))
+            FROM MSG
+            WHERE Type=1
+            {'AND StrTalker=?' if username_ else ''}
+            {'AND IsSender=?' if is_send is not None else ''}
+            {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if time_range else ''}
+            group by StrTalker,days,IsSender
+        '''
+        params = [username_] if username_ else []
+        if is_send is not None:
+            params.append(is_send)
+        try:
+            lock.acquire(True)
+            self.cursor.execute(sql, params)
+            result = self.cursor.fetchall()
+        finally:
+            lock.release()
+        return result
+
+    def get_text_iter(
+            self,
+            username_=None,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+            batch_size=5000,
+            is_send=None,
+    ):
+        """
+        分批读取文本消息内容
+        @param username_: 不传时读取全部联系人
+        @param time_range:
+        @param batch_size:
+        @param is_send: 1 只读取自己发的，0 只读取对方发的，默认全部
+        @return: (StrTalker, 日期, IsSender, StrContent) 的生成器
+        """
+        if not self.open_flag:
+            return
+        if time_range:
+            start_time, end_time = convert_to_timestamp(time_range)
+        sql = f'''
+            SELECT StrTalker,strftime('%Y-%m-%d',CreateTime,'unixepoch','localtime') as days,IsSender,StrContent
+            FROM MSG
+            WHERE Type=1
+            {'AND StrTalker=?' if username_ else ''}
+            {'AND IsSender=?' if is_send is not None else ''}
+            {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if time_range else ''}
+        '''
+        params = [username_] if username_ else []
+        if is_send is not None:
+            params.append(is_send)
+        cursor = self.DB.cursor()
+        try:
+            try:
+                lock.acquire(True)
+                cursor.execute(sql, params)
+            finally:
+                lock.release()
+            while True:
+                try:
+                    lock.acquire(True)
+                    rows = cursor.fetchmany(batch_size)
+                finally:
+                    lock.release()
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            cursor.close()
+
+    def get_message_meta_batches(
+            self,
+            username_=None,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+            batch_size=50000,
+    ):
+        """
+        分批读取消息的元数据，用于按列统计
+        @param username_: 不传时读取全部联系人
+        @param time_range:
+        @param batch_size:
+        @return: 每批是 [(localId, CreateTime, Type, SubType, IsSender, StrTalker, 文字长度), ...] 的生成器，
+                 文字长度只统计文本消息，其它消息是 0
+        """
+        if not self.open_flag:
+            return
+        if time_range:
+            start_time, end_time = convert_to_timestamp(time_range)
+        sql = f'''
+            SELECT localId,CreateTime,Type,ifnull(SubType,0),ifnull(IsSender,0),StrTalker,
+                CASE WHEN Type=1 THEN ifnull(length(StrContent),0) ELSE 0 END
+            FROM MSG
+            WHERE 1=1
+            {'AND StrTalker=?' if username_ else ''}
+            {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if time_range else ''}
+        '''
+        cursor = self.DB.cursor()
+        try:
+            try:
+                lock.acquire(True)
+                cursor.execute(sql, [username_] if username_ else [])
+            finally:
+                lock.release()
+            while True:
+                try:
+                    lock.acquire(True)
+                    rows = cursor.fetchmany(batch_size)
+                finally:
+                    lock.release()
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+
     def get_messages_by_month(
             self,
             username_,
@@ -864,6 +1104,45 @@ class Msg:
         sum_type_1 = result_type_1 if result_type_1 else 0
         return sum_type_1 + sum_type_49
 
+    def get_reply_text_lengths(
+            self,
+            usernames: List[str],
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+    ) -> dict:
+        """
+        统计多个联系人引用消息（type=49,subtype=57）里的文字数，一次查询
+        @param usernames: wxid 列表
+        @param time_range:
+        @return: {wxid: 字数}，没有引用消息的联系人不在结果里
+        """
+        result = {}
+        if not self.open_flag or not usernames:
+            return result
+        if time_range:
+            start_time, end_time = convert_to_timestamp(time_range)
+        sql = f"""
+            SELECT StrTalker, CompressContent
+            from MSG
+            where StrTalker in ({','.join('?' * len(usernames))}) and
+            type = 49 and subtype = 57
+            {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if time_range else ''}
+        """
+        rows = []
+        try:
+            lock.acquire(True)
+            self.cursor.execute(sql, list(usernames))
+            rows = self.cursor.fetchall()
+        except sqlite3.DatabaseError:
+            logger.error(f'{traceback.format_exc()}\n数据库损坏请删除msg文件夹重试')
+        finally:
+            lock.release()
+        for username, message in rows:
+            content = parser_reply(message)
+            if content["is_error"]:
+                continue
+            result[username] = result.get(username, 0) + len(content["title"])
+        return result
+
     def close(self):
         if self.open_flag:
             try:
@@ -1,8 +1,8 @@
 import threading
 
 from app.DataBase import msg_db, micro_msg_db, misc_db
-from app.util.protocbuf.msg_pb2 import MessageBytesExtra
-from app.util.protocbuf.roomdata_pb2 import ChatRoomData
+from app.DataBase.chatroom_roster import get_roster
+from app.util.protocbuf import get_sender
 from app.person import Contact, Me, ContactDefault
 
 lock = threading.Lock()
@@ -29,68 +29,65 @@ class PackageMsg:
         获取完整的聊天记录
         '''
         updated_messages = []  # 用于存储修改后的消息列表
+        for rows in self.get_package_message_iter():
+            updated_messages.extend(rows)
+        return updated_messages
 
-        messages = msg_db.get_messages_all()
-        for row in messages:
-            row_list = list(row)
-            # 删除不使用的几个字段
-            del row_list[13]
-            del row_list[12]
-            del row_list[11]
-            del row_list[10]
-            del row_list[9]
+    def get_package_message_iter(self, time_range=None, batch_size=10000):
+        '''
+        分批获取完整的聊天记录，字段和 get_package_message_all 一样
+        联系人信息提前一次性读出来，不再每条消息查一次数据库
+        return 生成器，每次返回一批消息（list）
+            a[0]-a[8]: localId ~ StrTime,
+            a[9]: 会话的备注,
+            a[10]: 会话的昵称,
+            a[11]: 发送人（自己发送的是“我”）
+        '''
+        contacts = micro_msg_db.get_contact_names()
+        # 名册可能已经随 MicroMsg.db 更新，每次导出重新取
+        self.ChatRoomMap = {}
+        for messages in msg_db.get_messages_all_iter(time_range=time_range, batch_size=batch_size):
+            yield self.package_messages(messages, contacts)
 
+    def package_messages(self, messages, contacts):
+        updated_messages = []
+        for row in messages:
             strtalker = row[11]
-            info = micro_msg_db.get_contact_by_username(strtalker)
-            if info is not None:
-                row_list.append(info[3])
-                row_list.append(info[4])
-            else:
-                row_list.append('')
-                row_list.append('')
+            remark, nickname = contacts.get(strtalker, ('', ''))
             # 判断是否是群聊
-            if strtalker.__contains__('@chatroom'):
+            if row[4] == 1:
                 # 自己发送
-                if row[4] == 1:
-                    row_list.append('我')
-                else:
-                    # 存在BytesExtra为空的情况，此时消息类型应该为提示性消息。跳过不处理
-                    if row[10] is None:
-                        continue
-                    # 解析BytesExtra
-                    msgbytes = MessageBytesExtra()
-                    msgbytes.ParseFromString(row[10])
-                    wxid = ''
-                    for tmp in msgbytes.message2:
-                        if tmp.field1 != 1:
-                            continue
-                        wxid = tmp.field2
-                    sender = ''
-                    # 获取群聊成员列表
-                    membersMap = self.get_chatroom_member_list(strtalker)
-                    if membersMap is not None:
-                        if wxid in membersMap:
-                            sender = membersMap.get(wxid)
-                        else:
-                            senderinfo = micro_msg_db.get_contact_by_username(wxid)
-                            if senderinfo is not None:
-                                sender = senderinfo[4]
-                                membersMap[wxid] = senderinfo[4]
-                                if len(senderinfo[3]) > 0:
-                                    sender = senderinfo[3]
-                                    membersMap[wxid] = senderinfo[3]
-                    row_list.append(sender)
+                sender = '我'
+            elif strtalker.__contains__('@chatroom'):
+                # 存在BytesExtra为空的情况，此时消息类型应该为提示性消息。跳过不处理
+                if row[10] is None:
+                    continue
+                # 解析BytesExtra
+                wxid = get_sender(row[10])
+                sender = self.get_chatroom_sender(strtalker, wxid, contacts)
             else:
-                if row[4] == 1:
-                    row_list.append('我')
-                else:
-                    if info is not None:
-                        row_list.append(info[4])
-                    else:
-                        row_list.append('')
-            updated_messages.append(tuple(row_list))
+                sender = nickname
+            # 只保留前 9 个字段
+            updated_messages.append((*row[:9], remark, nickname, sender))
         return updated_messages
 
+    def get_chatroom_sender(self, strtalker, wxid, contacts):
+        '''
+        群聊发送人的名字：群昵称 > 备注 > 昵称
+        '''
+        # 获取群聊成员列表
+        membersMap = self.get_chatroom_member_list(strtalker)
+        if membersMap is None:
+            return ''
+        if wxid in membersMap:
+            return membersMap.get(wxid)
+        if wxid not in contacts:
+            return ''
+        remark, nickname = contacts[wxid]
+        sender = remark if remark else nickname
+        membersMap[wxid] = sender
+        return sender
+
     def get_package_message_by_wxid(self, chatroom_wxid):
         '''
         获取一个群聊的聊天记录
@@ -122,13 +119,7 @@ class PackageMsg:
                 message.append(ContactDefault(wxid))
                 updated_messages.append(message)
                 continue
-            msgbytes = MessageBytesExtra()
-            msgbytes.ParseFromString(message[10])
-            wxid = ''
-            for tmp in msgbytes.message2:
-                if tmp.field1 != 1:
-                    continue
-                wxid = tmp.field2
+            wxid = get_sender(message[10])
             if wxid == "":  # 系统消息里面 wxid 不存在
                 message.append(ContactDefault(wxid))
                 updated_messages.append(message)
@@ -154,29 +145,19 @@ class PackageMsg:
         return updated_messages
 
     def get_chatroom_member_list(self, strtalker):
-        membermap = {}
         '''
-        获取群聊成员
+        获取群聊成员 {wxid: 群昵称}，数据来自共用的群成员名册
+        群不存在时返回 None
         '''
         try:
             lock.acquire(True)
-            if strtalker in self.ChatRoomMap:
-                membermap = self.ChatRoomMap.get(strtalker)
-            else:
-                chatroom = micro_msg_db.get_chatroom_info(strtalker)
-                if chatroom is None:
-                    return None
-                # 解析RoomData数据
-                parsechatroom = ChatRoomData()
-                parsechatroom.ParseFromString(chatroom[1])
-                # 群成员数据放入字典存储
-                for mem in parsechatroom.members:
-                    if mem.displayName is not None and len(mem.displayName) > 0:
-                        membermap[mem.wxID] = mem.displayName
-                self.ChatRoomMap[strtalker] = membermap
+            if strtalker not in self.ChatRoomMap:
+                members = get_roster().get_members(strtalker)
+                # 复制一份，后面会把通讯录里查到的名字补进来
+                self.ChatRoomMap[strtalker] = dict(members) if members is not None else None
+            return self.ChatRoomMap[strtalker]
         finally:
             lock.release()
-        return membermap
 
 
 if __name__ == "__main__":
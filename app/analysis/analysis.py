@@ -1,12 +1,13 @@
 import os
 from collections import Counter
 import sys
-from datetime import datetime
 from typing import List
 
-import jieba
-
-from app.DataBase import msg_db, MsgType
+from app.DataBase import msg_db
+from app.analysis.charts import chart_spec, render_chart, render_charts
+from app.analysis.columnar import WEEKDAYS, load_columns
+from app.analysis.term_index import term_index
+from app.analysis.tokenizer import count_words, get_word_counts
 from pyecharts import options as opts
 from pyecharts.charts import WordCloud, Calendar, Bar, Line, Pie, Map
 
@@ -16,109 +17,178 @@ from app.util.region_conversion import conversion_province_to_chinese
 os.makedirs('./data/聊天统计/', exist_ok=True)
 
 
+# 图表构建函数：只依赖参数，生成的配置按 (函数, 参数) 缓存，见 app/analysis/charts.py
+def build_wordcloud(data_pair, word_size_range):
+    return (
+        WordCloud(init_opts=opts.InitOpts())
+        .add(series_name="聊天文字", data_pair=data_pair, word_size_range=word_size_range)
+    )
+
+
+def build_calendar(calendar_data, calendar_days, min_, max_):
+    return (
+        Calendar()
+        .add(
+            "",
+            calendar_data,
+            calendar_opts=opts.CalendarOpts(range_=calendar_days)
+        )
+        .set_global_opts(
+            visualmap_opts=opts.VisualMapOpts(
+                max_=max_,
+                min_=min_,
+                orient="horizontal",
+                pos_bottom="0px",
+                pos_left="0px",
+            ),
+            legend_opts=opts.LegendOpts(is_show=False)
+        )
+    )
+
+
+def build_month_bar(x_axis, y_data):
+    return (
+        Bar(init_opts=opts.InitOpts())
+        .add_xaxis(x_axis)
+        .add_yaxis("消息数量", y_data,
+                   label_opts=opts.LabelOpts(is_show=True),
+                   itemstyle_opts=opts.ItemStyleOpts(color="#ffae80"),
+                   )
+        .set_global_opts(
+            title_opts=opts.TitleOpts(title="逐月统计", subtitle=None),
+            datazoom_opts=opts.DataZoomOpts(),
+            toolbox_opts=opts.ToolboxOpts(),
+            yaxis_opts=opts.AxisOpts(
+                name="消息数",
+                type_="value",
+                axistick_opts=opts.AxisTickOpts(is_show=True),
+                splitline_opts=opts.SplitLineOpts(is_show=True),
+            ),
+            visualmap_opts=opts.VisualMapOpts(
+                min_=min(y_data),
+                max_=max(y_data),
+                dimension=1,  # 根据第2个维度（y 轴）进行映射
+                is_piecewise=False,  # 是否分段显示
+                range_color=["#ffbe7a", "#fa7f6f"],  # 设置颜色范围
+                type_="color",
+                pos_right="0%",
+            ),
+        )
+    )
+
+
+def build_pie(data, title=None, legend_left="80%", legend_top="20%", formatter="{b}: {c}", label_position=None,
+              toolbox=True):
+    """
+    消息类型、双方消息占比的饼图
+    """
+    global_opts = {}
+    if title:
+        # 不传标题时和原来一样不设置 title_opts，生成的配置不变
+        global_opts['title_opts'] = opts.TitleOpts(title=title)
+    return (
+        Pie()
+        .add(
+            "",
+            data,
+            center=["40%", "50%"],
+        )
+        .set_global_opts(
+            datazoom_opts=opts.DataZoomOpts(),
+            toolbox_opts=opts.ToolboxOpts() if toolbox else None,
+            legend_opts=opts.LegendOpts(type_="scroll", pos_left=legend_left, pos_top=legend_top, orient="vertical"),
+            **global_opts,
+        )
+        .set_series_opts(label_opts=opts.LabelOpts(formatter=formatter, position=label_position))
+    )
+
+
+def build_weekday_pie(data):
+    return (
+        Pie()
+        .add(
+            "",
+            data,
+            radius=["40%", "75%"],
+        )
+        .set_global_opts(
+            datazoom_opts=opts.DataZoomOpts(),
+            toolbox_opts=opts.ToolboxOpts(),
+            title_opts=opts.TitleOpts(title="星期分布图"),
+            legend_opts=opts.LegendOpts(orient="vertical", pos_top="15%", pos_left="2%"),
+        )
+        .set_series_opts(label_opts=opts.LabelOpts(formatter="{b}: {c}\n{d}%"))
+    )
+
+
+def build_region_map(data, max_):
+    return (
+        Map()
+        .add("分布", data, "china")
+        .set_series_opts(label_opts=opts.LabelOpts(is_show=False))
+        .set_global_opts(
+            title_opts=opts.TitleOpts(title="地区分布"),
+            visualmap_opts=opts.VisualMapOpts(max_=max_, is_piecewise=True),
+            legend_opts=opts.LegendOpts(is_show=False),
+        )
+    )
+
+
 def wordcloud_(wxid, time_range=None):
-    import jieba
-    txt_messages = msg_db.get_messages_by_type(wxid, MsgType.TEXT, time_range=time_range)
-    if not txt_messages:
+    word_count, total_msg_len = get_word_counts(wxid, time_range=time_range)
+    if not word_count:
         return {
             'chart_data': None,
             'keyword': "没有聊天你想分析啥",
             'max_num': "0",
             'dialogs': []
         }
-    # text = ''.join(map(lambda x: x[7], txt_messages))
-    text = ''.join(map(lambda x: x[7], txt_messages))  # 1“我”说的话，0“Ta”说的话
-
-    total_msg_len = len(text)
-    # 使用jieba进行分词，并加入停用词
-    words = jieba.cut(text)
-    # 统计词频
-    word_count = Counter(words)
-    # 过滤停用词
-    stopwords_file = './app/data/stopwords.txt'
-    with open(stopwords_file, "r", encoding="utf-8") as stopword_file:
-        stopwords1 = set(stopword_file.read().splitlines())
-    # 构建 FFmpeg 可执行文件的路径
-    stopwords = set()
-    stopwords_file = './app/resources/data/stopwords.txt'
-    if not os.path.exists(stopwords_file):
-        resource_dir = getattr(sys, '_MEIPASS', os.path.abspath(os.path.dirname(__file__)))
-        stopwords_file = os.path.join(resource_dir, 'app', 'resources', 'data', 'stopwords.txt')
-    with open(stopwords_file, "r", encoding="utf-8") as stopword_file:
-        stopwords = set(stopword_file.read().splitlines())
-        stopwords = stopwords.union(stopwords1)
-    filtered_word_count = {word: count for word, count in word_count.items() if len(word) > 1 and word not in stopwords}
-
     # 转换为词云数据格式
-    data = [(word, count) for word, count in filtered_word_count.items()]
-    # text_data = data
-    data.sort(key=lambda x: x[1], reverse=True)
-
-    text_data = data[:100] if len(data) > 100 else data
+    text_data = word_count.most_common(100)
     # 创建词云图
     keyword, max_num = text_data[0]
-    w = (
-        WordCloud(init_opts=opts.InitOpts())
-        .add(series_name="聊天文字", data_pair=text_data, word_size_range=[5, 100])
-    )
-    # return w.render_embed()
     return {
-        'chart_data': w.dump_options_with_quotes(),
+        'chart_data': render_chart(build_wordcloud, text_data, [5, 100]),
         'keyword': keyword,
         'max_num': str(max_num),
-        'dialogs': msg_db.get_messages_by_keyword(wxid, keyword, num=5, max_len=12)
+        'dialogs': term_index.get_dialogs(wxid, keyword, num=5, max_len=12)
     }
 
 
-def get_wordcloud(text):
-    total_msg_len = len(text)
-    jieba.load_userdict('./app/data/new_words.txt')
-    # 使用jieba进行分词，并加入停用词
-    words = jieba.cut(text)
-    # 统计词频
-    word_count = Counter(words)
-    # 过滤停用词
-    stopwords_file = './app/data/stopwords.txt'
-    with open(stopwords_file, "r", encoding="utf-8") as stopword_file:
-        stopwords1 = set(stopword_file.read().splitlines())
-    # 构建 FFmpeg 可执行文件的路径
-    stopwords = set()
-    stopwords_file = './app/resources/data/stopwords.txt'
-    if not os.path.exists(stopwords_file):
-        resource_dir = getattr(sys, '_MEIPASS', os.path.abspath(os.path.dirname(__file__)))
-        stopwords_file = os.path.join(resource_dir, 'app', 'resources', 'data', 'stopwords.txt')
-    with open(stopwords_file, "r", encoding="utf-8") as stopword_file:
-        stopwords = set(stopword_file.read().splitlines())
-        stopwords = stopwords.union(stopwords1)
-
-    filtered_word_count = {word: count for word, count in word_count.items() if len(word) > 1 and word not in stopwords}
-    # 转换为词云数据格式
-    data = [(word, count) for word, count in filtered_word_count.items()]
-    # text_data = data
-    data.sort(key=lambda x: x[1], reverse=True)
+def wordcloud_from_counts(word_count: Counter):
+    """
+    根据词频生成词云
+    @param word_count: 已经去掉停用词的词频
+    @return:
+    """
+    spec, data = wordcloud_spec(word_count)
+    return {**render_charts({'chart_data_wordcloud': spec}), **data}
 
-    text_data = data[:100] if len(data) > 100 else data
-    # 创建词云图
+
+def wordcloud_spec(word_count: Counter):
+    """
+    @param word_count: 已经去掉停用词的词频
+    @return: (词云图的 chart_spec, 关键词信息)，图表可以和同一页面的其他图表一起交给 render_charts
+    """
+    text_data = word_count.most_common(100)
     if text_data:
         keyword, max_num = text_data[0]
     else:
         keyword, max_num = '', 0
-    w = (
-        WordCloud()
-        .add(series_name="聊天文字", data_pair=text_data, word_size_range=[5, 40])
-    )
-    return {
-        'chart_data_wordcloud': w.dump_options_with_quotes(),
+    spec = chart_spec(build_wordcloud, text_data, [5, 40])
+    return spec, {
         'keyword': keyword,
         'keyword_max_num': max_num,
     }
 
 
-def wordcloud_christmas(wxid,time_range=None, year='2023'):
-    import jieba
+def get_wordcloud(text):
+    return wordcloud_from_counts(count_words([text]))
+
 
-    txt_messages = msg_db.get_messages_by_type(wxid, MsgType.TEXT, time_range=time_range)
-    if not txt_messages:
+def wordcloud_christmas(wxid,time_range=None, year='2023'):
+    word_count, total_msg_len = get_word_counts(wxid, time_range=time_range)
+    if not total_msg_len:
         return {
             'wordcloud_chart_data': None,
             'keyword': "没有聊天你想分析啥",
@@ -126,13 +196,11 @@ def wordcloud_christmas(wxid,time_range=None, year='2023'):
             'dialogs': [],
             'total_num': 0,
         }
-    text = ''.join(map(lambda x: x[7], txt_messages))
-    total_msg_len = len(text)
-    wordcloud_data = get_wordcloud(text)
+    wordcloud_data = wordcloud_from_counts(word_count)
     # return w.render_embed()
     keyword = wordcloud_data.get('keyword')
     max_num = wordcloud_data.get('keyword_max_num')
-    dialogs = msg_db.get_messages_by_keyword(wxid, keyword, num=3, max_len=12, time_range=time_range)
+    dialogs = term_index.get_dialogs(wxid, keyword, num=3, max_len=12, time_range=time_range)
 
     return {
         'wordcloud_chart_data': wordcloud_data.get('chart_data_wordcloud'),
@@ -158,28 +226,10 @@ def calendar_chart(wxid, time_range=None):
     end_date_ = calendar_data[-1][0]
     print(start_date_, '---->', end_date_)
     calendar_days = (start_date_, end_date_)
-    calendar_title = '和Ta的聊天情况'
-    c = (
-        Calendar()
-        .add(
-            "",
-            calendar_data,
-            calendar_opts=opts.CalendarOpts(range_=calendar_days)
-        )
-        .set_global_opts(
-            visualmap_opts=opts.VisualMapOpts(
-                max_=max_,
-                min_=min_,
-                orient="horizontal",
-                pos_bottom="0px",
-                pos_left="0px",
-            ),
-            legend_opts=opts.LegendOpts(is_show=False)
-        )
-    )
+    chart_data = render_chart(build_calendar, calendar_data, calendar_days, min_, max_)
     return {
-        'chart_data': c.dump_options_with_quotes(),
-        'calendar_chart_data': c.dump_options_with_quotes(),
+        'chart_data': chart_data,
+        'calendar_chart_data': chart_data,
         'chat_days': len(calendar_data),
         # 'chart':c,
     }
@@ -192,36 +242,8 @@ def month_count(wxid, time_range=None):
     msg_data = msg_db.get_messages_by_month(wxid, time_range)
     y_data = list(map(lambda x: x[1], msg_data))
     x_axis = list(map(lambda x: x[0], msg_data))
-    m = (
-        Bar(init_opts=opts.InitOpts())
-        .add_xaxis(x_axis)
-        .add_yaxis("消息数量", y_data,
-                   label_opts=opts.LabelOpts(is_show=True),
-                   itemstyle_opts=opts.ItemStyleOpts(color="#ffae80"),
-                   )
-        .set_global_opts(
-            title_opts=opts.TitleOpts(title="逐月统计", subtitle=None),
-            datazoom_opts=opts.DataZoomOpts(),
-            toolbox_opts=opts.ToolboxOpts(),
-            yaxis_opts=opts.AxisOpts(
-                name="消息数",
-                type_="value",
-                axistick_opts=opts.AxisTickOpts(is_show=True),
-                splitline_opts=opts.SplitLineOpts(is_show=True),
-            ),
-            visualmap_opts=opts.VisualMapOpts(
-                min_=min(y_data),
-                max_=max(y_data),
-                dimension=1,  # 根据第2个维度（y 轴）进行映射
-                is_piecewise=False,  # 是否分段显示
-                range_color=["#ffbe7a", "#fa7f6f"],  # 设置颜色范围
-                type_="color",
-                pos_right="0%",
-            ),
-        )
-    )
     return {
-        'chart_data': m.dump_options_with_quotes(),
+        'chart_data': render_chart(build_month_bar, x_axis, y_data) if y_data else None,
         # 'chart': m,
     }
 
@@ -296,101 +318,25 @@ types_ = {
 }
 
 
-def get_weekday(timestamp):
-    # 将时间戳转换为日期时间对象
-    dt_object = datetime.fromtimestamp(timestamp)
-
-    # 获取星期几，0代表星期一，1代表星期二，以此类推
-    weekday = dt_object.weekday()
-    weekdays = ['周一', '周二', '周三', '周四', '周五', '周六', '周日']
-    return weekdays[weekday]
-
-
 def sender(wxid, time_range, my_name='', ta_name=''):
-    msg_data = msg_db.get_messages(wxid, time_range)
-
-    types_count = {}
-    send_num = 0  # 发送消息的数量
-    weekday_count = {}
-    for message in msg_data:
-        type_ = message[2]
-        is_sender = message[4]
-        subType = message[3]
-        timestamp = message[5]
-        weekday = get_weekday(timestamp)
-        str_time = message[8]
-        send_num += is_sender
-        type_ = f'{type_}{subType:0>2d}' if subType != 0 else type_
-        type_ = int(type_)
-        if type_ in types_count:
-            types_count[type_] += 1
-        else:
-            types_count[type_] = 1
-        if weekday in weekday_count:
-            weekday_count[weekday] += 1
-        else:
-            weekday_count[weekday] = 1
-    receive_num = len(msg_data) - send_num
-    data = [[types_.get(key), value] for key, value in types_count.items() if key in types_]
+    columns = load_columns(wxid, time_range)
+    send_num = columns.send_count()  # 发送消息的数量
+    receive_num = len(columns) - send_num
+    data = [[types_.get(key), value] for key, value in columns.type_counts().items() if key in types_]
+    weekday_count = columns.weekday_counts().tolist()
     if not data:
         return {
             'chart_data_sender': None,
             'chart_data_types': None,
             'chart_data_weekday': None,
         }
-    p1 = (
-        Pie()
-        .add(
-            "",
-            data,
-            center=["40%", "50%"],
-        )
-        .set_global_opts(
-            datazoom_opts=opts.DataZoomOpts(),
-            toolbox_opts=opts.ToolboxOpts(),
-            title_opts=opts.TitleOpts(title="消息类型占比"),
-            legend_opts=opts.LegendOpts(type_="scroll", pos_left="80%", pos_top="20%", orient="vertical"),
-        )
-        .set_series_opts(label_opts=opts.LabelOpts(formatter="{b}: {c}"))
-        # .render("./data/聊天统计/types_pie.html")
-    )
-    p2 = (
-        Pie()
-        .add(
-            "",
-            [[my_name, send_num], [ta_name, receive_num]],
-            center=["40%", "50%"],
-        )
-        .set_global_opts(
-            datazoom_opts=opts.DataZoomOpts(),
-            toolbox_opts=opts.ToolboxOpts(),
-            title_opts=opts.TitleOpts(title="双方消息占比"),
-            legend_opts=opts.LegendOpts(type_="scroll", pos_left="80%", pos_top="20%", orient="vertical"),
-        )
-        .set_series_opts(label_opts=opts.LabelOpts(formatter="{b}: {c}\n{d}%"))
-        # .render("./data/聊天统计/pie_scroll_legend.html")
-    )
-    p3 = (
-        Pie()
-        .add(
-            "",
-            [[key, value] for key, value in weekday_count.items()],
-            radius=["40%", "75%"],
-        )
-        .set_global_opts(
-            datazoom_opts=opts.DataZoomOpts(),
-            toolbox_opts=opts.ToolboxOpts(),
-            title_opts=opts.TitleOpts(title="星期分布图"),
-            legend_opts=opts.LegendOpts(orient="vertical", pos_top="15%", pos_left="2%"),
-        )
-        .set_series_opts(label_opts=opts.LabelOpts(formatter="{b}: {c}\n{d}%"))
-        # .render("./data/聊天统计/pie_weekdays.html")
-    )
-    return {
-        'chart_data_sender': p2.dump_options_with_quotes(),
-        'chart_data_types': p1.dump_options_with_quotes(),
-        'chart_data_weekday': p3.dump_options_with_quotes(),
-    }
+    return render_charts({
+        'chart_data_sender': chart_spec(build_pie, [[my_name, send_num], [ta_name, receive_num]], title="双方消息占比",
+                                        formatter="{b}: {c}\n{d}%"),
+        'chart_data_types': chart_spec(build_pie, data, title="消息类型占比"),
+        'chart_data_weekday': chart_spec(build_weekday_pie,
+                                         [[weekday, num] for weekday, num in zip(WEEKDAYS, weekday_count) if num]),
+    })
 
 
 def contacts_analysis(contacts):
@@ -428,94 +374,35 @@ def contacts_analysis(contacts):
     data = [[k, v] for k, v in data.items()]
     print(data)
     max_ = max(list(map(lambda x:x[1],data)))
-    c = (
-        Map()
-        .add("分布", data, "china")
-        .set_series_opts(label_opts=opts.LabelOpts(is_show=False))
-        .set_global_opts(
-            title_opts=opts.TitleOpts(title="地区分布"),
-            visualmap_opts=opts.VisualMapOpts(max_=max_, is_piecewise=True),
-            legend_opts=opts.LegendOpts(is_show=False),
-        )
-    )
     return {
         'woman_contact_num': woman_contact_num,
         'man_contact_num': man_contact_num,
-        'contact_region_map': c.dump_options_with_quotes(),
+        'contact_region_map': render_chart(build_region_map, data, max_),
     }
 
 
 def my_message_counter(time_range, my_name=''):
-    msg_data = msg_db.get_messages_all(time_range=time_range)
-    types_count = {}
-    send_num = 0  # 发送消息的数量
-    weekday_count = {}
-    str_content = ''
-    total_text_num = 0
-    for message in msg_data:
-        type_ = message[2]
-        is_sender = message[4]
-        subType = message[3]
-        timestamp = message[5]
-        weekday = get_weekday(timestamp)
-        str_time = message[8]
-        send_num += is_sender
-        type_ = f'{type_}{subType:0>2d}' if subType != 0 else type_
-        type_ = int(type_)
-        if type_ in types_count:
-            types_count[type_] += 1
-        else:
-            types_count[type_] = 1
-        if weekday in weekday_count:
-            weekday_count[weekday] += 1
-        else:
-            weekday_count[weekday] = 1
-        if type_ == 1:
-            total_text_num += len(message[7])
-            if is_sender == 1:
-                str_content += message[7]
-    receive_num = len(msg_data) - send_num
-    data = [[types_.get(key), value] for key, value in types_count.items() if key in types_]
+    columns = load_columns(time_range=time_range)
+    send_num = columns.send_count()  # 发送消息的数量
+    receive_num = len(columns) - send_num
+    total_text_num = columns.text_length()
+    data = [[types_.get(key), value] for key, value in columns.type_counts().items() if key in types_]
     if not data:
         return {
             'chart_data_sender': None,
             'chart_data_types': None,
         }
-    p1 = (
-        Pie()
-        .add(
-            "",
-            data,
-            center=["40%", "50%"],
-        )
-        .set_global_opts(
-            datazoom_opts=opts.DataZoomOpts(),
-            legend_opts=opts.LegendOpts(type_="scroll", pos_left="70%", pos_top="10%", orient="vertical"),
-        )
-        .set_series_opts(label_opts=opts.LabelOpts(formatter="{b}: {c}"))
-        # .render("./data/聊天统计/types_pie.html")
-    )
-    p2 = (
-        Pie()
-        .add(
-            "",
-            [['发送', send_num], ['接收', receive_num]],
-            center=["40%", "50%"],
-        )
-        .set_global_opts(
-            datazoom_opts=opts.DataZoomOpts(),
-            legend_opts=opts.LegendOpts(type_="scroll", pos_left="70%", pos_top="20%", orient="vertical"),
-        )
-        .set_series_opts(label_opts=opts.LabelOpts(formatter="{b}: {c}\n{d}%", position='inside'))
-        # .render("./data/聊天统计/pie_scroll_legend.html")
-    )
-    w = get_wordcloud(str_content)
+    # 自己发送的文字的词云，词频按天缓存
+    wordcloud, wordcloud_data = wordcloud_spec(get_word_counts(time_range=time_range, is_send=1)[0])
+    charts = render_charts({
+        'chart_data_sender': chart_spec(build_pie, [['发送', send_num], ['接收', receive_num]], legend_left="70%",
+                                        formatter="{b}: {c}\n{d}%", label_position='inside', toolbox=False),
+        'chart_data_types': chart_spec(build_pie, data, legend_left="70%", legend_top="10%", toolbox=False),
+        'chart_data_wordcloud': wordcloud,
+    })
     return {
-        'chart_data_sender': p2.dump_options_with_quotes(),
-        'chart_data_types': p1.dump_options_with_quotes(),
-        'chart_data_wordcloud': w.get('chart_data_wordcloud'),
-        'keyword': w.get('keyword'),
-        'keyword_max_num': w.get('keyword_max_num'),
+        **charts,
+        **wordcloud_data,
         'total_text_num': total_text_num,
     }
 
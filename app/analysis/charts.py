@@ -0,0 +1,108 @@
+"""
+图表配置（ECharts option JSON）的生成和缓存
+
+pyecharts 每次都要新建图表对象、填选项、再序列化成 JSON，报告页面的图表多，这部分开销不小。
+这里把每种图表的构建写成一个函数，以 (构建函数, 参数的哈希) 为键缓存 dump_options_with_quotes() 的结果，
+数据没变时直接返回缓存的字符串，不再创建 pyecharts 对象。
+一个页面的几个图表用 render_charts 一起生成：一次查缓存，只构建没命中的图表。
+"""
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict
+
+from app.config import CHART_OPTION_CACHE_SIZE
+
+
+def _default(obj):
+    # numpy 的数值、日期等
+    if hasattr(obj, 'item'):
+        return obj.item()
+    return str(obj)
+
+
+def chart_key(builder: Callable, args=(), kwargs=None) -> tuple:
+    """
+    @param builder: 图表构建函数，返回 pyecharts 图表对象
+    @param args: 构建函数的参数
+    @param kwargs:
+    @return: (图表类型, 数据哈希)
+    """
+    data = json.dumps([args, kwargs or {}], ensure_ascii=False, sort_keys=True, default=_default)
+    return f'{builder.__module__}.{builder.__qualname__}', hashlib.md5(data.encode('utf-8')).hexdigest()
+
+
+class ChartOptionCache:
+    def __init__(self, max_size=CHART_OPTION_CACHE_SIZE):
+        self.max_size = max_size
+        self.options = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.options)
+
+    def get_many(self, keys) -> dict:
+        result = {}
+        with self.lock:
+            for key in keys:
+                value = self.options.get(key)
+                if value is not None:
+                    self.options.move_to_end(key)
+                    result[key] = value
+        return result
+
+    def put_many(self, items: dict):
+        with self.lock:
+            for key, value in items.items():
+                self.options[key] = value
+                self.options.move_to_end(key)
+            while len(self.options) > self.max_size:
+                self.options.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.options.clear()
+
+    def render_charts(self, specs: Dict[str, tuple | None]) -> Dict[str, str | None]:
+        """
+        一次生成多个图表的配置
+        @param specs: {名称: chart_spec(构建函数, 参数...)}，值为 None 的表示没有数据
+        @return: {名称: option JSON 字符串}，没有数据的为 None
+        """
+        keys = {name: chart_key(*spec) for name, spec in specs.items() if spec is not None}
+        cached = self.get_many(set(keys.values()))
+        built = {}
+        result = {}
+        for name, spec in specs.items():
+            key = keys.get(name)
+            if key is None:
+                result[name] = None
+                continue
+            options = cached.get(key) or built.get(key)
+            if options is None:
+                builder, args, kwargs = spec
+                options = built[key] = builder(*args, **kwargs).dump_options_with_quotes()
+            result[name] = options
+        if built:
+            self.put_many(built)
+        return result
+
+    def render_chart(self, builder: Callable, *args, **kwargs) -> str:
+        """
+        生成单个图表的配置
+        """
+        return self.render_charts({'chart': chart_spec(builder, *args, **kwargs)})['chart']
+
+
+def chart_spec(builder: Callable, *args, **kwargs) -> tuple:
+    """
+    @param builder: 图表构建函数，返回 pyecharts 图表对象
+    @return: render_charts 用的 (构建函数, 参数, 关键字参数)
+    """
+    return builder, args, kwargs
+
+
+chart_cache = ChartOptionCache()
+render_charts = chart_cache.render_charts
+render_chart = chart_cache.render_chart
@@ -0,0 +1,321 @@
+"""
+消息元数据的列式统计
+
+把 (localId, CreateTime, Type, SubType, IsSender, 联系人编号, 文字长度) 读进 NumPy 数组，
+星期、小时、消息类型、发送方的分布都用数组运算一次算出来，不再逐条消息转换时间、累加字典。
+联系人用编号保存，编号对应的 wxid 在 talkers 列表里。
+"""
+import json
+import os
+import threading
+import time
+import traceback
+
+import numpy as np
+
+from app.DataBase import msg_db
+from app.DataBase.msg import convert_to_timestamp
+from app.analysis.msg_index import MsgIndexBase
+from app.config import CACHE_DIR
+from app.log import logger
+
+SNAPSHOT_VERSION = 1
+SNAPSHOT_BATCH_SIZE = 50000  # 每批读取、追加的消息条数
+META_COLUMNS = (
+    'localId,CreateTime,Type,ifnull(SubType,0),ifnull(IsSender,0),StrTalker,'
+    'CASE WHEN Type=1 THEN ifnull(length(StrContent),0) ELSE 0 END'
+)
+WEEKDAYS = ['周一', '周二', '周三', '周四', '周五', '周六', '周日']
+FIELDS = ('local_id', 'create_time', 'type', 'sub_type', 'is_send', 'talker', 'text_len')
+DTYPES = {
+    'local_id': np.int64,
+    'create_time': np.int64,
+    'type': np.int32,
+    'sub_type': np.int32,
+    'is_send': np.int8,
+    'talker': np.int32,
+    'text_len': np.int32,
+}
+
+
+def utc_offset(timestamp) -> int:
+    """
+    本地时区在这个时刻相对 UTC 的秒数
+    """
+    return time.localtime(timestamp).tm_gmtoff
+
+
+def local_seconds(timestamps: np.ndarray) -> np.ndarray:
+    """
+    时间戳换算成本地时间的秒数（从 1970-01-01 00:00 本地时间算起）
+    时区偏移（夏令时）只在整点变化，每个小时只算一次
+    """
+    if not len(timestamps):
+        return timestamps.astype(np.int64)
+    hours, inverse = np.unique(timestamps // 3600, return_inverse=True)
+    offsets = np.fromiter((utc_offset(int(hour) * 3600) for hour in hours), dtype=np.int64, count=len(hours))
+    return timestamps + offsets[inverse]
+
+
+def type_keys(type_: np.ndarray, sub_type: np.ndarray) -> np.ndarray:
+    """
+    和 analysis.types_ 的键一致：没有子类型时是 Type，否则是 Type 后面接两位以上的 SubType（49 和 57 -> 4957）
+    """
+    type_ = type_.astype(np.int64)
+    sub_type = sub_type.astype(np.int64)
+    digits = np.maximum(np.floor(np.log10(np.maximum(sub_type, 1))).astype(np.int64) + 1, 2)
+    return np.where(sub_type == 0, type_, type_ * 10 ** digits + sub_type)
+
+
+class MessageColumns:
+    def __init__(self, columns: dict, talkers: list):
+        """
+        @param columns: 字段名 -> 等长的数组
+        @param talkers: 联系人编号 -> wxid
+        """
+        self.columns = columns
+        self.talkers = talkers
+        self._local = None
+
+    def __len__(self):
+        return len(self.columns['create_time'])
+
+    def __getattr__(self, name):
+        columns = self.__dict__.get('columns')
+        if columns is not None and name in columns:
+            return columns[name]
+        raise AttributeError(name)
+
+    @classmethod
+    def empty(cls):
+        return cls({name: np.zeros(0, dtype=DTYPES[name]) for name in FIELDS}, [])
+
+    def filter(self, mask):
+        return MessageColumns({name: column[mask] for name, column in self.columns.items()}, self.talkers)
+
+    def talker_code(self, wxid) -> int:
+        try:
+            return self.talkers.index(wxid)
+        except ValueError:
+            return -1
+
+    def select(self, wxid=None, time_range=None, is_send=None):
+        """
+        按联系人、时间范围、发送方筛选
+        """
+        mask = np.ones(len(self), dtype=bool)
+        if wxid:
+            mask &= self.talker == self.talker_code(wxid)
+        if time_range:
+            start_time, end_time = convert_to_timestamp(time_range)
+            mask &= (self.create_time > start_time) & (self.create_time < end_time)
+        if is_send is not None:
+            mask &= self.is_send == is_send
+        return self.filter(mask)
+
+    def local_time(self) -> np.ndarray:
+        if self._local is None:
+            self._local = local_seconds(self.create_time)
+        return self._local
+
+    def weekday_counts(self) -> np.ndarray:
+        """
+        @return: 长度为 7 的数组，第 0 项是周一
+        """
+        days = self.local_time() // 86400
+        return np.bincount((days + 3) % 7, minlength=7)  # 1970-01-01 是周四
+
+    def hour_counts(self) -> np.ndarray:
+        """
+        @return: 长度为 24 的数组
+        """
+        return np.bincount(self.local_time() % 86400 // 3600, minlength=24)
+
+    def type_counts(self) -> dict:
+        """
+        @return: {类型键: 条数}，类型键见 type_keys
+        """
+        keys, counts = np.unique(type_keys(self.type, self.sub_type), return_counts=True)
+        return dict(zip(keys.tolist(), counts.tolist()))
+
+    def send_count(self) -> int:
+        return int(np.count_nonzero(self.is_send))
+
+    def text_length(self) -> int:
+        """
+        文本消息的总字数
+        """
+        return int(self.text_len.sum(dtype=np.int64))
+
+    def talker_counts(self) -> dict:
+        """
+        @return: {wxid: 条数}
+        """
+        counts = np.bincount(self.talker, minlength=len(self.talkers))
+        return {self.talkers[code]: int(count) for code, count in enumerate(counts.tolist()) if count}
+
+
+def batch_to_arrays(rows, talker_codes) -> dict:
+    """
+    一批 (localId, CreateTime, Type, SubType, IsSender, StrTalker, 文字长度) 转换成数组
+    @param talker_codes: wxid -> 编号，新出现的联系人会加进去
+    """
+    arrays = {}
+    for name, values in zip(FIELDS, zip(*rows)):
+        if name == 'talker':
+            values = [talker_codes.setdefault(talker, len(talker_codes)) for talker in values]
+        arrays[name] = np.fromiter(values, dtype=DTYPES[name], count=len(rows))
+    return arrays
+
+
+def from_batches(batches) -> MessageColumns:
+    """
+    @param batches: msg_db.get_message_meta_batches 的结果
+    """
+    parts = {name: [] for name in FIELDS}
+    talker_codes = {}
+    for rows in batches:
+        for name, array in batch_to_arrays(rows, talker_codes).items():
+            parts[name].append(array)
+    if not parts['create_time']:
+        return MessageColumns.empty()
+    talkers = list(talker_codes)
+    return MessageColumns({name: np.concatenate(arrays) for name, arrays in parts.items()}, talkers)
+
+
+def new_meta() -> dict:
+    return {'version': SNAPSHOT_VERSION, 'rows': 0, 'max_local_id': 0, 'time_sum': 0, 'talkers': []}
+
+
+class ColumnSnapshot(MsgIndexBase):
+    """
+    MSG 元数据的列式快照，保存在缓存目录里
+        <字段名>.bin: 定长数组（DTYPES），按 localId 顺序，只在末尾追加
+        meta.json: 行数、最大 localId、时间戳之和、联系人编号 -> wxid
+    读取时直接内存映射，不用解析。
+    """
+    name = 'column_snapshot'
+    title = '消息快照'
+
+    def __init__(self, snapshot_dir=os.path.join(CACHE_DIR, 'columns')):
+        super().__init__()
+        self.snapshot_dir = snapshot_dir
+        self._columns = None  # 内存映射的 MessageColumns
+
+    def column_path(self, name) -> str:
+        return os.path.join(self.snapshot_dir, f'{name}.bin')
+
+    def load_meta(self) -> dict:
+        meta_path = os.path.join(self.snapshot_dir, 'meta.json')
+        if os.path.exists(meta_path):
+            try:
+                with open(meta_path, 'r', encoding='utf-8') as f:
+                    meta = json.load(f)
+                if meta.get('version') == SNAPSHOT_VERSION:
+                    return meta
+            except Exception:
+                logger.error(traceback.format_exc())
+        return new_meta()
+
+    def save_meta(self, meta):
+        meta_path = os.path.join(self.snapshot_dir, 'meta.json')
+        tmp_path = f'{meta_path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp_path, meta_path)
+
+    def truncate(self, rows):
+        """
+        去掉上次写了一半的数据，各列都截到 rows 行
+        """
+        for name in FIELDS:
+            path = self.column_path(name)
+            size = rows * np.dtype(DTYPES[name]).itemsize
+            if not os.path.exists(path):
+                open(path, 'wb').close()
+            elif os.path.getsize(path) != size:
+                with open(path, 'r+b') as f:
+                    f.truncate(size)
+
+    def prepare(self):
+        self._columns = None  # 写入前释放内存映射
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+
+    def load_mark(self):
+        meta = self.load_meta()
+        return meta['max_local_id'], meta['rows'], meta['time_sum']
+
+    def clear(self):
+        self.truncate(0)
+        self.save_meta(new_meta())
+
+    def sync(self, msg_conn, max_local_id, msg_num, time_sum):
+        with self.lock:
+            meta = self.load_meta()
+            self.truncate(meta['rows'])
+            self.save_meta(meta)
+        talker_codes = {talker: code for code, talker in enumerate(meta['talkers'])}
+        cursor = msg_conn.execute(f'''
+            SELECT {META_COLUMNS}
+            FROM MSG
+            {self._where_new()}
+            ORDER BY localId
+        ''', [meta['max_local_id']])
+        for rows in self.batches(cursor, SNAPSHOT_BATCH_SIZE):
+            arrays = batch_to_arrays(rows, talker_codes)
+            for name, array in arrays.items():
+                with open(self.column_path(name), 'ab') as f:
+                    array.tofile(f)
+            meta['rows'] += len(rows)
+            meta['max_local_id'] = rows[-1][0]
+            meta['time_sum'] += int(arrays['create_time'].sum())
+            meta['talkers'] = list(talker_codes)
+            with self.lock:
+                self.save_meta(meta)
+
+    def stop(self):
+        """
+        停止后台更新（重新解密前调用，释放对 MSG.db 和快照文件的占用）
+        """
+        super().stop()
+        self.close()
+
+    def columns(self) -> MessageColumns | None:
+        """
+        内存映射打开整个快照
+        @return: 快照没有同步时返回 None
+        """
+        if not self.is_ready():
+            return None
+        with self.lock:
+            if self._columns is None:
+                meta = self.load_meta()
+                rows = meta['rows']
+                arrays = {}
+                for name in FIELDS:
+                    if rows:
+                        arrays[name] = np.memmap(self.column_path(name), dtype=DTYPES[name], mode='r', shape=(rows,))
+                    else:
+                        arrays[name] = np.zeros(0, dtype=DTYPES[name])
+                self._columns = MessageColumns(arrays, meta['talkers'])
+            return self._columns
+
+    def close(self):
+        with self.lock:
+            self._columns = None
+            self.ready = False
+
+
+column_snapshot = ColumnSnapshot()
+
+
+def load_columns(wxid=None, time_range=None) -> MessageColumns:
+    """
+    消息元数据，快照可用时从快照筛选，否则从 MSG.db 读取
+    @param wxid: 不传时读取全部联系人
+    @param time_range:
+    """
+    columns = column_snapshot.columns()
+    if columns is not None:
+        return columns.select(wxid, time_range)
+    return from_batches(msg_db.get_message_meta_batches(wxid, time_range))
@@ -0,0 +1,342 @@
+"""
+聊天记录全文检索
+
+文本消息的 StrContent 和 appmsg 消息（链接、文件、引用回复等）的标题保存在缓存目录的 FTS5 数据库里：
+    docs: localId -> (联系人, 时间, 类型, 子类型, 是否自己发送, 原文)
+    msg_fts: 分词后的文本（contentless，rowid 就是 localId）
+FTS5 自带的分词器不认识中文词，这里先在 Python 里切分：连续的汉字切成重叠的二元组（"今天吃饭" -> 今天 天吃 吃饭），
+每段汉字的最后一个字再单独记一次，这样单字也能用前缀查询找到；英文、数字交给 unicode61 处理。
+查询时关键词用同样的方法切分，按短语匹配，结果按 bm25 排序，摘要从原文里截取。
+"""
+import html
+import os
+import re
+import sqlite3
+import traceback
+
+from app.DataBase.connection import connect
+from app.DataBase.msg import convert_to_timestamp
+from app.analysis.msg_index import MsgIndexBase
+from app.config import CACHE_DIR
+from app.log import logger
+from app.util.appmsg import parse_xml
+from app.util.compress_content import decompress_CompressContent
+
+INDEX_VERSION = 1
+BATCH_SIZE = 5000  # 每批读取、写入的消息条数
+INDEX_TYPES = (1, 49)  # 文本消息、appmsg 消息
+SNIPPET_SIZE = 40  # 摘要的字数
+MAX_LIMIT = 200  # 每次检索最多返回的条数
+
+_CJK_PATTERN = re.compile(r'[㐀-䶿一-鿿豈-﫿぀-ヿ가-힯]+')
+_WORD_PATTERN = re.compile(r'\w+')
+
+
+def cjk_tokens(run) -> list:
+    """
+    一段连续汉字的二元组，最后一个字单独保留
+    """
+    tokens = [run[i:i + 2] for i in range(len(run) - 1)]
+    tokens.append(run[-1])
+    return tokens
+
+
+def tokenize(text) -> str:
+    """
+    切分成以空格分隔的词，写入 FTS5
+    """
+    if not text:
+        return ''
+    tokens = []
+    pos = 0
+    for match in _CJK_PATTERN.finditer(text):
+        if match.start() > pos:
+            tokens.append(text[pos:match.start()])
+        tokens.extend(cjk_tokens(match.group()))
+        pos = match.end()
+    if pos < len(text):
+        tokens.append(text[pos:])
+    return ' '.join(tokens)
+
+
+def build_query(keyword) -> str:
+    """
+    把关键词转换成 FTS5 查询，空格分隔的多个关键词之间是"并且"
+    @return: 关键词里没有可以检索的字符时返回空字符串
+    """
+    terms = []
+    for part in keyword.split():
+        pos = 0
+        for match in _CJK_PATTERN.finditer(part):
+            terms.extend(_word_terms(part[pos:match.start()]))
+            run = match.group()
+            if len(run) == 1:
+                terms.append(f'"{run}"*')
+            else:
+                terms.append('"' + ' '.join(run[i:i + 2] for i in range(len(run) - 1)) + '"')
+            pos = match.end()
+        terms.extend(_word_terms(part[pos:]))
+    return ' AND '.join(terms)
+
+
+def _word_terms(text) -> list:
+    # 英文、数字按前缀匹配，输入一半也能搜到
+    words = _WORD_PATTERN.findall(text)
+    return [f'"{word}"*' for word in words]
+
+
+def make_snippet(text, keyword, size=SNIPPET_SIZE) -> str:
+    """
+    截取第一个关键词附近的一段原文，关键词用 <mark> 标出，其余内容做 HTML 转义
+    """
+    if not text:
+        return ''
+    words = [word for word in keyword.split() if word]
+    lower_text = text.lower()
+    positions = [lower_text.find(word.lower()) for word in words]
+    positions = [pos for pos in positions if pos >= 0]
+    start = max(min(positions) - size // 4, 0) if positions else 0
+    end = min(start + size, len(text))
+    piece = text[start:end]
+    if words:
+        pattern = re.compile('|'.join(re.escape(word) for word in sorted(words, key=len, reverse=True)), re.I)
+        parts = []
+        pos = 0
+        for match in pattern.finditer(piece):
+            parts.append(html.escape(piece[pos:match.start()]))
+            parts.append(f'<mark>{html.escape(match.group())}</mark>')
+            pos = match.end()
+        parts.append(html.escape(piece[pos:]))
+        snippet = ''.join(parts)
+    else:
+        snippet = html.escape(piece)
+    return ('…' if start > 0 else '') + snippet + ('…' if end < len(text) else '')
+
+
+def get_text(type_, content, compress_content) -> str:
+    """
+    消息里需要检索的文字：文本消息的内容，appmsg 的标题
+    """
+    if type_ == 1:
+        return content or ''
+    appmsg = parse_xml(decompress_CompressContent(compress_content))
+    if appmsg is None:
+        return ''
+    return appmsg.title or ''
+
+
+class FullTextIndex(MsgIndexBase):
+    name = 'full_text_index'
+    title = '全文索引'
+    msg_filter = f"Type in ({','.join(str(type_) for type_ in INDEX_TYPES)})"
+
+    def __init__(self, db_path=os.path.join(CACHE_DIR, 'full_text.db')):
+        super().__init__()
+        self.db_path = db_path
+        self.DB = None
+        self.cursor = None
+
+    def init_database(self):
+        if self.DB is not None:
+            return
+        if self.read_only:
+            # 只打开主程序建好的索引，不存在时不创建
+            if os.path.exists(self.db_path):
+                self.DB = connect(self.db_path, read_only=True)
+                self.cursor = self.DB.cursor()
+            return
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        self.DB = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.cursor = self.DB.cursor()
+        self.cursor.executescript('''
+            create table if not exists meta(key text primary key, value text);
+            create table if not exists docs(
+                local_id integer primary key, talker text, create_time integer,
+                type integer, sub_type integer, is_send integer, text text
+            );
+            create index if not exists docs_talker on docs(talker, create_time);
+            create virtual table if not exists msg_fts using fts5(tokens, content='', tokenize='unicode61');
+        ''')
+        if self.get_meta('version') != str(INDEX_VERSION):
+            self.clear()
+            self.set_meta('version', INDEX_VERSION)
+        self.DB.commit()
+
+    def get_meta(self, key, default=None):
+        self.cursor.execute('select value from meta where key=?', [key])
+        row = self.cursor.fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        self.cursor.execute('insert or replace into meta(key, value) values (?, ?)', [key, str(value)])
+
+    def prepare(self):
+        self.init_database()
+
+    def load_mark(self):
+        self.init_database()
+        if self.DB is None or self.get_meta('version') != str(INDEX_VERSION):
+            return None
+        return (int(self.get_meta('max_local_id', 0)), int(self.get_meta('msg_num', 0)),
+                int(self.get_meta('time_sum', 0)))
+
+    def clear(self):
+        self.cursor.execute('delete from docs')
+        self.cursor.execute("insert into msg_fts(msg_fts) values ('delete-all')")
+        for key in ('max_local_id', 'msg_num', 'time_sum'):
+            self.set_meta(key, 0)
+        self.DB.commit()
+
+    def sync(self, msg_conn, max_local_id, msg_num, time_sum):
+        cursor = msg_conn.execute(
+            f'select localId,StrTalker,CreateTime,Type,SubType,IsSender,StrContent,CompressContent '
+            f'from MSG {self._where_new()} order by localId',
+            [max_local_id]
+        )
+        for rows in self.batches(cursor, BATCH_SIZE):
+            msg_num, time_sum = self.add(rows, msg_num, time_sum)
+
+    def add(self, rows, msg_num, time_sum):
+        """
+        写入一批消息（按 localId 顺序），每批提交一次，中断后下次从断点继续
+        """
+        docs = []
+        for local_id, talker, create_time, type_, sub_type, is_send, content, compress_content in rows:
+            msg_num += 1
+            time_sum += create_time
+            try:
+                text = get_text(type_, content, compress_content)
+            except:
+                logger.error(traceback.format_exc())
+                continue
+            if text:
+                docs.append((local_id, talker, create_time, type_, sub_type, is_send, text))
+        with self.lock:
+            try:
+                self.cursor.executemany('insert or replace into docs values (?,?,?,?,?,?,?)', docs)
+                self.cursor.executemany('insert into msg_fts(rowid, tokens) values (?,?)',
+                                        [(doc[0], tokenize(doc[6])) for doc in docs])
+                self.set_meta('max_local_id', rows[-1][0])
+                self.set_meta('msg_num', msg_num)
+                self.set_meta('time_sum', time_sum)
+                self.DB.commit()
+            except:
+                self.DB.rollback()
+                raise
+        return msg_num, time_sum
+
+    def search(self, keyword, wxid=None, time_range=None, types=None, is_send=None, order='rank', limit=50, offset=0):
+        """
+        全文检索
+        @param keyword: 关键词，空格分隔的多个关键词要同时出现
+        @param wxid: 只查这个联系人（群聊）
+        @param time_range:
+        @param types: 只查这些消息类型，比如 [1] 只查文本消息，[49] 只查链接、文件等
+        @param is_send: 1 只查自己发的，0 只查对方发的
+        @param order: 'rank' 按相关度，'time' 按时间从新到旧
+        @param limit:
+        @param offset:
+        @return: [{'localId', 'talker', 'CreateTime', 'StrTime', 'Type', 'SubType', 'IsSender', 'text', 'snippet'}]，
+                 索引还没有建好时返回 None
+        """
+        query = build_query(keyword or '')
+        if not query:
+            return []
+        limit = max(1, min(int(limit), MAX_LIMIT))
+        offset = max(0, int(offset))
+        if not self.is_ready():
+            return None
+        conditions = ['msg_fts match ?']
+        params = [query]
+        if wxid:
+            conditions.append('docs.talker=?')
+            params.append(wxid)
+        if time_range:
+            start_time, end_time = convert_to_timestamp(time_range)
+            conditions.append('docs.create_time>? and docs.create_time<?')
+            params.extend([start_time, end_time])
+        if types:
+            conditions.append(f"docs.type in ({','.join('?' * len(types))})")
+            params.extend(types)
+        if is_send is not None:
+            conditions.append('docs.is_send=?')
+            params.append(is_send)
+        sql = f'''
+            select docs.local_id,docs.talker,docs.create_time,
+                strftime('%Y-%m-%d %H:%M:%S',docs.create_time,'unixepoch','localtime'),
+                docs.type,docs.sub_type,docs.is_send,docs.text
+            from msg_fts join docs on docs.local_id=msg_fts.rowid
+            where {' and '.join(conditions)}
+            order by {'docs.create_time desc' if order == 'time' else 'msg_fts.rank'}
+            limit ? offset ?
+        '''
+        params.extend([limit, offset])
+        with self.lock:
+            try:
+                self.cursor.execute(sql, params)
+                rows = self.cursor.fetchall()
+            except sqlite3.OperationalError:
+                logger.error(traceback.format_exc())
+                return []
+        return [
+            {
+                'localId': local_id,
+                'talker': talker,
+                'CreateTime': create_time,
+                'StrTime': str_time,
+                'Type': type_,
+                'SubType': sub_type,
+                'IsSender': is_send,
+                'text': text,
+                'snippet': make_snippet(text, keyword),
+            }
+            for local_id, talker, create_time, str_time, type_, sub_type, is_send, text in rows
+        ]
+
+    def count(self, keyword, wxid=None, time_range=None):
+        """
+        每个联系人命中的消息条数
+        @return: {wxid: 条数}，索引还没有建好时返回 None
+        """
+        query = build_query(keyword or '')
+        if not query:
+            return {}
+        if not self.is_ready():
+            return None
+        conditions = ['msg_fts match ?']
+        params = [query]
+        if wxid:
+            conditions.append('docs.talker=?')
+            params.append(wxid)
+        if time_range:
+            start_time, end_time = convert_to_timestamp(time_range)
+            conditions.append('docs.create_time>? and docs.create_time<?')
+            params.extend([start_time, end_time])
+        sql = f'''
+            select docs.talker,count(*)
+            from msg_fts join docs on docs.local_id=msg_fts.rowid
+            where {' and '.join(conditions)}
+            group by docs.talker
+        '''
+        with self.lock:
+            try:
+                self.cursor.execute(sql, params)
+                return dict(self.cursor.fetchall())
+            except sqlite3.OperationalError:
+                logger.error(traceback.format_exc())
+                return {}
+
+    def close(self):
+        with self.lock:
+            if self.DB is not None:
+                self.DB.close()
+                self.DB = None
+                self.cursor = None
+            self.ready = False
+
+
+full_text_index = FullTextIndex()
+
+
+def search(keyword, wxid=None, time_range=None, types=None, is_send=None, order='rank', limit=50, offset=0):
+    return full_text_index.search(keyword, wxid, time_range, types, is_send, order, limit, offset)
@@ -0,0 +1,178 @@
+"""
+按 localId 增量同步 MSG.db 的缓存（词项索引、全文索引、消息快照）的公共部分
+
+缓存在解密完成后于后台建立，之后只追加 localId 比上次大的消息。
+MSG.db 重新合并后 localId 可能整体变化，所以每次更新前先核对已同步部分的条数和时间戳之和，
+不一致时清空重建。没有同步好时 is_ready() 返回 False，调用方先用别的方式查询。
+"""
+import os
+import sqlite3
+import threading
+import traceback
+
+from app.DataBase import msg as msg_module
+from app.log import logger
+
+
+class MsgIndexBase:
+    name = 'msg_index'  # 后台线程名
+    title = '索引'  # 提示信息里的名称
+    msg_filter = ''  # 参与同步的消息条件，比如 'Type=1'，空字符串表示全部消息
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.build_lock = threading.Lock()  # 同一时间只有一个线程更新
+        self.ready = False  # 本次运行中已经和 MSG.db 同步
+        self.read_only = False  # 报告服务的 worker 进程里只读打开主程序建好的缓存，不建立也不更新
+        self.thread = None
+        self.stopping = threading.Event()
+
+    # 子类实现的部分
+
+    def load_mark(self) -> tuple | None:
+        """
+        @return: 已同步的位置 (最大 localId, 条数, 时间戳之和)，在 self.lock 里调用；
+                 只读时缓存不存在或者版本不对返回 None
+        """
+        raise NotImplementedError
+
+    def clear(self):
+        """
+        清空已同步的内容（包括同步位置），在 self.lock 里调用
+        """
+        raise NotImplementedError
+
+    def sync(self, msg_conn, max_local_id, msg_num, time_sum):
+        """
+        把 localId > max_local_id 的消息按 localId 顺序写入，每批写完后保存同步位置；
+        self.stopping 被设置时尽快返回
+        """
+        raise NotImplementedError
+
+    def prepare(self):
+        """
+        更新前的准备（打开缓存数据库、释放内存映射等），在 self.lock 里调用
+        """
+
+    # 公共部分
+
+    def _count_sql(self, with_max=False) -> str:
+        """
+        核对用的 SQL：条数、时间戳之和（整数求和，total() 是浮点数，消息多了会对不上）
+        @param with_max: True 时统计全部消息并带上最大 localId；否则只统计 localId<=? 的部分
+        """
+        conditions = [self.msg_filter] if self.msg_filter else []
+        if with_max:
+            columns = 'count(*),ifnull(sum(CreateTime),0),max(localId)'
+        else:
+            columns = 'count(*),ifnull(sum(CreateTime),0)'
+            conditions.append('localId<=?')
+        return f"select {columns} from MSG {'where ' + ' and '.join(conditions) if conditions else ''}"
+
+    def _where_new(self) -> str:
+        """
+        读取新消息的条件，参数是上次的最大 localId
+        """
+        return f"where {self.msg_filter + ' and ' if self.msg_filter else ''}localId>?"
+
+    @staticmethod
+    def connect_msg():
+        """
+        只读打开 MSG.db，和主程序的连接互不影响
+        @return: 数据库不存在时返回 None
+        """
+        msg_path = msg_module.db_path
+        if not os.path.exists(msg_path):
+            return None
+        return sqlite3.connect(f'file:{os.path.abspath(msg_path)}?mode=ro', uri=True, check_same_thread=False)
+
+    def batches(self, cursor, batch_size):
+        """
+        分批取出查询结果，停止更新时不再继续
+        """
+        for rows in iter(lambda: cursor.fetchmany(batch_size), []):
+            if self.stopping.is_set():
+                break
+            yield rows
+
+    def start_update(self):
+        """
+        在后台线程里更新，已经在更新时直接返回
+        """
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.update, name=self.name, daemon=True)
+        self.thread.start()
+
+    def update(self):
+        """
+        把 MSG.db 里还没有同步的消息加入缓存
+        """
+        if self.read_only or not self.build_lock.acquire(blocking=False):
+            return
+        try:
+            self._update()
+        except:
+            logger.error(traceback.format_exc())
+        finally:
+            self.build_lock.release()
+
+    def _update(self):
+        msg_conn = self.connect_msg()
+        if msg_conn is None:
+            return
+        try:
+            with self.lock:
+                self.prepare()
+                max_local_id, msg_num, time_sum = self.load_mark()
+            if max_local_id:
+                # 核对已经同步的部分是否还是原来的消息
+                row = msg_conn.execute(self._count_sql(), [max_local_id]).fetchone()
+                if (row[0], int(row[1])) != (msg_num, time_sum):
+                    print(f'聊天记录有变化，重新建立{self.title}')
+                    with self.lock:
+                        self.clear()
+                    max_local_id = msg_num = time_sum = 0
+            self.sync(msg_conn, max_local_id, msg_num, time_sum)
+            self.ready = not self.stopping.is_set()
+        finally:
+            msg_conn.close()
+
+    def check(self) -> bool:
+        """
+        只检查是否已经和 MSG.db 同步，不更新；只读时不会创建或者改动缓存
+        """
+        msg_conn = self.connect_msg()
+        if msg_conn is None:
+            return False
+        try:
+            with self.lock:
+                mark = self.load_mark()
+            if mark is None:
+                self.ready = False
+                return False
+            max_local_id, msg_num, time_sum = mark
+            row = msg_conn.execute(self._count_sql(with_max=True)).fetchone()
+            self.ready = (row[0], int(row[1]), row[2] or 0) == (msg_num, time_sum, max_local_id)
+            return self.ready
+        finally:
+            msg_conn.close()
+
+    def stop(self):
+        """
+        停止后台更新（重新解密前调用，释放对 MSG.db 的占用）
+        """
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.ready = False
+
+    def is_ready(self) -> bool:
+        """
+        已经同步时返回 True；否则在后台开始更新
+        """
+        if not self.ready and not self.read_only:
+            self.start_update()
+        return self.ready
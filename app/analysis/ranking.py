@@ -0,0 +1,124 @@
+"""
+聊天排行：每个联系人的消息条数和文字数
+
+从消息元数据（列快照，快照不可用时扫描一次 MSG.db）按联系人汇总一次，
+含群聊、不含群聊两种排行和前几名的文字数都从这份汇总里取，不再分别查询、对全部联系人排序：
+    top(n)：用堆选出前 n 名
+    page(cursor, size)：按 (条数降序, wxid) 翻页，cursor 记下上一页最后一名，下一页只选出排在它后面的 size 名
+"""
+import heapq
+from typing import List, Tuple
+
+import numpy as np
+
+from app.DataBase import msg_db
+from app.analysis.columnar import MessageColumns, load_columns
+
+EXCLUDED_TALKERS = {'filehelper', 'notifymessage'}  # 文件传输助手、系统通知，和 gh_ 开头的公众号一起不参与排行
+
+
+def is_ranked(wxid, contain_chatroom=False) -> bool:
+    if not wxid or wxid in EXCLUDED_TALKERS or wxid.startswith('gh_'):
+        return False
+    return contain_chatroom or not wxid.endswith('@chatroom')
+
+
+def encode_cursor(wxid, num) -> str:
+    return f'{num}:{wxid}'
+
+
+def decode_cursor(cursor) -> Tuple[int, str]:
+    """
+    @return: 排序键 (-条数, wxid)
+    @raise ValueError: 格式不对
+    """
+    num, wxid = cursor.split(':', 1)
+    return -int(num), wxid
+
+
+class ContactRanking:
+    def __init__(self, stats: dict, time_range=None):
+        """
+        @param stats: {wxid: (消息条数, 文本消息字数)}
+        @param time_range: 统计的时间范围，查询引用消息字数时使用
+        """
+        self.stats = stats
+        self.time_range = time_range
+
+    @classmethod
+    def from_columns(cls, columns: MessageColumns, time_range=None):
+        talkers = columns.talkers
+        counts = np.bincount(columns.talker, minlength=len(talkers))
+        text_len = np.bincount(columns.talker, weights=columns.text_len, minlength=len(talkers))
+        stats = {
+            talkers[code]: (num, int(length))
+            for code, (num, length) in enumerate(zip(counts.tolist(), text_len.tolist())) if num
+        }
+        return cls(stats, time_range)
+
+    def __len__(self):
+        return len(self.stats)
+
+    def items(self, contain_chatroom=False):
+        """
+        @return: 不排序的 (wxid, 条数) 生成器
+        """
+        for wxid, (num, _) in self.stats.items():
+            if is_ranked(wxid, contain_chatroom):
+                yield wxid, num
+
+    def contact_num(self, contain_chatroom=False) -> int:
+        return sum(1 for _ in self.items(contain_chatroom))
+
+    def total_num(self, contain_chatroom=False) -> int:
+        return sum(num for _, num in self.items(contain_chatroom))
+
+    def top(self, n=10, contain_chatroom=False, after=None) -> List[Tuple[str, int]]:
+        """
+        聊天最多的 n 个联系人，按条数降序，条数相同时按 wxid
+        @param n:
+        @param contain_chatroom: 是否包含群聊
+        @param after: 排序键 (-条数, wxid)，只选排在它后面的
+        @return: [(wxid, 条数), ...]
+        """
+        keys = ((-num, wxid) for wxid, num in self.items(contain_chatroom))
+        if after is not None:
+            keys = (key for key in keys if key > after)
+        return [(wxid, -key) for key, wxid in heapq.nsmallest(n, keys)]
+
+    def page(self, cursor=None, size=20, contain_chatroom=False) -> Tuple[List[Tuple[str, int]], str | None]:
+        """
+        分页读取完整排行
+        @param cursor: 上一页返回的 cursor，第一页不传
+        @param size: 每页人数
+        @param contain_chatroom:
+        @return: (这一页的 [(wxid, 条数), ...], 下一页的 cursor)，已经是最后一页时 cursor 为 None
+        @raise ValueError: cursor 格式不对
+        """
+        after = decode_cursor(cursor) if cursor else None
+        # 多取一个，判断后面还有没有
+        result = self.top(size + 1, contain_chatroom, after)
+        if len(result) <= size:
+            return result, None
+        result = result[:size]
+        return result, encode_cursor(*result[-1])
+
+    def text_lengths(self, wxids) -> dict:
+        """
+        文字数：文本消息的字数加上引用消息里的文字，和 msg_db.get_message_length 一样
+        @param wxids:
+        @return: {wxid: 字数}
+        """
+        wxids = list(wxids)
+        reply_lengths = msg_db.get_reply_text_lengths(wxids, self.time_range)
+        return {
+            wxid: self.stats.get(wxid, (0, 0))[1] + reply_lengths.get(wxid, 0)
+            for wxid in wxids
+        }
+
+
+def get_contact_ranking(time_range=None) -> ContactRanking:
+    """
+    @param time_range: 不传时统计全部消息
+    """
+    return ContactRanking.from_columns(load_columns(time_range=time_range), time_range)
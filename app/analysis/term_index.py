@@ -0,0 +1,207 @@
+"""
+聊天记录的词项索引
+
+把文本消息分词后保存在缓存数据库里：
+    postings: 词 -> (联系人, localId, 时间, 是否自己发送, 字数)，同一条消息里的词只记一次
+    talker_terms: 每个联系人每个词出现的总次数
+关键词统计、关键词对话示例直接查索引，不用 StrContent like '%关键词%' 扫描全表。
+索引没有建好时查询退回到 msg_db 的 like 查询。
+"""
+import os
+import random
+import sqlite3
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+from app.DataBase import msg_db
+from app.DataBase.connection import connect
+from app.DataBase.msg import convert_to_timestamp
+from app.analysis.msg_index import MsgIndexBase
+from app.analysis.tokenizer import dict_signature, init_jieba, tokenize_chunk, PARALLEL_THRESHOLD, CHUNK_SIZE
+from app.config import CACHE_DIR, TOKENIZE_WORKERS
+
+INDEX_VERSION = 1
+
+
+class TermIndex(MsgIndexBase):
+    name = 'term_index'
+    title = '词项索引'
+    msg_filter = 'Type=1'
+
+    def __init__(self, db_path=os.path.join(CACHE_DIR, 'term_index.db'), workers=TOKENIZE_WORKERS):
+        super().__init__()
+        self.db_path = db_path
+        self.workers = workers
+        self.DB = None
+        self.cursor = None
+
+    def init_database(self):
+        if self.DB is not None:
+            return
+        if self.read_only:
+            # 只打开主程序建好的索引，不存在时不创建
+            if os.path.exists(self.db_path):
+                self.DB = connect(self.db_path, read_only=True)
+                self.cursor = self.DB.cursor()
+            return
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        self.DB = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.cursor = self.DB.cursor()
+        self.cursor.executescript('''
+            create table if not exists meta(key text primary key, value text);
+            create table if not exists postings(
+                word text, talker text, local_id integer, create_time integer, is_send integer, length integer,
+                primary key (word, talker, local_id)
+            ) without rowid;
+            create table if not exists talker_terms(
+                talker text, word text, count integer,
+                primary key (talker, word)
+            ) without rowid;
+        ''')
+        signature = f'{INDEX_VERSION}:{dict_signature()}'
+        if self.get_meta('signature') != signature:
+            self.clear()
+            self.set_meta('signature', signature)
+        self.DB.commit()
+
+    def get_meta(self, key, default=None):
+        self.cursor.execute('select value from meta where key=?', [key])
+        row = self.cursor.fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        self.cursor.execute('insert or replace into meta(key, value) values (?, ?)', [key, str(value)])
+
+    def prepare(self):
+        self.init_database()
+
+    def load_mark(self):
+        self.init_database()
+        if self.DB is None or self.get_meta('signature') != f'{INDEX_VERSION}:{dict_signature()}':
+            return None
+        return (int(self.get_meta('max_local_id', 0)), int(self.get_meta('msg_num', 0)),
+                int(self.get_meta('time_sum', 0)))
+
+    def clear(self):
+        self.cursor.execute('delete from postings')
+        self.cursor.execute('delete from talker_terms')
+        for key in ('max_local_id', 'msg_num', 'time_sum'):
+            self.set_meta(key, 0)
+        self.DB.commit()
+
+    def sync(self, msg_conn, max_local_id, msg_num, time_sum):
+        cursor = msg_conn.execute(
+            f'select localId,StrTalker,CreateTime,IsSender,StrContent from MSG {self._where_new()} order by localId',
+            [max_local_id]
+        )
+        total = msg_conn.execute(f'select count(*) from MSG {self._where_new()}', [max_local_id]).fetchone()[0]
+        chunks = self.batches(cursor, CHUNK_SIZE)
+        workers = min(self.workers, os.cpu_count() or 1)
+        if workers > 1 and total > PARALLEL_THRESHOLD:
+            print(f'建立词项索引：{total} 条消息，{workers} 个进程')
+            with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn'),
+                                     initializer=init_jieba) as executor:
+                futures = deque()
+                for chunk in chunks:
+                    futures.append(executor.submit(tokenize_chunk, chunk))
+                    if len(futures) >= workers * 2:
+                        msg_num, time_sum = self.add(futures.popleft().result(), msg_num, time_sum)
+                while futures:
+                    msg_num, time_sum = self.add(futures.popleft().result(), msg_num, time_sum)
+        else:
+            for chunk in chunks:
+                msg_num, time_sum = self.add(tokenize_chunk(chunk), msg_num, time_sum)
+
+    def add(self, rows, msg_num, time_sum):
+        """
+        写入一批分词结果（按 localId 顺序），每批提交一次，中断后下次从断点继续
+        """
+        if not rows:
+            return msg_num, time_sum
+        postings = []
+        terms = Counter()
+        for local_id, talker, create_time, is_send, length, words in rows:
+            for word in set(words):
+                postings.append((word, talker, local_id, create_time, is_send, length))
+            terms.update((talker, word) for word in words)
+            msg_num += 1
+            time_sum += create_time
+        with self.lock:
+            try:
+                self.cursor.executemany('insert or ignore into postings values (?,?,?,?,?,?)', postings)
+                self.cursor.executemany(
+                    'insert into talker_terms(talker,word,count) values (?,?,?) '
+                    'on conflict(talker,word) do update set count=count+excluded.count',
+                    [(talker, word, count) for (talker, word), count in terms.items()]
+                )
+                self.set_meta('max_local_id', rows[-1][0])
+                self.set_meta('msg_num', msg_num)
+                self.set_meta('time_sum', time_sum)
+                self.DB.commit()
+            except:
+                self.DB.rollback()
+                raise
+        return msg_num, time_sum
+
+    def term_count(self, wxid, word, time_range=None) -> int:
+        """
+        包含关键词的消息条数
+        @return: 索引没有建好时返回 -1
+        """
+        if not self.is_ready():
+            return -1
+        sql = 'select count(*) from postings where word=? and talker=?'
+        params = [word, wxid]
+        if time_range:
+            start_time, end_time = convert_to_timestamp(time_range)
+            sql += ' and create_time>? and create_time<?'
+            params.extend([start_time, end_time])
+        with self.lock:
+            self.cursor.execute(sql, params)
+            return self.cursor.fetchone()[0]
+
+    def top_terms(self, wxid, n=100) -> list:
+        """
+        联系人全部聊天记录里出现次数最多的词
+        @return: [(词, 次数)]，索引没有建好时返回 None
+        """
+        if not self.is_ready():
+            return None
+        with self.lock:
+            self.cursor.execute('select word,count from talker_terms where talker=? order by count desc limit ?',
+                                [wxid, n])
+            return self.cursor.fetchall()
+
+    def get_dialogs(self, wxid, keyword, num=5, max_len=10, time_range=None):
+        """
+        包含关键词的对话示例，和 msg_db.get_messages_by_keyword 的返回值一样
+        """
+        if not keyword or not self.is_ready():
+            return msg_db.get_messages_by_keyword(wxid, keyword, num=num, max_len=max_len, time_range=time_range)
+        sql = 'select local_id from postings where word=? and talker=? and length<?'
+        params = [keyword, wxid, max_len]
+        if time_range:
+            start_time, end_time = convert_to_timestamp(time_range)
+            sql += ' and create_time>? and create_time<?'
+            params.extend([start_time, end_time])
+        with self.lock:
+            self.cursor.execute(sql, params)
+            local_ids = [row[0] for row in self.cursor.fetchall()]
+        if not local_ids:
+            # 关键词可能不是完整的词
+            return msg_db.get_messages_by_keyword(wxid, keyword, num=num, max_len=max_len, time_range=time_range)
+        if len(local_ids) > num:
+            local_ids = random.sample(local_ids, num)
+        return msg_db.get_dialogs_by_local_ids(wxid, local_ids, keyword)
+
+    def close(self):
+        with self.lock:
+            if self.DB is not None:
+                self.DB.close()
+                self.DB = None
+                self.cursor = None
+            self.ready = False
+
+
+term_index = TermIndex()
@@ -0,0 +1,367 @@
+"""
+聊天记录分词服务
+
+jieba 词典和停用词只加载一次；分词结果按 (联系人, 日期, 是否自己发送) 统计词频后保存在缓存数据库里，
+任意时间段的词云只需要把对应日期的词频加起来，不用重新对多年的聊天记录分词；
+时间段首尾两天只有一部分在时间段内，这部分现场分词，不写入缓存。
+某一天的消息有变化（条数、localId 范围、字数不一致）时只重新统计这一天；
+需要分词的消息较多时按批分给多个进程。
+"""
+import hashlib
+import os
+import sqlite3
+import sys
+import threading
+import traceback
+from collections import Counter, deque
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import jieba
+
+from app.DataBase import msg_db
+from app.DataBase.msg import convert_to_timestamp
+from app.config import CACHE_DIR, TOKENIZE_WORKERS
+from app.log import logger
+
+TOKENIZER_VERSION = 1
+USER_DICT_PATH = './app/data/new_words.txt'
+STOPWORDS_PATH = './app/data/stopwords.txt'
+PARALLEL_THRESHOLD = 20000  # 需要分词的消息超过这个数量才使用多进程
+CHUNK_SIZE = 5000  # 每个任务的消息条数
+
+_init_lock = threading.Lock()
+_initialized = False
+_stopwords = None
+
+
+def resource_path(path) -> str:
+    """
+    打包后资源文件在 _MEIPASS 目录里
+    """
+    if os.path.exists(path):
+        return path
+    resource_dir = getattr(sys, '_MEIPASS', os.path.abspath(os.path.dirname(__file__)))
+    return os.path.join(resource_dir, path)
+
+
+def read_lines(path) -> list:
+    path = resource_path(path)
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read().splitlines()
+
+
+def init_jieba():
+    """
+    初始化 jieba 词典、加载自定义词典和停用词，只执行一次
+    """
+    global _initialized, _stopwords
+    if _initialized:
+        return
+    with _init_lock:
+        if _initialized:
+            return
+        jieba.initialize()
+        user_dict = resource_path(USER_DICT_PATH)
+        if os.path.exists(user_dict):
+            jieba.load_userdict(user_dict)
+        _stopwords = frozenset(read_lines(STOPWORDS_PATH) + read_lines('./app/resources/data/stopwords.txt'))
+        _initialized = True
+
+
+def get_stopwords() -> frozenset:
+    init_jieba()
+    return _stopwords
+
+
+def tokenize(text) -> list:
+    """
+    分词并去掉停用词和单字
+    @param text:
+    @return: 词列表
+    """
+    init_jieba()
+    stopwords = _stopwords
+    return [word for word in jieba.cut(text) if len(word) > 1 and word not in stopwords]
+
+
+def count_words(texts) -> Counter:
+    """
+    @param texts: 文本列表，每条消息单独分词
+    @return: 词频
+    """
+    init_jieba()
+    stopwords = _stopwords
+    cut = jieba.cut
+    counter = Counter()
+    for text in texts:
+        if text:
+            counter.update(word for word in cut(text) if len(word) > 1 and word not in stopwords)
+    return counter
+
+
+def count_chunk(chunk) -> list:
+    """
+    子进程里执行：统计一批消息的词频
+    @param chunk: [(key, 文本), ...]，同一个 key 的消息是连续的
+    @return: [(key, {词: 次数}), ...]
+    """
+    result = []
+    key = None
+    texts = []
+    for item_key, text in chunk:
+        if item_key != key:
+            if texts:
+                result.append((key, dict(count_words(texts))))
+            key = item_key
+            texts = []
+        texts.append(text)
+    if texts:
+        result.append((key, dict(count_words(texts))))
+    return result
+
+
+def tokenize_chunk(rows) -> list:
+    """
+    子进程里执行：对一批消息分词
+    @param rows: [(localId, StrTalker, CreateTime, IsSender, StrContent), ...]
+    @return: [(localId, StrTalker, CreateTime, IsSender, 字数, 词列表), ...]
+    """
+    return [(*row[:4], len(row[4] or ''), tokenize(row[4] or '')) for row in rows]
+
+
+def dict_signature() -> str:
+    """
+    词典和停用词变化后缓存的词频全部作废
+    """
+    md5 = hashlib.md5(str(TOKENIZER_VERSION).encode())
+    for path in (USER_DICT_PATH, STOPWORDS_PATH, './app/resources/data/stopwords.txt'):
+        md5.update('\n'.join(read_lines(path)).encode('utf-8'))
+    return md5.hexdigest()
+
+
+def local_day(timestamp) -> str:
+    return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d')
+
+
+def boundary_days(time_range) -> tuple:
+    """
+    @return: 时间段首尾两天的日期，没有时间段时是 (None, None)
+    """
+    if not time_range:
+        return None, None
+    start_time, end_time = convert_to_timestamp(time_range)
+    return local_day(start_time), local_day(end_time)
+
+
+def is_full_day(day, first_day, last_day) -> bool:
+    """
+    这一天的消息是否全部在时间段内（可以写入缓存）
+    """
+    return first_day is None or first_day < day < last_day
+
+
+def boundary_ranges(time_range) -> list:
+    """
+    时间段首尾两天落在时间段内的部分
+    @return: [(开始时间戳, 结束时间戳), ...]，和 SQL 里一样不含两端
+    """
+    if not time_range:
+        return []
+    start_time, end_time = convert_to_timestamp(time_range)
+    first_day, last_day = local_day(start_time), local_day(end_time)
+    if first_day == last_day:
+        return [(start_time, end_time)]
+    first_end = datetime.strptime(first_day, '%Y-%m-%d') + timedelta(days=1)
+    last_start = datetime.strptime(last_day, '%Y-%m-%d')
+    # 第二天零点整的消息属于中间的日期；最后一天零点整的消息属于最后一天
+    return [(start_time, int(first_end.timestamp())), (int(last_start.timestamp()) - 1, end_time)]
+
+
+class WordCountCache:
+    def __init__(self, db_path=os.path.join(CACHE_DIR, 'word_counts.db'), workers=TOKENIZE_WORKERS):
+        self.db_path = db_path
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.DB = None
+        self.cursor = None
+
+    def init_database(self):
+        if self.DB is not None:
+            return
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        self.DB = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.cursor = self.DB.cursor()
+        self.cursor.executescript('''
+            create table if not exists meta(key text primary key, value text);
+            create table if not exists day_stats(
+                talker text, day text, is_send integer,
+                msg_num integer, min_id integer, max_id integer, text_len integer,
+                primary key (talker, day, is_send)
+            ) without rowid;
+            create table if not exists day_words(
+                talker text, day text, is_send integer, word text, count integer,
+                primary key (talker, day, is_send, word)
+            ) without rowid;
+        ''')
+        signature = dict_signature()
+        self.cursor.execute("select value from meta where key='signature'")
+        row = self.cursor.fetchone()
+        if not row or row[0] != signature:
+            self.cursor.execute('delete from day_stats')
+            self.cursor.execute('delete from day_words')
+            self.cursor.execute("insert or replace into meta(key, value) values ('signature', ?)", [signature])
+        self.DB.commit()
+
+    def update(self, wxid=None, time_range=None, is_send=None) -> list:
+        """
+        检查需要的日期的词频缓存，有变化的重新分词
+        时间段首尾两天只有一部分消息在时间段内，不写入缓存，由 get_word_counts 现场分词
+        @return: msg_db.get_text_days 的结果（包括首尾两天）
+        """
+        stats = msg_db.get_text_days(wxid, time_range, is_send)
+        if not stats:
+            return []
+        first_day, last_day = boundary_days(time_range)
+        full_stats = [row for row in stats if is_full_day(row[1], first_day, last_day)]
+        conditions = []
+        params = []
+        if wxid:
+            conditions.append('talker=?')
+            params.append(wxid)
+        if is_send is not None:
+            conditions.append('is_send=?')
+            params.append(is_send)
+        with self.lock:
+            self.init_database()
+            self.cursor.execute(
+                f'select talker,day,is_send,msg_num,min_id,max_id,text_len from day_stats '
+                f'{"where " + " and ".join(conditions) if conditions else ""}',
+                params
+            )
+            cached = {row[:3]: row[3:] for row in self.cursor.fetchall()}
+        stale = {}
+        for row in full_stats:
+            if cached.get(row[:3]) != tuple(row[3:]):
+                stale[row[:3]] = row
+        # 时间段内已经没有消息的日期（消息被删除）
+        keys = {row[:3] for row in full_stats}
+        removed = [key for key in cached if is_full_day(key[1], first_day, last_day) and key not in keys]
+        if stale or removed:
+            self.rebuild(wxid, time_range, is_send, stale, removed)
+        return stats
+
+    def iter_chunks(self, wxid, time_range, is_send, stale):
+        chunk = []
+        for talker, day, is_send, content in msg_db.get_text_iter(wxid, time_range, is_send=is_send):
+            key = (talker, day, is_send)
+            if key in stale:
+                chunk.append((key, content))
+                if len(chunk) >= CHUNK_SIZE:
+                    chunk.sort(key=lambda item: item[0])
+                    yield chunk
+                    chunk = []
+        if chunk:
+            chunk.sort(key=lambda item: item[0])
+            yield chunk
+
+    def rebuild(self, wxid, time_range, is_send, stale, removed):
+        counters = {key: Counter() for key in stale}
+        chunks = self.iter_chunks(wxid, time_range, is_send, stale)
+        total = sum(row[3] for row in stale.values())
+        workers = min(self.workers, os.cpu_count() or 1)
+        if workers > 1 and total > PARALLEL_THRESHOLD:
+            print(f'分词：{total} 条消息，{workers} 个进程')
+            with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn'),
+                                     initializer=init_jieba) as executor:
+                # 最多同时提交 workers * 2 个任务，避免把全部文本读进内存
+                futures = deque()
+                for chunk in chunks:
+                    futures.append(executor.submit(count_chunk, chunk))
+                    if len(futures) >= workers * 2:
+                        self.merge(counters, futures.popleft().result())
+                while futures:
+                    self.merge(counters, futures.popleft().result())
+        else:
+            for chunk in chunks:
+                self.merge(counters, count_chunk(chunk))
+        with self.lock:
+            try:
+                for key in removed:
+                    self.cursor.execute('delete from day_stats where talker=? and day=? and is_send=?', key)
+                    self.cursor.execute('delete from day_words where talker=? and day=? and is_send=?', key)
+                for key, row in stale.items():
+                    self.cursor.execute('delete from day_words where talker=? and day=? and is_send=?', key)
+                    self.cursor.executemany(
+                        'insert into day_words(talker,day,is_send,word,count) values (?,?,?,?,?)',
+                        [(*key, word, count) for word, count in counters[key].items()]
+                    )
+                    self.cursor.execute(
+                        'insert or replace into day_stats(talker,day,is_send,msg_num,min_id,max_id,text_len) values (?,?,?,?,?,?,?)',
+                        row
+                    )
+                self.DB.commit()
+            except:
+                logger.error(traceback.format_exc())
+                self.DB.rollback()
+
+    @staticmethod
+    def merge(counters, result):
+        for key, counts in result:
+            counters[key].update(counts)
+
+    def get_word_counts(self, wxid=None, time_range=None, is_send=None):
+        """
+        时间段内的词频
+        @param wxid: 联系人，不传时统计全部联系人
+        @param time_range:
+        @param is_send: 1 只统计自己发的，0 只统计对方发的，默认全部
+        @return: (词频 Counter, 文本总字数)
+        """
+        stats = self.update(wxid, time_range, is_send)
+        if not stats:
+            return Counter(), 0
+        text_len = sum(row[6] or 0 for row in stats)
+        first_day, last_day = boundary_days(time_range)
+        conditions = []
+        params = []
+        if wxid:
+            conditions.append('talker=?')
+            params.append(wxid)
+        if is_send is not None:
+            conditions.append('is_send=?')
+            params.append(is_send)
+        if time_range:
+            # 中间的日期整天都在时间段内，直接按日期范围查
+            conditions.append('day>? and day<?')
+            params.extend([first_day, last_day])
+        sql = f'''
+            select word,sum(count) from day_words
+            {'where ' + ' and '.join(conditions) if conditions else ''}
+            group by word
+        '''
+        with self.lock:
+            self.init_database()
+            self.cursor.execute(sql, params)
+            counter = Counter(dict(self.cursor.fetchall()))
+        # 首尾两天只读取时间段内的部分现场分词
+        for part in boundary_ranges(time_range):
+            counter.update(count_words(content for *_, content in msg_db.get_text_iter(wxid, part, is_send=is_send)))
+        return counter, text_len
+
+    def close(self):
+        with self.lock:
+            if self.DB is not None:
+                self.DB.close()
+                self.DB = None
+                self.cursor = None
+
+
+word_count_cache = WordCountCache()
+
+
+def get_word_counts(wxid=None, time_range=None, is_send=None):
+    return word_count_cache.get_word_counts(wxid, time_range, is_send)
@@ -27,9 +27,27 @@ about = f'''
 INFO_FILE_PATH = './app/data/info.json'  # 个人信息文件
 DB_DIR = './app/Database/Msg'
 OUTPUT_DIR = './data/'  # 输出文件夹
+CACHE_DIR = './app/data/cache'  # 各类索引、缓存文件
 os.makedirs('./app/data', exist_ok=True)
 os.makedirs(DB_DIR, exist_ok=True)
 os.makedirs(OUTPUT_DIR, exist_ok=True)
+os.makedirs(CACHE_DIR, exist_ok=True)
 # 全局参数
 SEND_LOG_FLAG = True  # 是否发送错误日志
+VOICE_CODEC = 'mp3'  # 语音导出格式：mp3 / wav
+HTML_CHUNK_MODE = 'auto'  # HTML 分卷导出：'' 不分卷 / 'count' 按条数 / 'month' 按月 / 'auto' 消息较多时按条数
+HTML_CHUNK_SIZE = 2000  # 按条数分卷时每卷的消息数
+DOCX_VOLUME_SIZE = 100 * 1024 * 1024  # DOCX 超过这个大小（估算值，字节）就另起一卷
+COMPRESS_CONTENT_CACHE_SIZE = 4096  # CompressContent 解压结果缓存的消息条数
+OFFLINE_MODE = False  # 离线模式：导出时不访问网络，音乐、网站名称等只使用本地缓存
+NETWORK_TIMEOUT = 10  # 网络请求超时时间（秒）
+NETWORK_WORKERS = 8  # 并发网络请求数
+JSON_EXPORT_MODE = 'json'  # 训练数据导出格式：'json' 整个列表 / 'jsonl' 每行一段对话，边读边写
+JSON_SESSION_INTERVAL = 60  # 相邻消息间隔超过这个秒数就切分成新的一段对话
+JSON_DEV_RATIO = 0.2  # 划入验证集（_dev）的对话比例
+JSON_EXPORT_WORKERS = 4  # 批量导出 JSON 时按联系人分给多少个进程，1 表示不使用多进程
+TOKENIZE_WORKERS = 4  # 词云分词的进程数，1 表示不使用多进程
+REPORT_TIME_RANGE = ['2023-01-01 00:00:00', '2024-02-10 00:00:00']  # 年度报告的时间范围
+REPORT_PRECOMPUTE_CONTACTS = 6  # 解密后在后台预先生成报告的联系人数（聊天最多的几个）
+CHART_OPTION_CACHE_SIZE = 256  # 内存里缓存的图表配置（ECharts option JSON）个数
 SERVER_API_URL = 'http://api.lc044.love'  # api接口
\ No newline at end of file
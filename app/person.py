@@ -87,6 +87,8 @@ class Contact(Person):
         # Alias,Type,Remark,NickName,PYInitial,RemarkPYInitial,ContactHeadImgUrl.smallHeadImgUrl,ContactHeadImgUrl,bigHeadImgUrl
         self.alias = contact_info.get('Alias')
         self.nickName = contact_info.get('NickName')
+        self.py_initial = contact_info.get('PYInitial')  # 昵称的拼音首字母
+        self.remark_py_initial = contact_info.get('RemarkPYInitial')  # 备注的拼音首字母
         if not self.remark:
             self.remark = self.nickName
         self.remark = re.sub(r'[\\/:*?"<>|\s\.]', '_', self.remark)
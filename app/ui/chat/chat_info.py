@@ -182,6 +182,7 @@ class ShowChatThread(QThread):
         messages = msg_db.get_message_by_num(self.wxid, self.last_message_id)
         if messages:
             self.last_message_id = messages[-1][0]
+            hard_link_db.resolve_messages(messages)
         for message in messages:
             self.showSingal.emit(message)
         self.msg_id += 1
@@ -53,7 +53,7 @@ class ChatWindow(QWidget, Ui_Form):
         self.setupUi(self)
         self.ok_flag = False
         self.setStyleSheet(Stylesheet)
-        self.contacts = [[], []]
+        self.search_index = search.ContactSearchIndex()
         self.init_ui()
         self.show_chats()
         self.visited = set()
@@ -99,10 +99,12 @@ class ChatWindow(QWidget, Ui_Form):
         if not content:
             return
         index = self.search_contact_index(content)
+        if index < 0:
+            return
         self.select_contact_by_index(index)
 
     def search_contact_index(self, content: str) -> int:
-        return search.search_by_content(content, self.contacts)
+        return self.search_index.best(content)
 
     def select_contact_by_index(self, index):
         self.stackedWidget.setCurrentIndex(index)
@@ -110,8 +112,7 @@ class ChatWindow(QWidget, Ui_Form):
 
     def show_chat(self, contact):
         # return
-        self.contacts[0].append(contact.remark)
-        self.contacts[1].append(contact.nickName)
+        self.search_index.add_contact(contact)
         contact_item = ContactQListWidgetItem(contact.remark, contact.smallHeadImgUrl, contact.smallHeadImgBLOG)
         self.listWidget.addItem(contact_item)
         self.listWidget.setItemWidget(contact_item, contact_item.widget)
@@ -163,6 +164,8 @@ class ShowContactThread(QThread):
                 'Type': contact_info_list[2],
                 'Remark': contact_info_list[3],
                 'NickName': contact_info_list[4],
+                'PYInitial': contact_info_list[5],
+                'RemarkPYInitial': contact_info_list[6],
                 'smallHeadImgUrl': contact_info_list[7]
             }
             contact = Contact(contact_info)
@@ -63,7 +63,7 @@ class ContactWindow(QWidget, Ui_Form):
         self.ok_flag = False
         self.setStyleSheet(Stylesheet)
         self.init_ui()
-        self.contacts = [[], []]
+        self.search_index = search.ContactSearchIndex()
         self.contacts_list:List[Contact] = []
         self.show_contacts()
         self.contact_info_window = None
@@ -109,7 +109,9 @@ class ContactWindow(QWidget, Ui_Form):
         """
         keyword = self.lineEdit.text()
         if keyword:
-            index = search.search_by_content(keyword, self.contacts)
+            index = self.search_index.best(keyword)
+            if index < 0:
+                return
             self.listWidget.setCurrentRow(index)
             self.stackedWidget.setCurrentIndex(index)
 
@@ -120,8 +122,7 @@ class ContactWindow(QWidget, Ui_Form):
         @return:
         """
         # return
-        self.contacts[0].append(contact.remark)
-        self.contacts[1].append(contact.nickName)
+        self.search_index.add_contact(contact)
         contact_item = ContactQListWidgetItem(contact.remark, contact.smallHeadImgUrl, contact.smallHeadImgBLOG)
         self.listWidget.addItem(contact_item)
         self.listWidget.setItemWidget(contact_item, contact_item.widget)
@@ -171,6 +172,8 @@ class ShowContactThread(QThread):
                 'Type': contact_info_list[2],
                 'Remark': contact_info_list[3],
                 'NickName': contact_info_list[4],
+                'PYInitial': contact_info_list[5],
+                'RemarkPYInitial': contact_info_list[6],
                 'smallHeadImgUrl': contact_info_list[7],
                 'detail': detail,
                 'label_name': contact_info_list[10],
@@ -2,6 +2,7 @@ from PyQt5.QtCore import Qt, pyqtSignal, QThread, QUrl
 from PyQt5.QtGui import QFont, QDesktopServices
 from PyQt5.QtWidgets import QWidget, QMessageBox
 
+from app.config import REPORT_TIME_RANGE
 from app.ui.Icon import Icon
 
 from .home_windowUi import Ui_Dialog
@@ -57,8 +58,7 @@ class HomeWindow(QWidget, Ui_Dialog):
                                 "个人信息修改成功")
 
     def report(self):
-        time_range = ['2023-01-01 00:00:00', '2024-02-10 00:00:00']
-        self.report_thread = ReportThread(Me(), time_range)
+        self.report_thread = ReportThread(Me(), REPORT_TIME_RANGE)
         self.report_thread.start()
         QDesktopServices.openUrl(QUrl(f"http://127.0.0.1:21314/"))
 
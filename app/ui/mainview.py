@@ -29,6 +29,7 @@ from app.ui.contact import ContactWindow
 from app.ui.tool.tool_window import ToolWindow
 from app.ui.home.home_window import HomeWindow
 from .menu.export import ExportDialog
+from app.util.exporter import exporter_parquet
 from app.util.exporter.output import Output
 from ..components.QCursorGif import QCursorGif
 from ..config import INFO_FILE_PATH, DB_DIR, SERVER_API_URL, version
@@ -302,6 +303,8 @@ class MainWinController(QMainWindow, mainwindow.Ui_MainWindow, QCursorGif):
         self.menu_output.setIcon(Icon.Output)
         self.action_output_CSV.setIcon(Icon.ToCSV)
         self.action_output_CSV.triggered.connect(self.output)
+        self.action_output_parquet.setIcon(Icon.Output)
+        self.action_output_parquet.triggered.connect(self.output)
         self.action_output_contacts.setIcon(Icon.Output)
         self.action_output_contacts.triggered.connect(self.output)
         self.action_batch_export.setIcon(Icon.Output)
@@ -410,6 +413,17 @@ class MainWinController(QMainWindow, mainwindow.Ui_MainWindow, QCursorGif):
             self.outputThread.okSignal.connect(
                 lambda x: self.message('聊天记录导出成功'))
             self.outputThread.start()
+        elif self.sender() == self.action_output_parquet:
+            if exporter_parquet.pa is None:
+                QMessageBox.warning(self, "提醒", '导出 Parquet/Arrow 需要安装 pyarrow\npip install pyarrow')
+                return
+            self.outputThread = Output(None, type_=Output.PARQUET_ALL)
+            self.outputThread.startSignal.connect(lambda x: self.startBusy())
+            self.outputThread.okSignal.connect(
+                lambda x: self.message('聊天记录导出成功'))
+            self.outputThread.errorSignal.connect(
+                lambda x: self.message(f'聊天记录导出失败：{x}'))
+            self.outputThread.start()
         elif self.sender() == self.action_output_contacts:
             self.outputThread = Output(None, type_=Output.CONTACT_CSV)
             self.outputThread.startSignal.connect(lambda x: self.startBusy())
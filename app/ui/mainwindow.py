@@ -124,6 +124,8 @@ class Ui_MainWindow(object):
         self.action_help_contact.setObjectName("action_help_contact")
         self.action_output_CSV = QtWidgets.QAction(MainWindow)
         self.action_output_CSV.setObjectName("action_output_CSV")
+        self.action_output_parquet = QtWidgets.QAction(MainWindow)
+        self.action_output_parquet.setObjectName("action_output_parquet")
         self.action_output_contacts = QtWidgets.QAction(MainWindow)
         self.action_output_contacts.setObjectName("action_output_contacts")
         self.action_batch_export = QtWidgets.QAction(MainWindow)
@@ -137,6 +139,7 @@ class Ui_MainWindow(object):
         self.menu_F.addAction(self.action_3)
         self.menu_F.addAction(self.action_4)
         self.menu_output.addAction(self.action_output_CSV)
+        self.menu_output.addAction(self.action_output_parquet)
         self.menu_data.addAction(self.menu_output.menuAction())
         self.menu_data.addAction(self.action_output_contacts)
         self.menu_data.addAction(self.action_batch_export)
@@ -185,6 +188,7 @@ class Ui_MainWindow(object):
         self.action_help_chat.setText(_translate("MainWindow", "聊天相关"))
         self.action_help_contact.setText(_translate("MainWindow", "好友相关"))
         self.action_output_CSV.setText(_translate("MainWindow", "CSV"))
+        self.action_output_parquet.setText(_translate("MainWindow", "Parquet"))
         self.action_output_contacts.setText(_translate("MainWindow", "导出联系人"))
         self.action_batch_export.setText(_translate("MainWindow", "批量导出"))
         self.action_update.setText(_translate("MainWindow", "检查更新"))
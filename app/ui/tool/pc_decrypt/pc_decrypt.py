@@ -10,6 +10,9 @@ from PyQt5.QtGui import QDesktopServices
 from PyQt5.QtWidgets import QWidget, QMessageBox, QFileDialog
 
 from app.DataBase import msg_db, misc_db, close_db
+from app.analysis.columnar import column_snapshot
+from app.analysis.full_text import full_text_index
+from app.analysis.term_index import term_index
 from app.DataBase.merge import merge_databases, merge_MediaMSG_databases
 from app.components.QCursorGif import QCursorGif
 from app.config import INFO_FILE_PATH, DB_DIR, SERVER_API_URL
@@ -225,6 +228,9 @@ class DecryptThread(QThread):
 
     def run(self):
         close_db()
+        term_index.stop()
+        full_text_index.stop()
+        column_snapshot.stop()
         output_dir = DB_DIR
         os.makedirs(output_dir, exist_ok=True)
         tasks = []
@@ -275,6 +281,13 @@ class DecryptThread(QThread):
 
         # 合并数据库
         merge_MediaMSG_databases(source_databases, target_database)
+        # 后台建立（或追加）关键词索引、全文索引和消息快照
+        term_index.start_update()
+        full_text_index.start_update()
+        column_snapshot.start_update()
+        # 后台预先生成年度报告
+        from app.web_ui import web
+        web.start_precompute()
         self.okSignal.emit('ok')
         # self.signal.emit('100')
 
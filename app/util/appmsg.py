@@ -0,0 +1,215 @@
+"""
+消息 XML 的统一解析
+
+回复、音乐、卡片、转账、文件等 appmsg 消息（CompressContent 解压后的内容），
+以及图片、视频、语音、表情包消息（StrContent）都是 <msg> 开头的 XML。
+这里每条消息只解析一次，得到 AppMsg，各个字段在第一次访问时按固定路径查找并缓存，
+用不到的字段不会去找；最近解析过的 XML 直接复用结果（同一条消息常被多个函数解析）。
+用标准库（C 实现）解析，不规范的 XML 先截取 <msg>...</msg> 并转义 & 后再试一次，
+还是失败时才交给 lxml 的容错模式（装了 lxml 时）。容错模式会把没转义的 & 和它后面的文字丢掉，不能放在前面。
+"""
+import re
+import xml.etree.ElementTree as ET
+from functools import lru_cache
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+if lxml_etree is not None:
+    _LXML_PARSER = lxml_etree.XMLParser(recover=True, resolve_entities=False, no_network=True, huge_tree=True)
+else:
+    _LXML_PARSER = None
+
+_MSG_PATTERN = re.compile(r'<msg>.*</msg>', re.S)
+PARSE_CACHE_SIZE = 1024  # 缓存最近解析过的 XML 条数
+
+
+def _to_int(text):
+    try:
+        return int(text)
+    except (TypeError, ValueError):
+        return None
+
+
+class _Node:
+    """
+    按路径（从 <msg> 开始的子节点 tag）查找的节点，中间节点在同一条消息里共用
+    """
+
+    def __init__(self, path, deep=False):
+        """
+        @param path: 子节点 tag 组成的路径
+        @param deep: 按路径找不到时，再在整棵树里找最后一级的 tag（对应原来的 .//tag）
+        """
+        self.path = path
+        self.deep = deep
+
+    def find(self, msg):
+        nodes = msg.nodes
+        node = nodes.get(self.path, False)
+        if node is not False:
+            return node
+        parent = msg.root
+        for i in range(1, len(self.path) + 1):
+            sub_path = self.path[:i]
+            node = nodes.get(sub_path, False)
+            if node is False:
+                node = parent.find(sub_path[-1]) if parent is not None else None
+                nodes[sub_path] = node
+            parent = node
+        if node is None and self.deep:
+            node = msg.root.find('.//' + self.path[-1])
+            nodes[self.path] = node
+        return node
+
+
+class _Text(_Node):
+    """
+    节点的文本：节点不存在为 None，没有文本为空字符串
+    """
+
+    def __init__(self, path, convert=None):
+        super().__init__(path)
+        self.convert = convert
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, msg, owner=None):
+        if msg is None:
+            return self
+        node = self.find(msg)
+        if node is None:
+            value = None
+        else:
+            value = node.text or ''
+            if self.convert is not None:
+                value = self.convert(value)
+        msg.__dict__[self.name] = value
+        return value
+
+
+class _Attr(_Node):
+    """
+    节点的属性：节点或属性不存在为 None；attr 为 None 时返回全部属性（dict）
+    """
+
+    def __init__(self, path, attr=None, deep=False):
+        super().__init__(path, deep)
+        self.attr = attr
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, msg, owner=None):
+        if msg is None:
+            return self
+        node = self.find(msg)
+        if node is None:
+            value = None
+        elif self.attr is None:
+            value = dict(node.attrib)
+        else:
+            value = node.get(self.attr)
+        msg.__dict__[self.name] = value
+        return value
+
+
+_APPINFO = _Node(('appinfo',))
+
+
+class AppMsg:
+    """
+    一条消息 XML 的解析结果
+    字段对应的节点不存在时为 None，节点存在但没有文本时为空字符串
+    """
+    # <appmsg>
+    type: int | None = _Text(('appmsg', 'type'), _to_int)
+    title: str | None = _Text(('appmsg', 'title'))
+    des: str | None = _Text(('appmsg', 'des'))
+    url: str | None = _Text(('appmsg', 'url'))
+    dataurl: str | None = _Text(('appmsg', 'dataurl'))
+    source_display_name: str | None = _Text(('appmsg', 'sourcedisplayname'))
+    source_username: str | None = _Text(('appmsg', 'sourceusername'))
+    # <appmsg><refermsg> 引用消息
+    refer_type: int | None = _Text(('appmsg', 'refermsg', 'type'), _to_int)
+    refer_content: str | None = _Text(('appmsg', 'refermsg', 'content'))
+    refer_displayname: str | None = _Text(('appmsg', 'refermsg', 'displayname'))
+    # <appmsg><wcpayinfo> 转账
+    paysubtype: int | None = _Text(('appmsg', 'wcpayinfo', 'paysubtype'), _to_int)
+    feedesc: str | None = _Text(('appmsg', 'wcpayinfo', 'feedesc'))
+    pay_memo: str | None = _Text(('appmsg', 'wcpayinfo', 'pay_memo'))
+    receiver_username: str | None = _Text(('appmsg', 'wcpayinfo', 'receiver_username'))
+    # <appmsg><appattach> 文件
+    total_len: int | None = _Text(('appmsg', 'appattach', 'totallen'), _to_int)
+    file_ext: str | None = _Text(('appmsg', 'appattach', 'fileext'))
+    # <appinfo>
+    app_name: str | None = _Text(('appinfo', 'appname'))
+    # 图片、视频、语音、表情包
+    img_md5: str | None = _Attr(('img',), 'md5', deep=True)
+    video_md5: str | None = _Attr(('videomsg',), 'md5', deep=True)
+    voice_transtext: str | None = _Attr(('voicetrans',), 'transtext', deep=True)
+    emoji: dict | None = _Attr(('emoji',))
+
+    def __init__(self, root):
+        self.root = root
+        self.nodes = {}  # 路径 -> 节点（None 表示不存在）
+
+    @property
+    def has_appinfo(self) -> bool:
+        return _APPINFO.find(self) is not None
+
+
+def parse_root(content):
+    """
+    解析 XML，返回根节点
+    @param content: str 或 bytes
+    @return: 解析失败返回 None
+    """
+    if not content:
+        return None
+    try:
+        return ET.fromstring(content)
+    except ET.ParseError:
+        pass
+    # 有些消息 <msg> 前后有多余内容或者 & 没有转义
+    if isinstance(content, bytes):
+        content = content.decode('utf-8', errors='ignore')
+    res = _MSG_PATTERN.search(content)
+    if res:
+        content = res.group()
+    try:
+        return ET.fromstring(content.replace('&', '&amp;'))
+    except ET.ParseError:
+        pass
+    if _LXML_PARSER is None:
+        return None
+    try:
+        return lxml_etree.fromstring(content.encode('utf-8'), _LXML_PARSER)
+    except lxml_etree.XMLSyntaxError:
+        return None
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def parse_xml(content) -> AppMsg | None:
+    """
+    解析一条消息的 XML
+    同样的内容会返回同一个 AppMsg，调用方不要修改它
+    @param content: CompressContent 解压后的字符串，或者图片/视频/语音/表情包消息的 StrContent
+    @return: 解析失败返回 None
+    """
+    root = parse_root(content)
+    if root is None:
+        return None
+    return AppMsg(root)
+
+
+def parse_xml_many(contents) -> list:
+    """
+    批量解析
+    @param contents: XML 字符串列表
+    @return: 和 contents 一一对应的 AppMsg 列表，解析失败的是 None
+    """
+    return [parse_xml(content) for content in contents]
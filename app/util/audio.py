@@ -0,0 +1,203 @@
+"""
+语音消息转码
+
+silk -> pcm 在内存里完成（pysilk），pcm -> mp3/wav 交给进程内的编码器（lameenc / wave），
+只有两者都不可用时才退回到 ffmpeg，并且通过管道传 pcm，不再落地 .silk/.pcm 临时文件。
+"""
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import traceback
+import wave
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+
+from app.config import VOICE_CODEC
+from app.log import logger
+
+try:
+    import pysilk
+except ImportError:
+    pysilk = None
+try:
+    import lameenc
+except ImportError:
+    lameenc = None
+
+SAMPLE_RATE = 44100
+MP3_BIT_RATE = 64
+CODECS = {'mp3', 'wav'}
+
+
+def singleton(cls):
+    _instance = {}
+
+    def inner():
+        if cls not in _instance:
+            _instance[cls] = cls()
+        return _instance[cls]
+
+    return inner
+
+
+def get_ffmpeg_path() -> str:
+    """
+    查找 ffmpeg 可执行文件：打包目录 -> 源码目录 -> 系统 PATH
+    @return: 找不到时返回空字符串
+    """
+    exe_name = 'ffmpeg.exe' if sys.platform == 'win32' else 'ffmpeg'
+    # 获取打包后的资源目录
+    resource_dir = getattr(sys, '_MEIPASS', os.path.abspath(os.path.dirname(__file__)))
+    candidates = [
+        os.path.join(resource_dir, 'app', 'resources', 'data', exe_name),
+        os.path.join(os.getcwd(), 'app', 'resources', 'data', exe_name),
+    ]
+    for candidate in candidates:
+        if os.path.exists(candidate):
+            return candidate
+    return shutil.which('ffmpeg') or ''
+
+
+def silk_to_pcm(buf: bytes, sample_rate=SAMPLE_RATE) -> bytes:
+    """
+    在内存中把 silk 解码成 s16le 单声道 pcm
+    @param buf: MediaMSG.Media.Buf
+    @param sample_rate:
+    @return:
+    """
+    if pysilk is not None:
+        # 微信的 silk 文件开头多了一个 \x02
+        data = buf[1:] if buf[:1] == b'\x02' else buf
+        output = io.BytesIO()
+        pysilk.decode(io.BytesIO(data), output, sample_rate)
+        return output.getvalue()
+    # 没装 silk-python 的时候只能走 pilk，pilk 只认文件路径
+    from pilk import decode
+    fd, silk_path = tempfile.mkstemp(suffix='.silk')
+    pcm_path = silk_path[:-5] + '.pcm'
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(buf)
+        decode(silk_path, pcm_path, sample_rate)
+        with open(pcm_path, 'rb') as f:
+            return f.read()
+    finally:
+        for path in (silk_path, pcm_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def pcm_to_wav(pcm: bytes, sample_rate=SAMPLE_RATE) -> bytes:
+    output = io.BytesIO()
+    with wave.open(output, 'wb') as f:
+        f.setparams((1, 2, sample_rate, 0, 'NONE', 'NONE'))
+        f.writeframes(pcm)
+    return output.getvalue()
+
+
+def pcm_to_mp3(pcm: bytes, sample_rate=SAMPLE_RATE) -> bytes:
+    encoder = lameenc.Encoder()
+    encoder.set_bit_rate(MP3_BIT_RATE)
+    encoder.set_in_sample_rate(sample_rate)
+    encoder.set_channels(1)
+    encoder.set_quality(2)
+    return encoder.encode(pcm) + encoder.flush()
+
+
+@singleton
+class VoiceTranscoder:
+    """
+    语音批量转码服务
+    同一条语音（Reserved0）只会转码一次，后续请求直接复用已经生成的文件
+    """
+
+    def __init__(self):
+        self.codec = VOICE_CODEC if VOICE_CODEC in CODECS else 'mp3'
+        self.ffmpeg_path = get_ffmpeg_path()
+        self.max_workers = min(8, (os.cpu_count() or 1) + 2)
+        self.cache = {}  # Reserved0 -> 已生成的音频文件路径
+        self.lock = threading.Lock()
+        if self.codec == 'mp3' and lameenc is None and not self.ffmpeg_path:
+            logger.error('未找到 lameenc 和 ffmpeg，语音将导出为 wav')
+            self.codec = 'wav'
+
+    @property
+    def suffix(self) -> str:
+        return self.codec
+
+    def get_output_path(self, reserved0, output_path) -> str:
+        return os.path.join(output_path, f'{reserved0}.{self.suffix}')
+
+    def _encode_to_file(self, pcm: bytes, target_path):
+        if self.codec == 'wav':
+            data = pcm_to_wav(pcm)
+        elif lameenc is not None:
+            data = pcm_to_mp3(pcm)
+        else:
+            # 没有进程内编码器，pcm 走管道交给 ffmpeg，不经过 shell 和临时文件
+            cmd = [self.ffmpeg_path, '-loglevel', 'quiet', '-y', '-f', 's16le', '-ar', str(SAMPLE_RATE), '-ac', '1',
+                   '-i', 'pipe:0', target_path]
+            subprocess.run(cmd, input=pcm, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+            return
+        with open(target_path, 'wb') as f:
+            f.write(data)
+
+    def transcode(self, reserved0, buf: bytes, output_path) -> str:
+        """
+        把一条语音转码到 output_path 目录下
+        @param reserved0: MediaMSG.Media.Reserved0（即 MSG.MsgSvrID）
+        @param buf: silk 数据
+        @param output_path: 输出目录
+        @return: 音频文件路径，失败返回空字符串
+        """
+        target_path = self.get_output_path(reserved0, output_path)
+        if os.path.exists(target_path):
+            return target_path
+        with self.lock:
+            cached_path = self.cache.get(reserved0)
+        if cached_path and os.path.exists(cached_path):
+            shutil.copyfile(cached_path, target_path)
+            return target_path
+        if not buf:
+            return ''
+        try:
+            pcm = silk_to_pcm(buf)
+            self._encode_to_file(pcm, target_path)
+        except Exception:
+            logger.error(f'语音转码错误:{reserved0}\n{traceback.format_exc()}')
+            return ''
+        with self.lock:
+            self.cache[reserved0] = target_path
+        return target_path
+
+    def transcode_many(self, items, output_path, callback=None) -> dict:
+        """
+        用线程池批量转码
+        @param items: 可迭代的 (reserved0, buf)
+        @param output_path: 输出目录
+        @param callback: 每完成一条调用一次 callback(reserved0, path)
+        @return: {reserved0: path}
+        """
+        result = {}
+        pending = {}
+
+        def collect(done):
+            for future in done:
+                reserved0 = pending.pop(future)
+                path = future.result()
+                result[reserved0] = path
+                if callback:
+                    callback(reserved0, path)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for reserved0, buf in items:
+                pending[executor.submit(self.transcode, reserved0, buf, output_path)] = reserved0
+                # 限制在途任务数量，避免一次性把所有语音数据读进内存
+                if len(pending) >= self.max_workers * 4:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+            collect(as_completed(list(pending)))
+        return result
@@ -1,57 +1,154 @@
-import html
-import xml.etree.ElementTree as ET
+import re
+import threading
+from collections import OrderedDict, deque
 
 import lz4.block
 
-import requests
-import re
-from urllib.parse import urlparse
-from bs4 import BeautifulSoup
-
-from app.util.protocbuf.msg_pb2 import MessageBytesExtra
+from app.config import COMPRESS_CONTENT_CACHE_SIZE
+from app.util.appmsg import parse_xml, parse_xml_many
+from app.util.downloader import download_manager
+from app.util.link_resolver import get_audio_url, get_website_name, link_resolver
+from app.util.music import get_music_path
+from app.util.protocbuf import get_fields, get_thumb_path
 from ..util.file import get_file
 
 
-def decompress_CompressContent(data):
+# CompressContent 是不带长度头的 LZ4 block，解压后的长度只能估计
+# 先按 LZ4_INIT_RATIO 倍分配，不够再按 LZ4_GROW_FACTOR 倍扩大，LZ4 的压缩率不会超过 255 倍
+LZ4_INIT_RATIO = 8
+LZ4_GROW_FACTOR = 4
+LZ4_MAX_RATIO = 255
+
+
+def lz4_decompress(data: bytes) -> bytes:
+    """
+    解压不带长度头的 LZ4 block，缓冲区不够时自动扩大重试
+    @param data:
+    @return:
+    @raise lz4.block.LZ4BlockError: 数据损坏
+    """
+    max_size = len(data) * LZ4_MAX_RATIO + 64
+    size = min(max(len(data) * LZ4_INIT_RATIO, 4096), max_size)
+    while True:
+        try:
+            return lz4.block.decompress(data, uncompressed_size=size)
+        except lz4.block.LZ4BlockError:
+            if size >= max_size:
+                raise
+            size = min(size * LZ4_GROW_FACTOR, max_size)
+
+
+class CompressContentCache:
+    """
+    解压结果的 LRU 缓存，以 MsgSvrID 为键
+    同一条消息在导出时可能被解压多次（不同的解析函数、多种格式先后导出）
+    """
+
+    def __init__(self, maxsize=COMPRESS_CONTENT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.data.get(key)
+            if value is not None:
+                self.data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+compress_content_cache = CompressContentCache()
+
+
+def _decompress(data) -> str:
+    try:
+        dst = lz4_decompress(data)
+    except lz4.block.LZ4BlockError:
+        print("Decompression failed: potentially corrupt input.")
+        return ""
+    if b"\x00" in dst:
+        dst = dst.replace(b"\x00", b"")  # Remove any null characters
+    try:
+        return dst.decode()
+    except UnicodeDecodeError:
+        print("Decompression failed: result is not valid utf-8.")
+        return ""
+
+
+def decompress_CompressContent(data, msg_svr_id=None):
     """
     解压缩Msg：CompressContent内容
     :param data:
+    :param msg_svr_id: 消息的 MsgSvrID，传入时使用缓存
     :return:
     """
     if data is None or not isinstance(data, bytes):
         return ""
-    try:
-        dst = lz4.block.decompress(data, uncompressed_size=len(data) << 10)
-        decoded_string = dst.decode().replace("\x00", "")  # Remove any null characters
-    except:
-        print(
-            "Decompression failed: potentially corrupt input or insufficient buffer size."
-        )
-        return ""
+    if not msg_svr_id:
+        return _decompress(data)
+    decoded_string = compress_content_cache.get(msg_svr_id)
+    if decoded_string is None:
+        decoded_string = _decompress(data)
+        compress_content_cache.put(msg_svr_id, decoded_string)
     return decoded_string
 
 
+def decompress_CompressContent_many(datas, msg_svr_ids=None) -> list:
+    """
+    批量解压一列 CompressContent
+    :param datas: CompressContent 列表
+    :param msg_svr_ids: 与 datas 一一对应的 MsgSvrID，传入时结果会写入缓存，之后按 MsgSvrID 解压可以直接命中
+    :return: 与 datas 一一对应的字符串列表，解压失败的是空字符串
+    """
+    if msg_svr_ids is None:
+        return [decompress_CompressContent(data) for data in datas]
+    return [decompress_CompressContent(data, msg_svr_id) for data, msg_svr_id in zip(datas, msg_svr_ids)]
+
+
+def parse_CompressContent_many(datas, msg_svr_ids=None) -> list:
+    """
+    批量解压并解析一列 CompressContent
+    :param datas: CompressContent 列表
+    :param msg_svr_ids: 与 datas 一一对应的 MsgSvrID
+    :return: 与 datas 一一对应的 AppMsg 列表，解压或解析失败的是 None
+    """
+    return parse_xml_many(decompress_CompressContent_many(datas, msg_svr_ids))
+
+
+# html.escape(quote=False) 之后再做 JS 字符串转义，合并成一张表单次遍历完成
+# html.escape 只会产生 &amp; &lt; &gt;，不含需要再转义的字符，所以结果和分两步完全一致
+JS_HTML_ESCAPE_TABLE = str.maketrans({
+    '&': '&amp;',
+    '<': '&lt;',
+    '>': '&gt;',
+    '\\': '\\\\',
+    "'": "\\'",
+    '"': '\\"',
+    '\n': '\\n',
+    '\r': '\\r',
+    '\t': '\\t',
+})
+
+
 def escape_js_and_html(input_str):
     if not input_str:
         return ""
-    # 转义HTML特殊字符
-    html_escaped = html.escape(input_str, quote=False)
-
-    # 手动处理JavaScript转义字符
-    js_escaped = (
-        html_escaped.replace("\\", "\\\\")
-        .replace("'", r"\'")
-        .replace('"', r"\"")
-        .replace("\n", r"\n")
-        .replace("\r", r"\r")
-        .replace("\t", r"\t")
-    )
+    return input_str.translate(JS_HTML_ESCAPE_TABLE)
 
-    return js_escaped
 
-
-def parser_reply(data: bytes):
-    xml_content = decompress_CompressContent(data)
+def parser_reply(data: bytes, msg_svr_id=None):
+    xml_content = decompress_CompressContent(data, msg_svr_id)
     if not xml_content:
         return {
             "type": 57,
@@ -63,27 +160,22 @@ def parser_reply(data: bytes):
             },
             "is_error": True,
         }
-    try:
-        root = ET.XML(xml_content)
-        appmsg = root.find("appmsg")
-        msg_type = int(appmsg.find("type").text)
-        title = appmsg.find("title").text
-        refermsg_content = appmsg.find("refermsg").find("content").text
-        refermsg_type = int(appmsg.find("refermsg").find("type").text)
-        refermsg_displayname = appmsg.find("refermsg").find("displayname").text
+    appmsg = parse_xml(xml_content)
+    if not (appmsg is None or None in (appmsg.type, appmsg.title, appmsg.refer_type,
+                                       appmsg.refer_content, appmsg.refer_displayname)):
         return {
-            "type": msg_type,
-            "title": title,
+            "type": appmsg.type,
+            "title": appmsg.title,
             "refer": None
-            if refermsg_type != 1
+            if appmsg.refer_type != 1
             else {
-                "type": refermsg_type,
-                "content": refermsg_content.lstrip("\n"),
-                "displayname": refermsg_displayname,
+                "type": appmsg.refer_type,
+                "content": appmsg.refer_content.lstrip("\n"),
+                "displayname": appmsg.refer_displayname,
             },
             "is_error": False,
         }
-    except:
+    else:
         return {
             "type": 57,
             "title": "发生错误",
@@ -96,23 +188,23 @@ def parser_reply(data: bytes):
         }
 
 
-def music_share(data: bytes):
-    xml_content = decompress_CompressContent(data)
+def music_share(data: bytes, msg_svr_id=None):
+    xml_content = decompress_CompressContent(data, msg_svr_id)
     if not xml_content:
         return {"type": 3, "title": "发生错误", "is_error": True}
     try:
-        root = ET.XML(xml_content)
-        appmsg = root.find("appmsg")
-        msg_type = int(appmsg.find("type").text)
-        title = appmsg.find("title").text
+        appmsg = parse_xml(xml_content)
+        if appmsg is None or None in (appmsg.type, appmsg.title, appmsg.des, appmsg.url, appmsg.dataurl):
+            raise ValueError("音乐分享消息缺少字段")
+        title = appmsg.title
         if len(title) >= 39:
             title = title[:38] + "..."
-        artist = appmsg.find("des").text
-        link_url = appmsg.find("url").text  # 链接地址
-        audio_url = get_audio_url(appmsg.find("dataurl").text)  # 播放地址
+        artist = appmsg.des
+        link_url = appmsg.url  # 链接地址
+        audio_url = get_audio_url(appmsg.dataurl)  # 播放地址
         website_name = get_website_name(link_url)
         return {
-            "type": msg_type,
+            "type": appmsg.type,
             "title": escape_js_and_html(title),
             "artist": escape_js_and_html(artist),
             "link_url": link_url,
@@ -125,41 +217,58 @@ def music_share(data: bytes):
         return {"type": 3, "title": "发生错误", "is_error": True}
 
 
-def share_card(bytesExtra, compress_content_):
+MUSIC_PREFETCH_WINDOW = 200  # 音乐分享链接向前预读的消息条数
+
+
+def download_music_share(message, music_dir):
+    content = music_share(message[11], message[9])
+    if content.get("is_error") == False and content.get("audio_url") != "":
+        get_music_path(content.get("audio_url"), content.get("title"), output_path=music_dir)
+
+
+def prefetch_music_share(messages, window=MUSIC_PREFETCH_WINDOW, music_dir=None):
+    """
+    边读消息边把后面 window 条以内音乐分享的链接交给线程池解析，
+    导出到这条消息时 music_share 基本可以直接取到结果，不用逐条等待网络请求
+    :param messages: get_messages 格式的消息（可迭代）
+    :param window:
+    :param music_dir: 传入时音乐文件也提前并发下载到这个目录
+    :return: 原样返回消息的生成器
+    """
+    buffer = deque()
+    for message in messages:
+        buffer.append(message)
+        if message[2] == 49 and message[3] == 3:
+            appmsg = parse_xml(decompress_CompressContent(message[11], message[9]))
+            if appmsg is not None:
+                link_resolver.prefetch((appmsg.url,), (appmsg.dataurl,))
+                if music_dir:
+                    download_manager.submit(download_music_share, message, music_dir)
+        if len(buffer) > window:
+            yield buffer.popleft()
+    yield from buffer
+    link_resolver.save()
+    download_manager.save()
+
+
+def share_card(bytesExtra, compress_content_, msg_svr_id=None):
     title, des, url, show_display_name, thumbnail, app_logo = "", "", "", "", "", ""
     try:
-        xml = decompress_CompressContent(compress_content_)
-        root = ET.XML(xml)
-        appmsg = root.find("appmsg")
-        title = appmsg.find("title").text
-        try:
-            des = appmsg.find("des").text
-        except:
-            des = ""
-        url = appmsg.find("url").text
-        appinfo = root.find("appinfo")
-        show_display_name = appmsg.find("sourcedisplayname")
-        sourceusername = appmsg.find("sourceusername")
-        if show_display_name is not None:
-            show_display_name = show_display_name.text
-        else:
-            if appinfo is not None:
-                show_display_name = appinfo.find("appname").text
-        msg_bytes = MessageBytesExtra()
-        msg_bytes.ParseFromString(bytesExtra)
-        app_logo = ""
-        thumbnail = ""
-        for tmp in msg_bytes.message2:
-            if tmp.field1 == 3:
-                thumbnail = tmp.field2
-                thumbnail = "\\".join(thumbnail.split("\\")[1:])
-            if tmp.field2 == 4:
-                app_logo = tmp.field2
-                app_logo = "\\".join(app_logo.split("\\")[1:])
-        if sourceusername is not None:
+        xml = decompress_CompressContent(compress_content_, msg_svr_id)
+        appmsg = parse_xml(xml)
+        title = appmsg.title
+        des = appmsg.des or ""
+        url = appmsg.url
+        if appmsg.source_display_name is not None:
+            show_display_name = appmsg.source_display_name
+        elif appmsg.has_appinfo:
+            show_display_name = appmsg.app_name
+        thumbnail = get_thumb_path(bytesExtra)
+        thumbnail = "\\".join(thumbnail.split("\\")[1:])
+        if appmsg.source_username is not None:
             from app.DataBase import micro_msg_db  # 放上面会导致循环依赖
 
-            contact = micro_msg_db.get_contact_by_username(sourceusername.text)
+            contact = micro_msg_db.get_contact_by_username(appmsg.source_username)
             if contact:
                 app_logo = contact[7]
     finally:
@@ -173,7 +282,7 @@ def share_card(bytesExtra, compress_content_):
         }
 
 
-def transfer_decompress(compress_content_):
+def transfer_decompress(compress_content_, msg_svr_id=None):
     """
     return dict
         feedesc: 钱数，str类型，包含一个前缀币种符号（除人民币￥之外未测试）;
@@ -183,14 +292,12 @@ def transfer_decompress(compress_content_):
     """
     feedesc, pay_memo, receiver_username, paysubtype = "", "", "", ""
     try:
-        xml = decompress_CompressContent(compress_content_)
-        root = ET.XML(xml)
-        appmsg = root.find("appmsg")
-        wcpayinfo = appmsg.find("wcpayinfo")
-        paysubtype = int(wcpayinfo.find("paysubtype").text)
-        feedesc = wcpayinfo.find("feedesc").text
-        pay_memo = wcpayinfo.find("pay_memo").text
-        receiver_username = wcpayinfo.find("receiver_username").text
+        xml = decompress_CompressContent(compress_content_, msg_svr_id)
+        appmsg = parse_xml(xml)
+        paysubtype = appmsg.paysubtype if appmsg.paysubtype is not None else ""
+        feedesc = appmsg.feedesc or ""
+        pay_memo = appmsg.pay_memo or ""
+        receiver_username = appmsg.receiver_username or ""
     finally:
         return {
             "feedesc": feedesc,
@@ -208,14 +315,12 @@ def call_decompress(is_send, bytes_extra, display_content, str_content):  # 音
     """
     call_type = 2
     call_length = 0
-    msg_bytes = MessageBytesExtra()
-    msg_bytes.ParseFromString(bytes_extra)
     # message2 字段 1: 发送人wxid; 字段 3: "1"是语音，"0"是视频; 字段 4: 通话时长
-    for i in msg_bytes.message2:
-        if i.field1 == 3:
-            call_type = int(i.field2)
-        elif i.field1 == 4:
-            call_length = int(i.field2)
+    fields = get_fields(bytes_extra, (3, 4))
+    if 3 in fields:
+        call_type = int(fields[3])
+    if 4 in fields:
+        call_length = int(fields[4])
 
     try:
         if display_content == "":
@@ -242,70 +347,22 @@ def call_decompress(is_send, bytes_extra, display_content, str_content):  # 音
     }
 
 
-def get_website_name(url):
-    parsed_url = urlparse(url)
-    domain = f"{parsed_url.scheme}://{parsed_url.netloc}"
-    website_name = ""
-    try:
-        response = requests.get(domain, allow_redirects=False)
-        if response.status_code == 200:
-            soup = BeautifulSoup(response.content, "html.parser")
-            website_name = soup.title.string.strip()
-        elif response.status_code == 302:
-            domain = response.headers["Location"]
-            response = requests.get(domain, allow_redirects=False)
-            soup = BeautifulSoup(response.content, "html.parser")
-            website_name = soup.title.string.strip()
-        else:
-            response = requests.get(url, allow_redirects=False)
-            if response.status_code == 200:
-                soup = BeautifulSoup(response.content, "html.parser")
-                website_name = soup.title.string.strip()
-                index = website_name.find("-")
-                if index != -1:  # 如果找到了 "-"
-                    website_name = website_name[index + 1 :].strip()
-    except Exception as e:
-        print(f"Get Website Info Error: {e}")
-    return website_name
-
-
-def get_audio_url(url):
-    path = ""
-    try:
-        response = requests.get(url, allow_redirects=False)
-        # 检查响应状态码
-        if response.status_code == 302:
-            path = response.headers["Location"]
-        elif response.status_code == 200:
-            print("音乐文件已失效,url:" + url)
-        else:
-            print("音乐文件地址获取失败,url:" + url + ",状态码" + str(response.status_code))
-    except Exception as e:
-        print(f"Get Audio Url Error: {e}")
-    return path
+FILE_NAME_PATTERN = re.compile(r'[\\/:*?"<>|\r\n]+')
 
 
-def file(bytes_extra, compress_content, output_path):
-    xml_content = decompress_CompressContent(compress_content)
+def file(bytes_extra, compress_content, output_path, msg_svr_id=None):
+    xml_content = decompress_CompressContent(compress_content, msg_svr_id)
     if not xml_content:
         return {"type": 6, "title": "发生错误", "is_error": True}
     try:
-        root = ET.XML(xml_content)
-        appmsg = root.find("appmsg")
-        msg_type = int(appmsg.find("type").text)
-        file_name = appmsg.find("title").text
-        pattern = r'[\\/:*?"<>|\r\n]+'
-        file_name = re.sub(pattern, "_", file_name)
-        appattach = appmsg.find("appattach")
-        file_len = int(appattach.find("totallen").text)
-        app_name = ""
-        file_len = format_bytes(file_len)
-        file_ext = appattach.find("fileext").text
-        if root.find("appinfo") is not None:
-            app_info = root.find("appinfo")
-            app_name = app_info.find("appname").text
-            if app_name is None:
-                app_name = ""
+        appmsg = parse_xml(xml_content)
+        if appmsg is None or None in (appmsg.type, appmsg.title, appmsg.total_len, appmsg.file_ext):
+            raise ValueError("文件消息缺少字段")
+        msg_type = appmsg.type
+        file_name = FILE_NAME_PATTERN.sub("_", appmsg.title)
+        file_len = format_bytes(appmsg.total_len)
+        file_ext = appmsg.file_ext
+        app_name = appmsg.app_name or ""
         file_path = get_file(bytes_extra, file_name, output_path)
         return {
             "type": msg_type,
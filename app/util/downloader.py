@@ -0,0 +1,235 @@
+"""
+音乐、表情包等网络资源的下载管理
+
+所有下载共用一个保持连接的 Session，同一个网站同时只有 PER_HOST_LIMIT 个请求，
+网络错误和 5xx/429 会按指数退避重试。
+下载结果记在缓存目录的索引里（key -> 本地路径、状态、ETag），
+再次导出时文件还在就直接使用（导出到别的目录时复制过去），不会重新请求；
+确定失效的地址（404 等）也会记下来，不再反复请求。
+离线模式（config.OFFLINE_MODE）下只查索引。
+"""
+import json
+import os
+import shutil
+import threading
+import time
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from app import config
+from app.config import CACHE_DIR, NETWORK_TIMEOUT, NETWORK_WORKERS
+from app.log import logger
+
+INDEX_VERSION = 1
+PER_HOST_LIMIT = 4  # 每个网站的并发请求数
+RETRIES = 3  # 失败后的重试次数
+BACKOFF = 0.5  # 第 n 次重试前等待 BACKOFF * 2^n 秒
+SAVE_INTERVAL = 20  # 新增多少条记录写一次索引
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+STATUS_OK = 'ok'
+
+
+class DownloadManager:
+    def __init__(self, index_path=os.path.join(CACHE_DIR, 'download_index.json'), workers=NETWORK_WORKERS,
+                 per_host=PER_HOST_LIMIT, retries=RETRIES, backoff=BACKOFF, timeout=NETWORK_TIMEOUT):
+        self.index_path = index_path
+        self.workers = workers
+        self.per_host = per_host
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.index = {}  # key -> {'url', 'path', 'status', 'etag', 'size'}
+        self.pending = {}  # key -> Future，正在下载
+        self.tasks = set()  # submit 提交、还没完成的任务
+        self.host_limits = {}  # 网站 -> Semaphore
+        self.unsaved = 0
+        self.executor = None
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def load(self):
+        if self.loaded:
+            return
+        self.loaded = True
+        if not os.path.exists(self.index_path):
+            return
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except Exception:
+            logger.error(traceback.format_exc())
+            return
+        if data.get('version') == INDEX_VERSION:
+            self.index = data.get('items', {})
+
+    def save(self):
+        with self.lock:
+            if not self.unsaved:
+                return
+            data = {'version': INDEX_VERSION, 'items': dict(self.index)}
+            self.unsaved = 0
+        try:
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+            tmp_path = f'{self.index_path}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+            os.replace(tmp_path, self.index_path)
+        except Exception:
+            logger.error(traceback.format_exc())
+
+    def get_host_limit(self, url) -> threading.Semaphore:
+        host = urlparse(url).netloc
+        with self.lock:
+            semaphore = self.host_limits.get(host)
+            if semaphore is None:
+                semaphore = threading.Semaphore(self.per_host)
+                self.host_limits[host] = semaphore
+        return semaphore
+
+    def download(self, url, output_path, key=None, headers=None, verify=True) -> str:
+        """
+        下载文件，已经下载过的直接返回本地路径
+        同一个 key 正在被别的线程下载时等待它完成
+        @param url:
+        @param output_path: 保存路径；也可以是函数，参数是下载到的内容，返回保存路径（比如按文件头判断后缀）
+        @param key: 索引里的键，默认是 url（表情包可以用 md5）
+        @param headers:
+        @param verify: 是否校验 https 证书
+        @return: 本地路径，失败返回空字符串
+        """
+        key = key or url
+        downloaded = None
+        with self.lock:
+            self.load()
+            entry = self.index.get(key)
+            if entry is not None:
+                if entry['status'] != STATUS_OK:  # 确定失效的地址
+                    return ''
+                if os.path.exists(entry['path']):
+                    downloaded = entry['path']
+            if downloaded is None:
+                future = self.pending.get(key)
+                owner = future is None
+                if owner:
+                    if config.OFFLINE_MODE:
+                        return ''
+                    future = Future()
+                    self.pending[key] = future
+        if downloaded is not None:
+            return self.place(downloaded, output_path)
+        if not owner:
+            path = future.result()
+            return self.place(path, output_path) if path else ''
+        path = ''
+        try:
+            path = self.fetch(key, url, output_path, headers, verify)
+        except Exception:
+            logger.error(traceback.format_exc())
+        finally:
+            with self.lock:
+                self.pending.pop(key, None)
+                need_save = self.unsaved >= SAVE_INTERVAL
+            future.set_result(path)
+        if need_save:
+            self.save()
+        return path
+
+    @staticmethod
+    def place(path, output_path) -> str:
+        """
+        已经下载过的文件，需要保存到别的目录时复制一份
+        """
+        if callable(output_path):
+            # 保存路径由文件内容决定，用已下载的文件算出这次应该保存到哪里
+            with open(path, 'rb') as f:
+                output_path = output_path(f.read())
+        if os.path.abspath(path) != os.path.abspath(output_path) and not os.path.exists(output_path):
+            os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+            shutil.copy2(path, output_path)
+        return output_path
+
+    def fetch(self, key, url, output_path, headers, verify) -> str:
+        response = None
+        with self.get_host_limit(url):
+            for attempt in range(self.retries + 1):
+                if attempt:
+                    time.sleep(self.backoff * 2 ** (attempt - 1))
+                try:
+                    response = self.session.get(url, headers=headers, verify=verify, timeout=self.timeout)
+                except requests.RequestException as e:
+                    print(f"下载失败({attempt + 1}/{self.retries + 1}):{url} {e}")
+                    response = None
+                    continue
+                if response.status_code not in RETRY_STATUS:
+                    break
+        if response is None:  # 网络错误不写入索引，下次再试
+            return ''
+        if response.status_code != 200:
+            print(f"下载失败:{url}，状态码{response.status_code}")
+            if response.status_code not in RETRY_STATUS:
+                self.record(key, url, '', response.status_code, None, 0)
+            return ''
+        content = response.content
+        path = output_path(content) if callable(output_path) else output_path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+        self.record(key, url, path, STATUS_OK, response.headers.get('ETag'), len(content))
+        return path
+
+    def record(self, key, url, path, status, etag, size):
+        with self.lock:
+            self.index[key] = {
+                'url': url,
+                'path': os.path.abspath(path) if path else '',
+                'status': status,
+                'etag': etag,
+                'size': size,
+            }
+            self.unsaved += 1
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        """
+        在下载线程池里执行任务（比如先解析地址再下载），不等待结果
+        """
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='downloader')
+            future = self.executor.submit(fn, *args, **kwargs)
+            self.tasks.add(future)
+        future.add_done_callback(self.tasks.discard)
+        return future
+
+    def download_many(self, tasks) -> list:
+        """
+        并发下载一批文件
+        @param tasks: [(url, output_path, key), ...]，key 可以省略
+        @return: 和 tasks 一一对应的本地路径，失败的是空字符串
+        """
+        futures = [self.submit(self.download, *task) for task in tasks]
+        return [future.result() for future in futures]
+
+    def wait(self):
+        """
+        等待提交的任务和正在下载的文件全部完成，并保存索引
+        """
+        with self.lock:
+            futures = list(self.tasks) + list(self.pending.values())
+        for future in futures:
+            try:
+                future.result()
+            except Exception:
+                logger.error(traceback.format_exc())
+        self.save()
+
+
+download_manager = DownloadManager()
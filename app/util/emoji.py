@@ -9,15 +9,14 @@ emoji.py
 """
 
 import os
-import re
 import traceback
-import xml.etree.ElementTree as ET
 import sqlite3
 import threading
 from PyQt5.QtGui import QPixmap
-import requests
 
 from app.log import log, logger
+from app.util.appmsg import parse_xml
+from app.util.downloader import download_manager
 
 lock = threading.Lock()
 db_path = "./app/Database/Msg/Emotion.db"
@@ -49,29 +48,18 @@ def get_image_format(header):
 @log
 def parser_xml(xml_string):
     assert type(xml_string) == str
-    # Parse the XML string
-    try:
-        root = ET.fromstring(xml_string)
-    except:
-        res = re.search('<msg>.*</msg>', xml_string)
-        if res:
-            xml_string = res.group()
-        root = ET.fromstring(xml_string.replace("&", "&amp;"))
-    emoji = root.find("./emoji")
+    msg = parse_xml(xml_string)
+    if msg is None or msg.emoji is None:
+        return None
     # Accessing attributes of the 'emoji' element
-    fromusername = emoji.get("fromusername")
-    tousername = emoji.get("tousername")
+    emoji = msg.emoji
     md5 = emoji.get("md5")
     cdnurl = emoji.get("cdnurl")
-    encrypturl = emoji.get("encrypturl")
     thumburl = emoji.get("thumburl")
-    externurl = emoji.get("externurl")
     androidmd5 = emoji.get("androidmd5")
-    width = emoji.get("width")
-    height = emoji.get("height")
     return {
-        "width": width,
-        "height": height,
+        "width": emoji.get("width"),
+        "height": emoji.get("height"),
         "cdnurl": cdnurl,
         "thumburl": thumburl if thumburl else cdnurl,
         "md5": (md5 if md5 else androidmd5).lower(),
@@ -185,19 +173,17 @@ class Emotion:
 
 @log
 def download(url, output_dir, name, thumb=False):
-    resp = requests.get(url)
-    byte = resp.content
-    image_format = get_image_format(byte[:8])
-    if image_format:
-        if thumb:
-            output_path = os.path.join(output_dir, "th_" + name + "." + image_format)
-        else:
-            output_path = os.path.join(output_dir, name + "." + image_format)
-    else:
-        output_path = os.path.join(output_dir, name)
-    with open(output_path, "wb") as f:
-        f.write(resp.content)
-    return output_path
+    def get_output_path(content):
+        image_format = get_image_format(content[:8])
+        if image_format:
+            if thumb:
+                return os.path.join(output_dir, "th_" + name + "." + image_format)
+            return os.path.join(output_dir, name + "." + image_format)
+        return os.path.join(output_dir, name)
+
+    # 表情包按 md5 记录，同一个表情包只下载一次
+    key = ("th_" if thumb else "") + name
+    return download_manager.download(url, get_output_path, key=f"emoji:{key}")
 
 
 def get_most_emoji(messages):
@@ -1,5 +1,4 @@
 import csv
-import html
 import os
 import shutil
 import sys
@@ -10,6 +9,7 @@ from PyQt5.QtCore import pyqtSignal, QThread
 
 from app.config import OUTPUT_DIR
 from app.person import Me, Contact
+from app.util.compress_content import escape_js_and_html
 
 os.makedirs(os.path.join(OUTPUT_DIR, '聊天记录'), exist_ok=True)
 
@@ -61,26 +61,6 @@ def makedirs(path):
                     shutil.copy(source_file_path, target_file_path)
 
 
-def escape_js_and_html(input_str):
-    if not input_str:
-        return ''
-    # 转义HTML特殊字符
-    html_escaped = html.escape(input_str, quote=False)
-
-    # 手动处理JavaScript转义字符
-    js_escaped = (
-        html_escaped
-        .replace("\\", "\\\\")
-        .replace("'", r"\'")
-        .replace('"', r'\"')
-        .replace("\n", r'\n')
-        .replace("\r", r'\r')
-        .replace("\t", r'\t')
-    )
-
-    return js_escaped
-
-
 class ExporterBase(QThread):
     progressSignal = pyqtSignal(int)
     rangeSignal = pyqtSignal(int)
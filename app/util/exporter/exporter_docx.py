@@ -5,17 +5,22 @@ from re import findall
 
 import docx
 from docx import shared
+from docx.enum.style import WD_STYLE_TYPE
 from docx.enum.table import WD_ALIGN_VERTICAL
 from docx.enum.text import WD_COLOR_INDEX, WD_PARAGRAPH_ALIGNMENT
+from docx.oxml import OxmlElement
 from docx.oxml.ns import qn
-from docxcompose.composer import Composer
+from docx.oxml.table import CT_Tbl
+from docx.table import Table
+from docx.text.paragraph import Paragraph
 
 from app.DataBase import msg_db, hard_link_db
 from app.util.exporter.exporter import ExporterBase, escape_js_and_html
-from app.config import OUTPUT_DIR
+from app.config import OUTPUT_DIR, DOCX_VOLUME_SIZE
 from app.log import logger
 from app.person import Me
-from app.util.compress_content import parser_reply, share_card, music_share
+from app.util import file_index
+from app.util.compress_content import parser_reply, share_card, music_share, prefetch_music_share
 from app.util.image import get_image_abs_path
 from app.util.music import get_music_path
 
@@ -39,6 +44,59 @@ def filter_control_characters(input_string):
     return filtered_string
 
 
+class DocxVolume:
+    """
+    DOCX 分卷
+    python-docx 的 add_paragraph / add_table 每次都要从头查找 w:sectPr 再插入，文档越大越慢，
+    这里直接插到 w:sectPr 前面，追加一条消息的耗时和文档大小无关
+    """
+    # 一条消息（头像表格 + 空行）在 document.xml 里大概占的字节数
+    MESSAGE_SIZE = 2048
+
+    def __init__(self):
+        self.document = docx.Document()
+        self.document.styles["Normal"].font.name = "Cambria"
+        self.document.styles["Normal"]._element.rPr.rFonts.set(qn("w:eastAsia"), "宋体")
+        self.body = self.document._body
+        self.sectPr = self.document.element.body.get_or_add_sectPr()
+        # _block_width 每次都会在整个 body 里查找 w:sectPr，只算一次
+        self.block_width = self.document._block_width
+        self.table_styles = {}  # 样式名 -> 样式 id
+        self.size = 0  # 估算的文件大小
+
+    def add_paragraph(self, text='', style=None):
+        paragraph = Paragraph(OxmlElement('w:p'), self.body)
+        self.sectPr.addprevious(paragraph._p)
+        if text:
+            paragraph.add_run(text)
+        if style is not None:
+            paragraph.style = style
+        return paragraph
+
+    def add_table(self, rows, cols, style=None):
+        table = Table(CT_Tbl.new_tbl(rows, cols, self.block_width), self.body)
+        self.sectPr.addprevious(table._tbl)
+        # 按名字查样式要遍历整个 styles.xml，同一个样式只查一次
+        if style not in self.table_styles:
+            self.table_styles[style] = self.document.part.get_style_id(style, WD_STYLE_TYPE.TABLE)
+        table._tbl.tblStyle_val = self.table_styles[style]
+        return table
+
+    def add_size(self, size):
+        self.size += size
+
+    def is_full(self) -> bool:
+        return self.size >= DOCX_VOLUME_SIZE
+
+    def save(self, filename):
+        try:
+            self.document.save(filename)
+        except PermissionError:
+            filename = filename[:-5] + f'{time.time()}' + '.docx'
+            self.document.save(filename)
+        return filename
+
+
 class DocxExporter(ExporterBase):
     def text(self, doc, message):
         type_ = message[2]
@@ -77,15 +135,16 @@ class DocxExporter(ExporterBase):
         str_content = escape_js_and_html(str_content)
         image_path = hard_link_db.get_image(str_content, BytesExtra, thumb=True)
         base_path = os.path.join(OUTPUT_DIR, '聊天记录', self.contact.remark, 'image')
-        if not os.path.exists(os.path.join(Me().wx_dir, image_path)):
+        if not file_index.exists(os.path.join(Me().wx_dir, image_path)):
             image_thumb_path = hard_link_db.get_image(str_content, BytesExtra, thumb=False)
-            if not os.path.exists(os.path.join(Me().wx_dir, image_thumb_path)):
+            if not file_index.exists(os.path.join(Me().wx_dir, image_thumb_path)):
                 return
             image_path = image_thumb_path
         image_path = get_image_abs_path(image_path, base_path=base_path)
         try:
             run.add_picture(image_path, height=shared.Inches(2))
             doc.add_paragraph()
+            doc.add_size(os.path.getsize(image_path))
         except Exception:
             print("Error!image")
 
@@ -150,7 +209,7 @@ class DocxExporter(ExporterBase):
         """
         str_time = message[8]
         is_send = message[4]
-        content = parser_reply(message[11])
+        content = parser_reply(message[11], message[9])
         refer_msg = content.get('refer')
         timestamp = message[5]
         is_chatroom = 1 if self.contact.is_chatroom else 0
@@ -242,7 +301,7 @@ class DocxExporter(ExporterBase):
         origin_path = os.path.join(os.getcwd(), OUTPUT_DIR, '聊天记录', self.contact.remark)
         is_send = message[4]
         timestamp = message[5]
-        content = music_share(message[11])
+        content = music_share(message[11], message[9])
         music_path = ''
         if content.get('audio_url') != '':
             music_path = get_music_path(content.get('audio_url'), content.get('title'),
@@ -260,14 +319,14 @@ class DocxExporter(ExporterBase):
         timestamp = message[5]
         bytesExtra = message[10]
         compress_content_ = message[11]
-        card_data = share_card(bytesExtra, compress_content_)
+        card_data = share_card(bytesExtra, compress_content_, message[9])
         is_chatroom = 1 if self.contact.is_chatroom else 0
         avatar = self.get_avatar_path(is_send, message)
         display_name = self.get_display_name(is_send, message)
         thumbnail = ''
         if card_data.get('thumbnail'):
             thumbnail = os.path.join(Me().wx_dir, card_data.get('thumbnail'))
-            if os.path.exists(thumbnail):
+            if file_index.exists(thumbnail):
                 shutil.copy(thumbnail, os.path.join(origin_path, 'image', os.path.basename(thumbnail)))
                 thumbnail = './image/' + os.path.basename(thumbnail)
             else:
@@ -275,75 +334,50 @@ class DocxExporter(ExporterBase):
         app_logo = ''
         if card_data.get('app_logo'):
             app_logo = os.path.join(Me().wx_dir, card_data.get('app_logo'))
-            if os.path.exists(app_logo):
+            if file_index.exists(app_logo):
                 shutil.copy(app_logo, os.path.join(origin_path, 'image', os.path.basename(app_logo)))
                 app_logo = './image/' + os.path.basename(app_logo)
             else:
                 app_logo = ''
 
-    def merge_docx(self, conRemark, n):
-        origin_path = os.path.join(os.getcwd(), OUTPUT_DIR, '聊天记录')
-        all_file_path = []
-        for i in range(n):
-            file_name = f"{conRemark}{i}.docx"
-            all_file_path.append(origin_path + '/' + file_name)
-        filename = f"{conRemark}.docx"
-        # print(all_file_path)
-        doc = docx.Document()
-        doc.save(origin_path + '/' + filename)
-        master = docx.Document(origin_path + '/' + filename)
-        middle_new_docx = Composer(master)
-        num = 0
-        for word in all_file_path:
-            word_document = docx.Document(word)
-            word_document.add_page_break()
-            if num != 0:
-                middle_new_docx.append(word_document)
-            num = num + 1
-            os.remove(word)
-        middle_new_docx.save(origin_path + '/' + filename)
-
     def export(self):
         print(f"【开始导出 DOCX {self.contact.remark}】")
         origin_path = os.path.join(os.getcwd(), OUTPUT_DIR, '聊天记录', self.contact.remark)
-        messages = msg_db.get_messages(self.contact.wxid, time_range=self.time_range)
+        total = msg_db.get_messages_number(self.contact.wxid, time_range=self.time_range)
+        messages = msg_db.get_messages_iter(self.contact.wxid, time_range=self.time_range)
+        if self.message_types.get(4903):
+            # 音乐分享的网站名称、播放地址和音乐文件提前并发获取
+            messages = prefetch_music_share(messages, music_dir=origin_path + '/music')
+        if self.message_types.get(3) or self.message_types.get(43):
+            # 图片、视频的路径按批一次查出来
+            messages = hard_link_db.prefetch(messages)
         Me().save_avatar(os.path.join(origin_path, 'avatar', f'{Me().wxid}.png'))
-        if self.contact.is_chatroom:
-            for message in messages:
-                if message[4]:  # is_send
-                    continue
-                try:
-                    chatroom_avatar_path =os.path.join(origin_path, 'avatar', f'{message[13].wxid}.png')
-                    message[13].save_avatar(chatroom_avatar_path)
-                except:
-                    print(message)
-                    pass
-        else:
+        if not self.contact.is_chatroom:
             self.contact.save_avatar(os.path.join(origin_path, 'avatar', f'{self.contact.wxid}.png'))
-        self.rangeSignal.emit(len(messages))
-
-        def newdoc():
-            nonlocal n, doc
-            doc = docx.Document()
-            doc.styles["Normal"].font.name = "Cambria"
-            doc.styles["Normal"]._element.rPr.rFonts.set(qn("w:eastAsia"), "宋体")
-            n += 1
+        saved_avatars = set()
+        self.rangeSignal.emit(total)
 
-        doc = None
-        n = 0
+        doc = DocxVolume()
+        n = 1
         index = 0
-        newdoc()
         for index, message in enumerate(messages):
-            if index % 200 == 0 and index:
-                filename = os.path.join(origin_path, f"{self.contact.remark}_{n}.docx")
-                doc.save(filename)
-                self.okSignal.emit(n)
-                newdoc()
-
+            if doc.is_full():
+                # 按估算大小分卷，每卷写完直接保存，不再合并临时文件
+                doc.save(os.path.join(origin_path, f"{self.contact.remark}-{n}.docx"))
+                n += 1
+                doc = DocxVolume()
             type_ = message[2]
             sub_type = message[3]
             timestamp = message[5]
             self.progressSignal.emit(1)
+            if self.contact.is_chatroom and not message[4] and message[13].wxid not in saved_avatars:
+                # 群成员的头像第一次出现时再保存
+                saved_avatars.add(message[13].wxid)
+                try:
+                    chatroom_avatar_path = os.path.join(origin_path, 'avatar', f'{message[13].wxid}.png')
+                    message[13].save_avatar(chatroom_avatar_path)
+                except:
+                    print(message)
             if self.is_5_min(timestamp):
                 str_time = message[8]
                 doc.add_paragraph(str_time).alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
@@ -363,18 +397,11 @@ class DocxExporter(ExporterBase):
                 self.refermsg(doc, message)
             elif type_ == 49 and sub_type == 6 and self.message_types.get(4906):
                 self.file(doc, message)
-            if index % 25 == 0:
-                print(f"【导出 DOCX {self.contact.remark}】{index}/{len(messages)}")
-        if index % 25:
-            print(f"【导出 DOCX {self.contact.remark}】{index + 1}/{len(messages)}")
-        filename = os.path.join(origin_path, f"{self.contact.remark}_{n}.docx")
-        try:
-            # document.save(filename)
-            doc.save(filename)
-        except PermissionError:
-            filename = filename[:-5] + f'{time.time()}' + '.docx'
-            # document.save(filename)
-            doc.save(filename)
-        self.okSignal.emit(n)
+            doc.add_size(DocxVolume.MESSAGE_SIZE + (len(message[7]) * 3 if type_ == 1 and message[7] else 0))
+            if index % 2000 == 0:
+                print(f"【导出 DOCX {self.contact.remark}】{index}/{total}")
+        # 只有一卷时沿用原来的文件名
+        filename = f"{self.contact.remark}-{n}.docx" if n > 1 else f"{self.contact.remark}.docx"
+        doc.save(os.path.join(origin_path, filename))
         print(f"【完成导出 DOCX {self.contact.remark}】")
-        self.okSignal.emit(10086)
+        self.okSignal.emit(1)
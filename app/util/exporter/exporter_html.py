@@ -1,3 +1,4 @@
+import json
 import os
 import shutil
 import sys
@@ -8,11 +9,13 @@ from PyQt5.QtCore import pyqtSignal, QThread
 
 from app.DataBase import msg_db, hard_link_db, media_msg_db
 from app.util.exporter.exporter import ExporterBase, escape_js_and_html
-from app.config import OUTPUT_DIR
+from app.config import OUTPUT_DIR, HTML_CHUNK_MODE, HTML_CHUNK_SIZE
 from app.log import logger
 from app.person import Me
 from app.util import path
-from app.util.compress_content import parser_reply, share_card, music_share, file, transfer_decompress, call_decompress
+from app.util import file_index
+from app.util.compress_content import parser_reply, share_card, music_share, file, transfer_decompress, call_decompress, \
+    prefetch_music_share
 from app.util.emoji import get_emoji_url
 from app.util.image import get_image_path, get_image
 from app.util.music import get_music_path
@@ -27,51 +30,155 @@ icon_files = {
     './icon/pdf.png': ['pdf'],
 }
 
+WRITE_BUFFER_SIZE = 1 << 20  # 导出文件的写缓冲，攒够 1MB 再落盘
+
+# 各类消息记录的模板，和 template.html 里 renderPage 读取的字段一一对应
+# 字段值在写入前已经按需转义，这里只做拼接
+COMMON_FIELDS = "is_send:%(is_send)s,avatar_path:'%(avatar)s',timestamp:%(timestamp)s,is_chatroom:%(is_chatroom)s,displayname:'%(display_name)s'"
+BASE_RECORD = "{ type:%(type)s, text: '%(text)s'," + COMMON_FIELDS + "},"
+AUDIO_RECORD = (
+    "{ type:34, text:'%(text)s',is_send:%(is_send)s,avatar_path:'%(avatar)s',voice_to_text:'%(voice_to_text)s',"
+    "timestamp:%(timestamp)s,is_chatroom:%(is_chatroom)s,displayname:'%(display_name)s'},"
+)
+FILE_RECORD = (
+    "{ type:49, text: '%(text)s'," + COMMON_FIELDS +
+    ",icon_path: '%(icon_path)s',sub_type:6,file_name: '%(file_name)s',file_size: '%(file_size)s',app_name: '%(app_name)s'},"
+)
+REFER_RECORD = (
+    "{ type:49, text: '%(text)s',is_send:%(is_send)s,sub_type:%(sub_type)s,refer_text: '%(refer_text)s',"
+    "avatar_path:'%(avatar)s',timestamp:%(timestamp)s,is_chatroom:%(is_chatroom)s,displayname:'%(display_name)s'},"
+)
+REPLY_RECORD = (
+    "{ type:49, text: '%(text)s',is_send:%(is_send)s,sub_type:%(sub_type)s,"
+    "avatar_path:'%(avatar)s',timestamp:%(timestamp)s,is_chatroom:%(is_chatroom)s,displayname:'%(display_name)s'},"
+)
+SYSTEM_RECORD = (
+    "{ type:0, text: '%(text)s',is_send:%(is_send)s,avatar_path:'',timestamp:%(timestamp)s,"
+    "is_chatroom:%(is_chatroom)s,displayname:''},"
+)
+MUSIC_RECORD = (
+    "{ type:49, text:'%(text)s',is_send:%(is_send)s,avatar_path:'%(avatar)s',link_url:'%(link_url)s',"
+    "timestamp:%(timestamp)s,is_chatroom:%(is_chatroom)s,displayname:'%(display_name)s',sub_type:3,"
+    "title:'%(title)s',artist:'%(artist)s', website_name:'%(website_name)s'},"
+)
+CARD_RECORD = (
+    "{ type:49,sub_type:5, text:'',is_send:%(is_send)s,avatar_path:'%(avatar)s',url:'%(url)s',"
+    "timestamp:%(timestamp)s,is_chatroom:%(is_chatroom)s,displayname:'%(display_name)s',title:'%(title)s',"
+    "description:'%(description)s',thumbnail:'%(thumbnail)s',app_logo:'%(app_logo)s',app_name:'%(app_name)s'},\n"
+)
+TRANSFER_RECORD = (
+    "{ type:49,sub_type:2000,text:'%(text)s'," + COMMON_FIELDS +
+    ",paysubtype:%(paysubtype)s,pay_memo:'%(pay_memo)s',feedesc:'%(feedesc)s',},\n"
+)
+CALL_RECORD = (
+    "{ type:50, text:'%(text)s',call_type:%(call_type)s,avatar_path:'%(avatar)s',timestamp:%(timestamp)s,"
+    "is_chatroom:%(is_chatroom)s,displayname:'%(display_name)s',},\n"
+)
+
+
+class ChunkWriter:
+    """
+    HTML 分卷导出时代替 html 文件对象，把消息记录写进 messages 目录下编号的 js 文件
+    每个 js 文件的内容是 chatChunkLoaded(序号, [...]);，由 template.html 翻页时按需加载
+    """
+
+    def __init__(self, output_dir, mode='count', chunk_size=HTML_CHUNK_SIZE):
+        self.output_dir = os.path.join(output_dir, 'messages')
+        self.mode = mode
+        self.chunk_size = chunk_size
+        self.chunks = []  # 分卷索引：[{src, start, count, month}]
+        self.file = None
+        self.month = ''
+        self.total = 0
+        os.makedirs(self.output_dir, exist_ok=True)
+
+    def begin(self, message):
+        """
+        每条消息导出前调用，记下消息所在的月份
+        @param message:
+        @return:
+        """
+        if self.mode == 'month':
+            self.month = message[8][:7]
+
+    def write(self, record):
+        # 每条消息恰好对应一次 write，卷在第一次写入时才创建，不会产生空卷
+        chunk = self.chunks[-1] if self.chunks else None
+        if chunk is None or (
+                chunk['month'] != self.month if self.mode == 'month' else chunk['count'] >= self.chunk_size):
+            self._open()
+        self.file.write(record)
+        self.chunks[-1]['count'] += 1
+        self.total += 1
+
+    def _open(self):
+        self._close_file()
+        chunk_id = len(self.chunks)
+        filename = f'{chunk_id + 1:05d}.js'
+        self.chunks.append({
+            'src': f'./messages/{filename}',
+            'start': self.total,
+            'count': 0,
+            'month': self.month,
+        })
+        self.file = open(os.path.join(self.output_dir, filename), 'w', encoding='utf-8', buffering=WRITE_BUFFER_SIZE)
+        self.file.write(f'chatChunkLoaded({chunk_id}, [\n')
+
+    def _close_file(self):
+        if self.file:
+            self.file.write('\n]);\n')
+            self.file.close()
+            self.file = None
+
+    def close(self):
+        self._close_file()
+
+    def index(self) -> dict:
+        return {
+            'total': self.total,
+            'chunks': self.chunks,
+        }
+
 
 class HtmlExporter(ExporterBase):
-    def text(self, doc, message):
-        type_ = message[2]
-        str_content = message[7]
-        str_time = message[8]
+    def get_common_fields(self, message) -> dict:
+        """
+        每条记录都有的字段，头像和昵称按发送人缓存，同一个人的昵称只转义一次
+        @param message:
+        @return:
+        """
         is_send = message[4]
-        timestamp = message[5]
-        is_chatroom = 1 if self.contact.is_chatroom else 0
+        key = (is_send, message[13].wxid) if self.contact.is_chatroom else is_send
+        sender = self.sender_cache.get(key)
+        if sender is None:
+            sender = self.get_avatar_path(is_send, message), self.get_display_name(is_send, message)
+            self.sender_cache[key] = sender
+        return {
+            'is_send': is_send,
+            'avatar': sender[0],
+            'display_name': sender[1],
+            'timestamp': message[5],
+            'is_chatroom': self.is_chatroom,
+        }
 
-        display_name = self.get_display_name(is_send, message)
-        avatar = self.get_avatar_path(is_send, message)
-        str_content = escape_js_and_html(str_content)
-        doc.write(
-            f'''{{ type:{1}, text: '{str_content}',is_send:{is_send},avatar_path:'{avatar}',timestamp:{timestamp},is_chatroom:{is_chatroom},displayname:'{display_name}'}},'''
-        )
+    def text(self, doc, message):
+        str_content = escape_js_and_html(message[7])
+        doc.write(BASE_RECORD % {**self.get_common_fields(message), 'type': 1, 'text': str_content})
 
     def image(self, doc, message):
         base_path = os.path.join(OUTPUT_DIR, '聊天记录', self.contact.remark, 'image')
         type_ = message[2]
         str_content = message[7]
-        str_time = message[8]
-        is_send = message[4]
         BytesExtra = message[10]
-        timestamp = message[5]
-        is_chatroom = 1 if self.contact.is_chatroom else 0
-        avatar = self.get_avatar_path(is_send, message)
-        display_name = self.get_display_name(is_send, message)
         str_content = escape_js_and_html(str_content)
         image_path = hard_link_db.get_image(str_content, BytesExtra, up_dir=Me().wx_dir, thumb=False)
         image_path = get_image_path(image_path, base_path=base_path)
-        doc.write(
-            f'''{{ type:{type_}, text: '{image_path}',is_send:{is_send},avatar_path:'{avatar}',timestamp:{timestamp},is_chatroom:{is_chatroom},displayname:'{display_name}'}},'''
-        )
+        doc.write(BASE_RECORD % {**self.get_common_fields(message), 'type': type_, 'text': image_path})
 
     def audio(self, doc, message):
         origin_path = os.path.join(os.getcwd(), OUTPUT_DIR, '聊天记录', self.contact.remark)
         str_content = message[7]
-        str_time = message[8]
-        is_send = message[4]
         msgSvrId = message[9]
-        timestamp = message[5]
-        is_chatroom = 1 if self.contact.is_chatroom else 0
-        avatar = self.get_avatar_path(is_send, message)
-        display_name = self.get_display_name(is_send, message)
         try:
             audio_path = media_msg_db.get_audio_path(msgSvrId, output_path=origin_path + "/voice")
             audio_path = "./voice/" + os.path.basename(audio_path)
@@ -81,34 +188,18 @@ class HtmlExporter(ExporterBase):
         voice_to_text = media_msg_db.get_audio_text(str_content)
         if voice_to_text and voice_to_text != "":
             voice_to_text = escape_js_and_html(voice_to_text)
-        doc.write(
-            f'''{{ type:34, text:'{audio_path}',is_send:{is_send},avatar_path:'{avatar}',voice_to_text:'{voice_to_text}',timestamp:{timestamp},is_chatroom:{is_chatroom},displayname:'{display_name}'}},'''
-        )
+        doc.write(AUDIO_RECORD % {**self.get_common_fields(message), 'text': audio_path, 'voice_to_text': voice_to_text})
 
     def emoji(self, doc, message):
         str_content = message[7]
-        str_time = message[8]
-        is_send = message[4]
-        timestamp = message[5]
-        is_chatroom = 1 if self.contact.is_chatroom else 0
-        avatar = self.get_avatar_path(is_send, message)
-        display_name = self.get_display_name(is_send, message)
         emoji_path = get_emoji_url(str_content, thumb=True)
-        doc.write(
-            f'''{{ type:{3}, text: '{emoji_path}',is_send:{is_send},avatar_path:'{avatar}',timestamp:{timestamp},is_chatroom:{is_chatroom},displayname:'{display_name}'}},'''
-        )
+        doc.write(BASE_RECORD % {**self.get_common_fields(message), 'type': 3, 'text': emoji_path})
 
     def file(self, doc, message):
         origin_path = os.path.join(os.getcwd(), OUTPUT_DIR, '聊天记录', self.contact.remark)
         bytesExtra = message[10]
         compress_content = message[11]
-        str_time = message[8]
-        is_send = message[4]
-        timestamp = message[5]
-        is_chatroom = 1 if self.contact.is_chatroom else 0
-        avatar = self.get_avatar_path(is_send, message)
-        display_name = self.get_display_name(is_send, message)
-        file_info = file(bytesExtra, compress_content, output_path=origin_path + '/file')
+        file_info = file(bytesExtra, compress_content, output_path=origin_path + '/file', msg_svr_id=message[9])
         if file_info.get('is_error') == False:
             icon_path = None
             for icon, extensions in icon_files.items():
@@ -122,9 +213,14 @@ class HtmlExporter(ExporterBase):
             file_path = file_info.get('file_path')
             if file_path != "":
                 file_path = './file/' + file_info.get('file_name')
-            doc.write(
-                f'''{{ type:49, text: '{file_path}',is_send:{is_send},avatar_path:'{avatar}',timestamp:{timestamp},is_chatroom:{is_chatroom},displayname:'{display_name}',icon_path: '{icon_path}',sub_type:6,file_name: '{file_info.get('file_name')}',file_size: '{file_info.get('file_len')}',app_name: '{file_info.get('app_name')}'}},'''
-            )
+            doc.write(FILE_RECORD % {
+                **self.get_common_fields(message),
+                'text': file_path,
+                'icon_path': icon_path,
+                'file_name': file_info.get('file_name'),
+                'file_size': file_info.get('file_len'),
+                'app_name': file_info.get('app_name'),
+            })
 
     def refermsg(self, doc, message):
         """
@@ -133,31 +229,20 @@ class HtmlExporter(ExporterBase):
         @param message:
         @return:
         """
-        str_time = message[8]
-        is_send = message[4]
-        content = parser_reply(message[11])
+        content = parser_reply(message[11], message[9])
         refer_msg = content.get('refer')
-        timestamp = message[5]
-        is_chatroom = 1 if self.contact.is_chatroom else 0
-        avatar = self.get_avatar_path(is_send, message)
-        display_name = self.get_display_name(is_send, message)
         contentText = escape_js_and_html(content.get('title'))
+        fields = {**self.get_common_fields(message), 'text': contentText, 'sub_type': content.get('type')}
         if refer_msg:
-            referText = f"{escape_js_and_html(refer_msg.get('displayname'))}：{escape_js_and_html(refer_msg.get('content'))}"
-            doc.write(
-                f'''{{ type:49, text: '{contentText}',is_send:{is_send},sub_type:{content.get('type')},refer_text: '{referText}',avatar_path:'{avatar}',timestamp:{timestamp},is_chatroom:{is_chatroom},displayname:'{display_name}'}},'''
-            )
+            fields['refer_text'] = f"{escape_js_and_html(refer_msg.get('displayname'))}：{escape_js_and_html(refer_msg.get('content'))}"
+            doc.write(REFER_RECORD % fields)
         else:
-            doc.write(
-                f'''{{ type:49, text: '{contentText}',is_send:{is_send},sub_type:{content.get('type')},avatar_path:'{avatar}',timestamp:{timestamp},is_chatroom:{is_chatroom},displayname:'{display_name}'}},'''
-            )
+            doc.write(REPLY_RECORD % fields)
 
     def system_msg(self, doc, message):
         str_content = message[7]
         is_send = message[4]
-        str_time = message[8]
         timestamp = message[5]
-        is_chatroom = 1 if self.contact.is_chatroom else 0
 
         str_content = str_content.replace('<![CDATA[', "").replace(
             ' <a href="weixin://revoke_edit_click">重新编辑</a>]]>', "")
@@ -165,21 +250,19 @@ class HtmlExporter(ExporterBase):
         for xmlstr, b in res:
             str_content = str_content.replace(xmlstr, "")
         str_content = escape_js_and_html(str_content)
-        doc.write(
-            f'''{{ type:0, text: '{str_content}',is_send:{is_send},avatar_path:'',timestamp:{timestamp},is_chatroom:{is_chatroom},displayname:''}},'''
-        )
+        doc.write(SYSTEM_RECORD % {
+            'text': str_content,
+            'is_send': is_send,
+            'timestamp': timestamp,
+            'is_chatroom': self.is_chatroom,
+        })
 
     def video(self, doc, message):
         origin_path = os.path.join(os.getcwd(), OUTPUT_DIR, '聊天记录', self.contact.remark)
         type_ = message[2]
         str_content = message[7]
-        str_time = message[8]
-        is_send = message[4]
         BytesExtra = message[10]
         timestamp = message[5]
-        is_chatroom = 1 if self.contact.is_chatroom else 0
-        avatar = self.get_avatar_path(is_send, message)
-        display_name = self.get_display_name(is_send, message)
         video_path = hard_link_db.get_video(str_content, BytesExtra, thumb=False)
         image_path = hard_link_db.get_video(str_content, BytesExtra, thumb=True)
         if video_path is None and image_path is not None:
@@ -188,33 +271,25 @@ class HtmlExporter(ExporterBase):
                 # todo 网络图片问题
                 print(origin_path + image_path[1:])
                 os.utime(origin_path + image_path[1:], (timestamp, timestamp))
-                doc.write(
-                    f'''{{ type:3, text: '{image_path}',is_send:{is_send},avatar_path:'{avatar}',timestamp:{timestamp},is_chatroom:{is_chatroom},displayname:'{display_name}'}},'''
-                )
+                doc.write(BASE_RECORD % {**self.get_common_fields(message), 'type': 3, 'text': image_path})
             except:
-                doc.write(
-                    f'''{{ type:1, text: '视频丢失',is_send:{is_send},avatar_path:'{avatar}',timestamp:{timestamp},is_chatroom:{is_chatroom},displayname:'{display_name}'}},'''
-                )
+                doc.write(BASE_RECORD % {**self.get_common_fields(message), 'type': 1, 'text': '视频丢失'})
             return
         if video_path is None and image_path is None:
             return
         video_path = f'{Me().wx_dir}/{video_path}'
         video_path = video_path.replace('\\', '/')
-        if os.path.exists(video_path):
+        if file_index.exists(video_path):
             new_path = origin_path + '/video/' + os.path.basename(video_path)
             if not os.path.exists(new_path):
                 shutil.copy(video_path, os.path.join(origin_path, 'video'))
             os.utime(new_path, (timestamp, timestamp))
             video_path = f'./video/{os.path.basename(video_path)}'
-        doc.write(
-            f'''{{ type:{type_}, text: '{video_path}',is_send:{is_send},avatar_path:'{avatar}',timestamp:{timestamp},is_chatroom:{is_chatroom},displayname:'{display_name}'}},'''
-        )
+        doc.write(BASE_RECORD % {**self.get_common_fields(message), 'type': type_, 'text': video_path})
 
     def music_share(self, doc, message):
         origin_path = os.path.join(os.getcwd(), OUTPUT_DIR, '聊天记录', self.contact.remark)
-        is_send = message[4]
-        timestamp = message[5]
-        content = music_share(message[11])
+        content = music_share(message[11], message[9])
         music_path = ''
         if content.get('is_error') == False:
             if content.get('audio_url') != '':
@@ -223,28 +298,25 @@ class HtmlExporter(ExporterBase):
                 if music_path != '':
                     music_path = f'./music/{os.path.basename(music_path)}'
                     music_path = music_path.replace('\\', '/')
-            is_chatroom = 1 if self.contact.is_chatroom else 0
-            avatar = self.get_avatar_path(is_send, message)
-            display_name = self.get_display_name(is_send, message)
             music_path = escape_js_and_html(music_path)
-            doc.write(
-                f'''{{ type:49, text:'{music_path}',is_send:{is_send},avatar_path:'{avatar}',link_url:'{content.get('link_url')}',timestamp:{timestamp},is_chatroom:{is_chatroom},displayname:'{display_name}',sub_type:3,title:'{content.get('title')}',artist:'{content.get('artist')}', website_name:'{content.get('website_name')}'}},'''
-            )
+            doc.write(MUSIC_RECORD % {
+                **self.get_common_fields(message),
+                'text': music_path,
+                'link_url': content.get('link_url'),
+                'title': content.get('title'),
+                'artist': content.get('artist'),
+                'website_name': content.get('website_name'),
+            })
 
     def share_card(self, doc, message):
         origin_path = os.path.join(os.getcwd(), OUTPUT_DIR, '聊天记录', self.contact.remark)
-        is_send = message[4]
-        timestamp = message[5]
         bytesExtra = message[10]
         compress_content_ = message[11]
-        card_data = share_card(bytesExtra, compress_content_)
-        is_chatroom = 1 if self.contact.is_chatroom else 0
-        avatar = self.get_avatar_path(is_send, message)
-        display_name = self.get_display_name(is_send, message)
+        card_data = share_card(bytesExtra, compress_content_, message[9])
         thumbnail = ''
         if card_data.get('thumbnail'):
             thumbnail = os.path.join(Me().wx_dir, card_data.get('thumbnail'))
-            if os.path.exists(thumbnail):
+            if file_index.exists(thumbnail):
                 shutil.copy(thumbnail, os.path.join(origin_path, 'image', os.path.basename(thumbnail)))
                 thumbnail = './image/' + os.path.basename(thumbnail)
             else:
@@ -252,24 +324,25 @@ class HtmlExporter(ExporterBase):
         app_logo = ''
         if card_data.get('app_logo'):
             app_logo = os.path.join(Me().wx_dir, card_data.get('app_logo'))
-            if os.path.exists(app_logo):
+            if file_index.exists(app_logo):
                 shutil.copy(app_logo, os.path.join(origin_path, 'image', os.path.basename(app_logo)))
                 app_logo = './image/' + os.path.basename(app_logo)
             else:
                 app_logo = card_data.get('app_logo')
-        doc.write(
-            f'''{{ type:49,sub_type:5, text:'',is_send:{is_send},avatar_path:'{avatar}',url:'{card_data.get('url')}',timestamp:{timestamp},is_chatroom:{is_chatroom},displayname:'{display_name}',title:'{card_data.get('title')}',description:'{card_data.get('description')}',thumbnail:'{thumbnail}',app_logo:'{app_logo}',app_name:'{card_data.get('app_name')}'}},\n'''
-        )
+        doc.write(CARD_RECORD % {
+            **self.get_common_fields(message),
+            'url': card_data.get('url'),
+            'title': card_data.get('title'),
+            'description': card_data.get('description'),
+            'thumbnail': thumbnail,
+            'app_logo': app_logo,
+            'app_name': card_data.get('app_name'),
+        })
 
     def transfer(self, doc, message):
-        is_send = message[4]
-        timestamp = message[5]
         compress_content_ = message[11]
         # open("test.bin", "wb").write(compress_content_)
-        transfer_detail = transfer_decompress(compress_content_)
-        is_chatroom = 1 if self.contact.is_chatroom else 0
-        avatar = self.get_avatar_path(is_send, message)
-        display_name = self.get_display_name(is_send, message)
+        transfer_detail = transfer_decompress(compress_content_, message[9])
         try:
             text_info_map = {
                 1: transfer_detail["pay_memo"] or "发起转账",
@@ -280,30 +353,71 @@ class HtmlExporter(ExporterBase):
                 8: "未知",
                 9: "未知",
             }
-            doc.write(
-                f"""{{ type:49,sub_type:2000,text:'{text_info_map[transfer_detail["paysubtype"]]}',is_send:{is_send},avatar_path:'{avatar}',timestamp:{timestamp},is_chatroom:{is_chatroom},displayname:'{display_name}',paysubtype:{transfer_detail["paysubtype"]},pay_memo:'{transfer_detail["pay_memo"]}',feedesc:'{transfer_detail["feedesc"]}',}},\n""")
+            doc.write(TRANSFER_RECORD % {
+                **self.get_common_fields(message),
+                'text': text_info_map[transfer_detail["paysubtype"]],
+                'paysubtype': transfer_detail["paysubtype"],
+                'pay_memo': transfer_detail["pay_memo"],
+                'feedesc': transfer_detail["feedesc"],
+            })
         except Exception as e:
             logger.error(f'转账解析错误：{transfer_detail}\n{traceback.format_exc()}')
+
     def call(self, doc, message):
         is_send = message[4]
-        timestamp = message[5]
         str_content = message[7]
         bytes_extra = message[10]
         display_content = message[12]
         call_detail = call_decompress(
             is_send, bytes_extra, display_content, str_content
         )
-        is_chatroom = 1 if self.contact.is_chatroom else 0
-        avatar = self.get_avatar_path(is_send, message)
-        display_name = self.get_display_name(is_send, message)
-        doc.write(
-            f"""{{ type:50, text:'{call_detail["display_content"]}',call_type:{call_detail["call_type"]},avatar_path:'{avatar}',timestamp:{timestamp},is_chatroom:{is_chatroom},displayname:'{display_name}',}},\n""")
+        doc.write(CALL_RECORD % {
+            **self.get_common_fields(message),
+            'text': call_detail["display_content"],
+            'call_type': call_detail["call_type"],
+        })
+
+    def write_message(self, doc, message):
+        type_ = message[2]
+        sub_type = message[3]
+        if type_ == 1 and self.message_types.get(type_):
+            self.text(doc, message)
+        elif type_ == 3 and self.message_types.get(type_):
+            self.image(doc, message)
+        elif type_ == 34 and self.message_types.get(type_):
+            self.audio(doc, message)
+        elif type_ == 43 and self.message_types.get(type_):
+            self.video(doc, message)
+        elif type_ == 47 and self.message_types.get(type_):
+            self.emoji(doc, message)
+        elif type_ == 10000 and self.message_types.get(type_):
+            self.system_msg(doc, message)
+        elif type_ == 49 and sub_type == 57 and self.message_types.get(1):
+            self.refermsg(doc, message)
+        elif type_ == 49 and sub_type == 6 and self.message_types.get(4906):
+            self.file(doc, message)
+        elif type_ == 49 and sub_type == 3 and self.message_types.get(4903):
+            self.music_share(doc, message)
+        elif type_ == 49 and sub_type == 5 and self.message_types.get(4905):
+            self.share_card(doc, message)
+        elif type_ == 49 and sub_type == 2000 and self.message_types.get(492000):
+            self.transfer(doc, message)
+        elif type_ == 50 and self.message_types.get(50):
+            self.call(doc, message)
 
     def export(self):
         print(f"【开始导出 HTML {self.contact.remark}】")
-        messages = msg_db.get_messages(self.contact.wxid, time_range=self.time_range)
-        filename = os.path.join(os.getcwd(), OUTPUT_DIR, '聊天记录', self.contact.remark,
-                                f'{self.contact.remark}.html')
+        total = msg_db.get_messages_number(self.contact.wxid, time_range=self.time_range)
+        # 分批读取消息，导出过程中内存里不会有整个聊天记录
+        messages = msg_db.get_messages_iter(self.contact.wxid, time_range=self.time_range)
+        origin_path = os.path.join(os.getcwd(), OUTPUT_DIR, '聊天记录', self.contact.remark)
+        filename = os.path.join(origin_path, f'{self.contact.remark}.html')
+        if self.message_types.get(4903):
+            # 音乐分享的网站名称、播放地址和音乐文件提前并发获取
+            messages = prefetch_music_share(messages, music_dir=origin_path + '/music')
+        if self.message_types.get(3) or self.message_types.get(43):
+            # 图片、视频的路径按批一次查出来
+            messages = hard_link_db.prefetch(messages)
         file_path = './app/resources/data/template.html'
         if not os.path.exists(file_path):
             resource_dir = getattr(sys, '_MEIPASS', os.path.abspath(os.path.dirname(__file__)))
@@ -312,50 +426,37 @@ class HtmlExporter(ExporterBase):
         with open(file_path, "r", encoding="utf-8") as f:
             content = f.read()
             html_head, html_end = content.split('/*注意看这是分割线*/')
-        f = open(filename, 'w', encoding='utf-8')
+        chunk_mode = HTML_CHUNK_MODE
+        if chunk_mode == 'auto':
+            # 消息较多时浏览器一次性解析整个聊天记录会很卡，改为分卷按需加载
+            chunk_mode = 'count' if total > HTML_CHUNK_SIZE * 10 else ''
+        f = open(filename, 'w', encoding='utf-8', buffering=WRITE_BUFFER_SIZE)
         html_head = html_head.replace("<title>出错了</title>", f"<title>{self.contact.remark}</title>")
         html_head = html_head.replace("<p id=\"title\">出错了</p>", f"<p id=\"title\">{self.contact.remark}</p>")
         f.write(html_head)
-        self.rangeSignal.emit(len(messages))
+        doc = ChunkWriter(origin_path, mode=chunk_mode) if chunk_mode else f
+        self.is_chatroom = 1 if self.contact.is_chatroom else 0
+        self.sender_cache = {}
+        self.rangeSignal.emit(total)
         for index, message in enumerate(messages):
             type_ = message[2]
-            sub_type = message[3]
-            timestamp = message[5]
             if (type_ == 3 and self.message_types.get(3)) or (type_ == 34 and self.message_types.get(34)) or (
                     type_ == 47 and self.message_types.get(47)):
                 pass
             else:
                 self.progressSignal.emit(1)
-
-            if type_ == 1 and self.message_types.get(type_):
-                self.text(f, message)
-            elif type_ == 3 and self.message_types.get(type_):
-                self.image(f, message)
-            elif type_ == 34 and self.message_types.get(type_):
-                self.audio(f, message)
-            elif type_ == 43 and self.message_types.get(type_):
-                self.video(f, message)
-            elif type_ == 47 and self.message_types.get(type_):
-                self.emoji(f, message)
-            elif type_ == 10000 and self.message_types.get(type_):
-                self.system_msg(f, message)
-            elif type_ == 49 and sub_type == 57 and self.message_types.get(1):
-                self.refermsg(f, message)
-            elif type_ == 49 and sub_type == 6 and self.message_types.get(4906):
-                self.file(f, message)
-            elif type_ == 49 and sub_type == 3 and self.message_types.get(4903):
-                self.music_share(f, message)
-            elif type_ == 49 and sub_type == 5 and self.message_types.get(4905):
-                self.share_card(f, message)
-            elif type_ == 49 and sub_type == 2000 and self.message_types.get(492000):
-                self.transfer(f, message)
-            elif type_ == 50 and self.message_types.get(50):
-                self.call(f, message)
+            if chunk_mode:
+                doc.begin(message)
+            self.write_message(doc, message)
             if index % 2000 == 0:
-                print(f"【导出 HTML {self.contact.remark}】{index}/{len(messages)}")
+                print(f"【导出 HTML {self.contact.remark}】{index}/{total}")
+        if chunk_mode:
+            doc.close()
+            chunk_index = json.dumps(doc.index(), ensure_ascii=False)
+            html_end = html_end.replace('const chatChunkIndex = null;', f'const chatChunkIndex = {chunk_index};', 1)
         f.write(html_end)
         f.close()
-        print(f"【完成导出 HTML {self.contact.remark}】{len(messages)}")
+        print(f"【完成导出 HTML {self.contact.remark}】{total}")
         self.count_finish_num(1)
 
     def count_finish_num(self, num):
@@ -386,17 +487,14 @@ class OutputMedia(QThread):
     def run(self):
         origin_path = os.path.join(os.getcwd(), OUTPUT_DIR, '聊天记录', self.contact.remark)
         messages = msg_db.get_messages_by_type(self.contact.wxid, 34)
-        for message in messages:
-            is_send = message[4]
-            msgSvrId = message[9]
-            try:
-                audio_path = media_msg_db.get_audio(
-                    msgSvrId, output_path=origin_path + "/voice"
-                )
-            except:
-                logger.error(traceback.format_exc())
-            finally:
-                self.progressSignal.emit(1)
+        try:
+            media_msg_db.get_audios(
+                [message[9] for message in messages],
+                output_path=os.path.join(origin_path, 'voice'),
+                callback=lambda reserved0, audio_path: self.progressSignal.emit(1)
+            )
+        except:
+            logger.error(traceback.format_exc())
         self.okSingal.emit(34)
 
 
@@ -452,6 +550,7 @@ class OutputImage(QThread):
     def run(self):
         origin_path = os.path.join(os.getcwd(), OUTPUT_DIR, '聊天记录', self.contact.remark)
         messages = msg_db.get_messages_by_type(self.contact.wxid, 3)
+        hard_link_db.resolve_messages(messages)
         base_path = os.path.join(OUTPUT_DIR, '聊天记录', self.contact.remark, 'image')
         for message in messages:
             str_content = message[7]
@@ -461,11 +560,11 @@ class OutputImage(QThread):
                 image_path = hard_link_db.get_image(
                     str_content, BytesExtra, thumb=False
                 )
-                if not os.path.exists(os.path.join(Me().wx_dir, image_path)):
+                if not file_index.exists(os.path.join(Me().wx_dir, image_path)):
                     image_thumb_path = hard_link_db.get_image(
                         str_content, BytesExtra, thumb=True
                     )
-                    if not os.path.exists(os.path.join(Me().wx_dir, image_thumb_path)):
+                    if not file_index.exists(os.path.join(Me().wx_dir, image_thumb_path)):
                         continue
                     image_path = image_thumb_path
                 image_path = get_image(
@@ -501,11 +600,11 @@ class OutputImageChild(QThread):
                 image_path = hard_link_db.get_image(
                     str_content, BytesExtra, thumb=False
                 )
-                if not os.path.exists(os.path.join(Me().wx_dir, image_path)):
+                if not file_index.exists(os.path.join(Me().wx_dir, image_path)):
                     image_thumb_path = hard_link_db.get_image(
                         str_content, BytesExtra, thumb=True
                     )
-                    if not os.path.exists(os.path.join(Me().wx_dir, image_thumb_path)):
+                    if not file_index.exists(os.path.join(Me().wx_dir, image_thumb_path)):
                         continue
                     image_path = image_thumb_path
                 image_path = get_image(
@@ -1,8 +1,16 @@
+import hashlib
 import json
 import random
 import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+
+from PyQt5.QtCore import pyqtSignal, QThread
 
 from app.DataBase import msg_db
+from app.config import OUTPUT_DIR, JSON_EXPORT_MODE, JSON_SESSION_INTERVAL, JSON_DEV_RATIO, JSON_EXPORT_WORKERS
+from app.log import logger
 from app.person import Me
 from .exporter import ExporterBase
 
@@ -15,29 +23,19 @@ def merge_content(conversions_list) -> list:
     """
     merged_data = []
     current_role = None
-    current_content = ""
-    str_time = ''
+    current_content = []
     for item in conversions_list:
-        if 'str_time' in item:
-            str_time = item['str_time']
-        else:
-            str_time = ''
-        if current_role is None:
-            current_role = item["role"]
-            current_content = item["content"]
-        elif current_role == item["role"]:
-            current_content += "\n" + item["content"]
+        if current_role == item["role"]:
+            current_content.append(item["content"])
         else:
-            # merged_data.append({"role": current_role, "content": current_content, 'str_time': str_time})
-            merged_data.append({"role": current_role, "content": current_content})
+            if current_role is not None:
+                merged_data.append({"role": current_role, "content": "\n".join(current_content)})
             current_role = item["role"]
-            current_content = item["content"]
-            str_time = item.get('str_time')
+            current_content = [item["content"]]
 
     # 处理最后一组
     if current_role is not None:
-        # merged_data.append({"role": current_role, "content": current_content,'str_time': str_time})
-        merged_data.append({"role": current_role, "content": current_content})
+        merged_data.append({"role": current_role, "content": "\n".join(current_content)})
     return merged_data
 
 
@@ -50,8 +48,14 @@ def system_prompt():
     return system
 
 
-def message_to_conversion(group):
-    conversions = [system_prompt()]
+def message_to_conversion(group, system=None):
+    """
+    一段对话转换成训练数据，去掉开头自己发的和结尾对方发的消息
+    @param group: 消息列表
+    @param system: 系统提示，默认是 system_prompt()
+    @return: 合并后的对话，没有有效对话时返回空列表
+    """
+    conversions = [system or system_prompt()]
     while len(group) and group[-1][4] == 0:
         group.pop()
     for message in group:
@@ -68,13 +72,121 @@ def message_to_conversion(group):
                 "role": "user",
                 "content": message[7]
             }
-        json_msg['str_time'] = message[8]
         conversions.append(json_msg)
     if len(conversions) == 1:
         return []
     return merge_content(conversions)
 
 
+def iter_sessions(messages, max_diff_seconds=JSON_SESSION_INTERVAL):
+    """
+    一次遍历把消息切分成一段段对话，每段结束时立即返回，不需要把全部消息读进内存
+    每段从对方发的消息开始，相邻消息间隔不超过 max_diff_seconds，
+    超过间隔后紧跟着的自己发的消息（回复）也算在这一段里
+    @param messages: 按时间排序的消息迭代器
+    @param max_diff_seconds:
+    @return: 消息列表的生成器
+    """
+    group = None
+    replying = False  # 已经超过间隔，只接收自己发的消息
+    for message in messages:
+        if group is None:
+            if message[4]:  # 开头自己发的消息丢弃
+                continue
+            group = [message]
+            replying = False
+            continue
+        if not replying and message[5] - group[-1][5] <= max_diff_seconds:
+            group.append(message)
+            continue
+        if message[4]:
+            replying = True
+            group.append(message)
+            continue
+        yield group
+        group = [message]
+        replying = False
+    if group is not None:
+        yield group
+
+
+def iter_conversations(messages, max_diff_seconds=JSON_SESSION_INTERVAL, system=None):
+    """
+    @return: (这段对话第一条消息的时间戳, 对话) 的生成器，没有有效对话的段落会跳过
+    """
+    for group in iter_sessions(messages, max_diff_seconds):
+        timestamp = group[0][5]
+        conversations = message_to_conversion(group, system)
+        if conversations:
+            yield timestamp, conversations
+
+
+def is_dev(key, dev_ratio=JSON_DEV_RATIO) -> bool:
+    """
+    按 key 的哈希决定是否划入验证集，同一段对话每次导出、在哪个进程导出结果都一样
+    @param key: 比如 wxid:时间戳
+    @param dev_ratio:
+    @return:
+    """
+    value = int(hashlib.md5(key.encode('utf-8')).hexdigest()[:8], 16)
+    return value < dev_ratio * 0x100000000
+
+
+def export_conversations(wxid, filename, time_range=None, mode=JSON_EXPORT_MODE,
+                         max_diff_seconds=JSON_SESSION_INTERVAL, dev_ratio=JSON_DEV_RATIO, system=None):
+    """
+    导出一个联系人的训练数据，分成 {filename}_train 和 {filename}_dev 两个文件
+    jsonl 模式每段对话结束就写入一行；json 模式写成列表（打乱顺序，随机种子固定）
+    @param wxid:
+    @param filename: 输出文件路径（不含后缀）
+    @param time_range:
+    @param mode: 'json' / 'jsonl'
+    @param max_diff_seconds: 对话切分的间隔
+    @param dev_ratio: 验证集比例
+    @param system: 系统提示
+    @return: (训练集条数, 验证集条数)
+    """
+    messages = msg_db.get_messages_iter(wxid, time_range=time_range, type_=1)
+    conversations = iter_conversations(messages, max_diff_seconds, system)
+    train_num = dev_num = 0
+    if mode == 'jsonl':
+        with open(f'{filename}_train.jsonl', 'w', encoding='utf-8') as train_file, \
+                open(f'{filename}_dev.jsonl', 'w', encoding='utf-8') as dev_file:
+            for timestamp, conversation in conversations:
+                line = json.dumps({'conversations': conversation}, ensure_ascii=False)
+                if is_dev(f'{wxid}:{timestamp}', dev_ratio):
+                    dev_file.write(line + '\n')
+                    dev_num += 1
+                else:
+                    train_file.write(line + '\n')
+                    train_num += 1
+        return train_num, dev_num
+    train_data = []
+    dev_data = []
+    for timestamp, conversation in conversations:
+        data = dev_data if is_dev(f'{wxid}:{timestamp}', dev_ratio) else train_data
+        data.append({'conversations': conversation})
+    rand = random.Random(wxid)
+    rand.shuffle(train_data)
+    rand.shuffle(dev_data)
+    with open(f'{filename}_train.json', "w", encoding="utf-8") as f:
+        json.dump(train_data, f, ensure_ascii=False, indent=4)
+    with open(f'{filename}_dev.json', "w", encoding="utf-8") as f:
+        json.dump(dev_data, f, ensure_ascii=False, indent=4)
+    return len(train_data), len(dev_data)
+
+
+def export_contact(task):
+    """
+    子进程里执行的导出任务
+    @param task: export_conversations 的参数（dict）
+    @return: (wxid, 训练集条数, 验证集条数)
+    """
+    os.makedirs(os.path.dirname(task['filename']), exist_ok=True)
+    train_num, dev_num = export_conversations(**task)
+    return task['wxid'], train_num, dev_num
+
+
 class JsonExporter(ExporterBase):
     def split_by_time(self, length=300):
         messages = msg_db.get_messages_by_type(self.contact.wxid, type_=1, time_range=self.time_range)
@@ -134,28 +246,8 @@ class JsonExporter(ExporterBase):
 
     def split_by_intervals(self, max_diff_seconds=300):
         messages = msg_db.get_messages_by_type(self.contact.wxid, type_=1, time_range=self.time_range)
-        res = []
-        i = 0
-        current_group = []
-        while i < len(messages):
-            message = messages[i]
-            timestamp = message[5]
-            is_send = message[4]
-            while is_send and i + 1 < len(messages):
-                i += 1
-                message = messages[i]
-                is_send = message[4]
-            current_group = [messages[i]]
-            i += 1
-            while i < len(messages) and messages[i][5] - current_group[-1][5] <= max_diff_seconds:
-                current_group.append(messages[i])
-                i += 1
-            while i < len(messages) and messages[i][4]:
-                current_group.append(messages[i])
-                i += 1
-            res.append(current_group)
         res_ = []
-        for group in res:
+        for group in iter_sessions(messages, max_diff_seconds):
             conversations = message_to_conversion(group)
             if conversations:
                 res_.append({
@@ -168,26 +260,40 @@ class JsonExporter(ExporterBase):
         origin_path = self.origin_path
         os.makedirs(origin_path, exist_ok=True)
         filename = os.path.join(origin_path, f"{self.contact.remark}")
+        train_num, dev_num = export_conversations(self.contact.wxid, filename, time_range=self.time_range,
+                                                  system=system_prompt())
+        print(f"【完成导出 json {self.contact.remark}】训练集 {train_num} 验证集 {dev_num}")
+        self.okSignal.emit(1)
 
-        # res = self.split_by_time()
-        res = self.split_by_intervals(60)
-        # 打乱列表顺序
-        random.shuffle(res)
+    def run(self):
+        self.to_json()
 
-        # 计算切分比例
-        split_ratio = 0.2  # 20% for the second list
 
-        # 计算切分点
-        split_point = int(len(res) * split_ratio)
+class JsonBatchExporter(QThread):
+    """
+    批量导出训练数据，按联系人分给多个进程，每导出完一个联系人发送一次 okSignal
+    """
+    okSignal = pyqtSignal(int)
 
-        # 分割列表
-        train_data = res[split_point:]
-        dev_data = res[:split_point]
-        with open(f'{filename}_train.json', "w", encoding="utf-8") as f:
-            json.dump(train_data, f, ensure_ascii=False, indent=4)
-        with open(f'{filename}_dev.json', "w", encoding="utf-8") as f:
-            json.dump(dev_data, f, ensure_ascii=False, indent=4)
-        self.okSignal.emit(1)
+    def __init__(self, contacts, time_range=None, workers=JSON_EXPORT_WORKERS, parent=None):
+        super().__init__(parent)
+        self.contacts = contacts
+        self.time_range = time_range
+        self.workers = workers
 
     def run(self):
-        self.to_json()
+        system = system_prompt()
+        tasks = []
+        for contact in self.contacts:
+            filename = os.path.join(os.getcwd(), OUTPUT_DIR, '聊天记录', contact.remark, contact.remark)
+            tasks.append({'wxid': contact.wxid, 'filename': filename, 'time_range': self.time_range, 'system': system})
+        # spawn 启动的子进程只导入需要的模块，不会带上界面线程和数据库连接的状态
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=get_context('spawn')) as executor:
+            futures = [executor.submit(export_contact, task) for task in tasks]
+            for future in as_completed(futures):
+                try:
+                    wxid, train_num, dev_num = future.result()
+                    print(f"【完成导出 json {wxid}】训练集 {train_num} 验证集 {dev_num}")
+                except:
+                    logger.error(traceback.format_exc())
+                self.okSignal.emit(1)
@@ -0,0 +1,124 @@
+"""
+把全部聊天记录导出成列式存储文件（Parquet / Arrow IPC）
+
+直接从 MSG 表的游标分批读取，每批写成一个 row group，内存里只有一批消息。
+talker 和 sender 用全局递增的字典编码，同一个 wxid 在整个文件里只存一次。
+"""
+import os
+
+from app.DataBase import msg_db
+from app.person import Me
+from app.util.protocbuf import get_sender as get_bytes_extra_sender
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+ROW_GROUP_SIZE = 50000  # 每个 row group 的消息条数
+FORMATS = {'.parquet', '.arrow'}
+
+
+def get_schema():
+    return pa.schema([
+        ('local_id', pa.int64()),
+        ('talker_id', pa.int64()),
+        ('type', pa.int32()),
+        ('sub_type', pa.int32()),
+        ('is_sender', pa.bool_()),
+        ('create_time', pa.timestamp('s', tz='UTC')),
+        ('status', pa.int32()),
+        ('str_content', pa.string()),
+        ('msg_svr_id', pa.int64()),
+        ('talker', pa.dictionary(pa.int32(), pa.string())),
+        ('sender', pa.dictionary(pa.int32(), pa.string())),
+    ])
+
+
+class DictionaryEncoder:
+    """
+    跨批次共用的字典编码
+    字典只会在末尾追加，写 Arrow IPC 时每批只需要输出增量（delta）
+    """
+
+    def __init__(self):
+        self.values = []
+        self.index = {}
+
+    def encode(self, column):
+        indices = []
+        for value in column:
+            i = self.index.get(value)
+            if i is None:
+                i = len(self.values)
+                self.index[value] = i
+                self.values.append(value)
+            indices.append(i)
+        return pa.DictionaryArray.from_arrays(
+            pa.array(indices, type=pa.int32()),
+            pa.array(self.values, type=pa.string())
+        )
+
+
+def get_sender(row, my_wxid) -> str:
+    """
+    消息发送人的 wxid：自己发的就是自己，私聊是对方，群聊从 BytesExtra 里解析
+    @param row: get_messages_all 的一行
+    @param my_wxid:
+    @return:
+    """
+    if row[4] == 1:
+        return my_wxid
+    talker = row[11]
+    if not talker.endswith('@chatroom'):
+        return talker
+    return get_bytes_extra_sender(row[10])
+
+
+def export_messages(filename, time_range=None, callback=None) -> int:
+    """
+    导出全部聊天记录
+    @param filename: 后缀为 .parquet 时写 Parquet（zstd 压缩），.arrow 时写 Arrow IPC 文件
+    @param time_range:
+    @param callback: 每写完一批调用一次 callback(本批条数)
+    @return: 导出的消息条数
+    """
+    if pa is None:
+        raise ImportError('导出 Parquet/Arrow 需要安装 pyarrow')
+    suffix = os.path.splitext(filename)[1].lower()
+    if suffix not in FORMATS:
+        raise ValueError(f'不支持的文件格式:{suffix}')
+    schema = get_schema()
+    my_wxid = Me().wxid
+    talkers = DictionaryEncoder()
+    senders = DictionaryEncoder()
+    if suffix == '.parquet':
+        writer = pq.ParquetWriter(filename, schema, compression='zstd')
+    else:
+        writer = pa.ipc.new_file(filename, schema, options=pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True))
+    total = 0
+    try:
+        for rows in msg_db.get_messages_all_iter(time_range=time_range, batch_size=ROW_GROUP_SIZE):
+            columns = list(zip(*rows))
+            batch = pa.record_batch([
+                pa.array(columns[0], type=pa.int64()),
+                pa.array(columns[1], type=pa.int64()),
+                pa.array(columns[2], type=pa.int32()),
+                pa.array(columns[3], type=pa.int32()),
+                pa.array([is_sender == 1 for is_sender in columns[4]], type=pa.bool_()),
+                pa.array(columns[5], type=pa.timestamp('s', tz='UTC')),
+                pa.array(columns[6], type=pa.int32()),
+                pa.array(columns[7], type=pa.string()),
+                pa.array(columns[9], type=pa.int64()),
+                talkers.encode(columns[11]),
+                senders.encode([get_sender(row, my_wxid) for row in rows]),
+            ], schema=schema)
+            writer.write_batch(batch)
+            total += len(rows)
+            if callback:
+                callback(len(rows))
+    finally:
+        writer.close()
+    return total
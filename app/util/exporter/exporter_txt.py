@@ -57,7 +57,7 @@ class TxtExporter(ExporterBase):
         """
         str_time = message[8]
         is_send = message[4]
-        content = parser_reply(message[11])
+        content = parser_reply(message[11], message[9])
         refer_msg = content.get('refer')
         display_name = self.get_display_name(is_send, message)
         if refer_msg:
@@ -98,7 +98,7 @@ class TxtExporter(ExporterBase):
         bytesExtra = message[10]
         compress_content_ = message[11]
         str_time = message[8]
-        card_data = share_card(bytesExtra, compress_content_)
+        card_data = share_card(bytesExtra, compress_content_, message[9])
         display_name = self.get_display_name(is_send, message)
         doc.write(
             f'''{str_time} {display_name}
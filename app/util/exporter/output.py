@@ -1,27 +1,25 @@
 import csv
 import os
-import time
 import traceback
 from typing import List
 
-import docx
 from PyQt5.QtCore import pyqtSignal, QThread
 from PyQt5.QtWidgets import QFileDialog
-from docx.oxml.ns import qn
-from docxcompose.composer import Composer
 
 from app.util.exporter.exporter_ai_txt import AiTxtExporter
 from app.util.exporter.exporter_csv import CSVExporter
 from app.util.exporter.exporter_docx import DocxExporter
 from app.util.exporter.exporter_html import HtmlExporter
-from app.util.exporter.exporter_json import JsonExporter
+from app.util.exporter.exporter_json import JsonExporter, JsonBatchExporter
+from app.util.exporter import exporter_parquet
 from app.util.exporter.exporter_txt import TxtExporter
 from app.DataBase.hard_link import decodeExtraBuf
-from app.config import OUTPUT_DIR
+from app.config import OUTPUT_DIR, JSON_EXPORT_WORKERS
 from app.DataBase.package_msg import PackageMsg
 from app.DataBase import media_msg_db, hard_link_db, micro_msg_db, msg_db
 from app.log import logger
 from app.person import Me
+from app.util import file_index
 from app.util.image import get_image
 
 os.makedirs(os.path.join(OUTPUT_DIR, '聊天记录'), exist_ok=True)
@@ -35,6 +33,7 @@ class Output(QThread):
     progressSignal = pyqtSignal(int)
     rangeSignal = pyqtSignal(int)
     okSignal = pyqtSignal(int)
+    errorSignal = pyqtSignal(str)
     batchOkSignal = pyqtSignal(int)
     nowContact = pyqtSignal(str)
     i = 1
@@ -46,6 +45,7 @@ class Output(QThread):
     TXT = 5
     JSON = 6
     AI_TXT = 7
+    PARQUET_ALL = 8
     Batch = 10086
 
     def __init__(self, contact, type_=DOCX, message_types={}, sub_type=[], time_range=None, parent=None):
@@ -99,13 +99,31 @@ class Output(QThread):
                    'StrTime', 'Remark', 'NickName', 'Sender']
 
         packagemsg = PackageMsg()
-        messages = packagemsg.get_package_message_all()
         # 写入CSV文件
         with open(filename, mode='w', newline='', encoding='utf-8-sig') as file:
             writer = csv.writer(file)
             writer.writerow(columns)
-            # 写入数据
-            writer.writerows(messages)
+            # 边读边写，内存里只有一批数据
+            for messages in packagemsg.get_package_message_iter():
+                writer.writerows(messages)
+        self.okSignal.emit(1)
+
+    def to_parquet_all(self):
+        """
+        导出全部聊天记录到 Parquet / Arrow，供数据分析工具直接读取
+        @return:
+        """
+        filename = QFileDialog.getSaveFileName(None, "save file", os.path.join(os.getcwd(), 'messages.parquet'),
+                                               "parquet files (*.parquet);;arrow files (*.arrow)")
+        if not filename[0]:
+            return
+        self.startSignal.emit(1)
+        try:
+            exporter_parquet.export_messages(filename[0])
+        except Exception as e:
+            logger.error(traceback.format_exc())
+            self.errorSignal.emit(str(e))
+            return
         self.okSignal.emit(1)
 
     def contact_to_csv(self):
@@ -151,9 +169,17 @@ class Output(QThread):
         self.batch_num_total = len(self.contact) * len(self.sub_type)
         self.batch_num = 0
         self.rangeSignal.emit(self.batch_num_total)
+        sub_type = self.sub_type
+        if self.JSON in sub_type and JSON_EXPORT_WORKERS > 1 and len(self.contact) > 1:
+            # 训练数据按联系人分给多个进程导出
+            sub_type = [type_ for type_ in sub_type if type_ != self.JSON]
+            Child = JsonBatchExporter(self.contact, time_range=self.time_range)
+            self.children.append(Child)
+            Child.okSignal.connect(self.batch_finish_one)
+            Child.start()
         for contact in self.contact:
             # print('联系人', contact.remark)
-            for type_ in self.sub_type:
+            for type_ in sub_type:
                 # print('导出类型', type_)
                 if type_ == self.DOCX:
                     self.to_docx(contact, self.message_types, True)
@@ -176,47 +202,13 @@ class Output(QThread):
         if self.batch_num == self.batch_num_total:
             self.okSignal.emit(1)
 
-    def merge_docx(self, n):
-        conRemark = self.contact.remark
-        origin_path = os.path.join(os.getcwd(), OUTPUT_DIR, '聊天记录', conRemark)
-        filename = f"{origin_path}/{conRemark}_{n}.docx"
-        if n == 10086:
-            # self.document.append(self.document)
-            file = os.path.join(origin_path, f'{conRemark}.docx')
-            try:
-                self.document.save(file)
-            except PermissionError:
-                file = file[:-5] + f'{time.time()}' + '.docx'
-                self.document.save(file)
-            self.okSignal.emit(1)
-            return
-        doc = docx.Document(filename)
-        self.document.append(doc)
-        os.remove(filename)
-        if n % 50 == 0:
-            # self.document.append(self.document)
-            file = os.path.join(origin_path, f'{conRemark}-{n // 50}.docx')
-            try:
-                self.document.save(file)
-            except PermissionError:
-                file = file[:-5] + f'{time.time()}' + '.docx'
-                self.document.save(file)
-            doc = docx.Document()
-            doc.styles["Normal"].font.name = "Cambria"
-            doc.styles["Normal"]._element.rPr.rFonts.set(qn("w:eastAsia"), "宋体")
-            self.document = Composer(doc)
-
     def to_docx(self, contact, message_types, is_batch=False):
-        doc = docx.Document()
-        doc.styles["Normal"].font.name = "Cambria"
-        doc.styles["Normal"]._element.rPr.rFonts.set(qn("w:eastAsia"), "宋体")
-        self.document = Composer(doc)
         Child = DocxExporter(contact, type_=self.DOCX, message_types=message_types, time_range=self.time_range)
         self.children.append(Child)
         Child.progressSignal.connect(self.progress)
         if not is_batch:
             Child.rangeSignal.connect(self.rangeSignal)
-        Child.okSignal.connect(self.merge_docx if not is_batch else self.batch_finish_one)
+        Child.okSignal.connect(self.okSignal if not is_batch else self.batch_finish_one)
         Child.start()
 
     def to_json(self, contact, message_types, is_batch=False):
@@ -296,6 +288,8 @@ class Output(QThread):
             self.to_csv_all()
         elif self.output_type == self.CONTACT_CSV:
             self.contact_to_csv()
+        elif self.output_type == self.PARQUET_ALL:
+            self.to_parquet_all()
         elif self.output_type == self.TXT:
             self.to_txt(self.contact, self.message_types)
         elif self.output_type == self.AI_TXT:
@@ -343,15 +337,14 @@ class OutputMedia(QThread):
     def run(self):
         origin_path = os.path.join(os.getcwd(), OUTPUT_DIR, '聊天记录', self.contact.remark)
         messages = msg_db.get_messages_by_type(self.contact.wxid, 34, time_range=self.time_range)
-        for message in messages:
-            is_send = message[4]
-            msgSvrId = message[9]
-            try:
-                audio_path = media_msg_db.get_audio(msgSvrId, output_path=origin_path + "/voice")
-            except:
-                logger.error(traceback.format_exc())
-            finally:
-                self.progressSignal.emit(1)
+        try:
+            media_msg_db.get_audios(
+                [message[9] for message in messages],
+                output_path=os.path.join(origin_path, 'voice'),
+                callback=lambda reserved0, audio_path: self.progressSignal.emit(1)
+            )
+        except:
+            logger.error(traceback.format_exc())
         self.okSingal.emit(34)
 
 
@@ -407,6 +400,7 @@ class OutputImage(QThread):
     def run(self):
         origin_path = os.path.join(os.getcwd(), OUTPUT_DIR, '聊天记录', self.contact.remark)
         messages = msg_db.get_messages_by_type(self.contact.wxid, 3, time_range=self.time_range)
+        hard_link_db.resolve_messages(messages)
         base_path = os.path.join(OUTPUT_DIR, '聊天记录', self.contact.remark, 'image')
         for message in messages:
             str_content = message[7]
@@ -444,9 +438,9 @@ class OutputImageChild(QThread):
             timestamp = message[5]
             try:
                 image_path = hard_link_db.get_image(str_content, BytesExtra, thumb=False)
-                if not os.path.exists(os.path.join(Me().wx_dir, image_path)):
+                if not file_index.exists(os.path.join(Me().wx_dir, image_path)):
                     image_thumb_path = hard_link_db.get_image(str_content, BytesExtra, thumb=True)
-                    if not os.path.exists(os.path.join(Me().wx_dir, image_thumb_path)):
+                    if not file_index.exists(os.path.join(Me().wx_dir, image_thumb_path)):
                         continue
                     image_path = image_thumb_path
                 image_path = get_image(image_path, base_path=f'/data/聊天记录/{self.contact.remark}/image')
@@ -0,0 +1,218 @@
+"""
+微信 FileStorage 目录的文件索引
+
+导出时每张图片、缩略图、视频、文件、卡片缩略图都要 os.path.exists 判断一次，
+还经常要试好几个候选路径，微信目录在网络盘上时这些 stat 会非常慢。
+这里用 os.scandir 把 FileStorage 下的 MsgAttach、Video、File、Cache 扫描一遍，
+记下每个目录的 mtime、文件名和大小，之后的存在性判断都在内存里完成。
+索引保存在缓存目录里，下次启动时只重新扫描 mtime 变化了的目录（目录 mtime 在增删文件时才会变）。
+索引里找不到的文件会再看一次所在目录的 mtime，建立索引之后微信新写入的文件也能找到。
+不在这几个目录下的路径、以及索引里没有的目录，仍然直接访问文件系统。
+"""
+import hashlib
+import json
+import os
+import threading
+import traceback
+
+from app.config import CACHE_DIR
+from app.log import logger
+from app.person import Me
+
+INDEX_VERSION = 1
+INDEX_DIRS = ('MsgAttach', 'Video', 'File', 'Cache')  # FileStorage 下需要索引的目录
+
+
+def normalize(path) -> str:
+    """
+    统一成绝对路径，微信记录的路径是 \\ 分隔的
+    """
+    if os.sep != '\\':
+        path = path.replace('\\', os.sep)
+    return os.path.normcase(os.path.abspath(path))
+
+
+class FileStorageIndex:
+    def __init__(self, cache_dir=CACHE_DIR):
+        self.cache_dir = cache_dir
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()  # 同一时间只有一个线程扫描
+        self.root = None  # FileStorage 的绝对路径（normcase）
+        self.dirs = {}  # 相对 FileStorage 的目录 -> {'mtime': int, 'files': {文件名: 大小}, 'subdirs': [目录名]}
+
+    def index_path(self, root) -> str:
+        name = hashlib.md5(root.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f'file_index_{name}.json')
+
+    def load(self, root) -> dict:
+        index_path = self.index_path(root)
+        if not os.path.exists(index_path):
+            return {}
+        try:
+            with open(index_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except Exception:
+            logger.error(traceback.format_exc())
+            return {}
+        if data.get('version') != INDEX_VERSION or data.get('root') != root:
+            return {}
+        return data.get('dirs', {})
+
+    def save(self):
+        with self.lock:
+            if self.root is None:
+                return
+            data = {'version': INDEX_VERSION, 'root': self.root, 'dirs': self.dirs}
+            index_path = self.index_path(self.root)
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                tmp_path = f'{index_path}.{threading.get_ident()}.tmp'
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+                os.replace(tmp_path, index_path)
+            except Exception:
+                logger.error(traceback.format_exc())
+
+    @staticmethod
+    def list_dir(abs_dir, mtime) -> dict | None:
+        """
+        @return: 目录的索引项，目录无法访问时返回 None
+        """
+        files = {}
+        subdirs = []
+        try:
+            with os.scandir(abs_dir) as it:
+                for item in it:
+                    try:
+                        if item.is_dir():
+                            subdirs.append(item.name)
+                        else:
+                            files[os.path.normcase(item.name)] = item.stat().st_size
+                    except OSError:
+                        continue
+        except OSError:
+            return None
+        return {'mtime': mtime, 'files': files, 'subdirs': subdirs}
+
+    @staticmethod
+    def scan(root, old_dirs) -> dict:
+        """
+        扫描 FileStorage，mtime 没变的目录沿用 old_dirs 里的内容，不再列出文件
+        @param root: FileStorage 的绝对路径
+        @param old_dirs: 上次的索引
+        @return: 新的索引
+        """
+        dirs = {}
+        stack = [name for name in INDEX_DIRS]
+        while stack:
+            rel_dir = stack.pop()
+            abs_dir = os.path.join(root, rel_dir)
+            try:
+                mtime = os.stat(abs_dir).st_mtime_ns
+            except OSError:
+                continue
+            key = os.path.normcase(rel_dir)
+            entry = old_dirs.get(key)
+            if entry is None or entry.get('mtime') != mtime:
+                entry = FileStorageIndex.list_dir(abs_dir, mtime)
+                if entry is None:
+                    continue
+            dirs[key] = entry
+            stack.extend(os.path.join(rel_dir, name) for name in entry['subdirs'])
+        return dirs
+
+    def refresh(self, wx_dir=None):
+        """
+        重新扫描（只列出 mtime 变化了的目录）并保存索引
+        @param wx_dir: 微信账号目录，默认是 Me().wx_dir
+        @return:
+        """
+        wx_dir = wx_dir if wx_dir is not None else Me().wx_dir
+        if not wx_dir:
+            return
+        root = normalize(os.path.join(wx_dir, 'FileStorage'))
+        with self.lock:
+            old_dirs = self.dirs if self.root == root else None
+        if old_dirs is None:
+            old_dirs = self.load(root)
+        dirs = self.scan(root, old_dirs)
+        with self.lock:
+            self.root = root
+            self.dirs = dirs
+        self.save()
+
+    def ensure(self):
+        """
+        第一次使用（或切换了账号）时建立索引
+        """
+        wx_dir = Me().wx_dir
+        if not wx_dir:
+            return False
+        root = normalize(os.path.join(wx_dir, 'FileStorage'))
+        if self.root != root:
+            with self.refresh_lock:
+                if self.root != root:
+                    self.refresh(wx_dir)
+        return True
+
+    def lookup(self, path):
+        """
+        @return: (是否在索引范围内, 文件大小)，在索引范围内但不存在时大小为 None
+        """
+        if not path or not self.ensure():
+            return False, None
+        path = normalize(path)
+        root = self.root
+        if not path.startswith(root + os.sep):
+            return False, None
+        rel_dir, name = os.path.split(path[len(root) + 1:])
+        entry = self.dirs.get(rel_dir)
+        if entry is None:  # 不在索引范围内，或者是扫描之后才新建的目录
+            return False, None
+        size = entry['files'].get(name)
+        if size is None:
+            if os.path.join(rel_dir, name) in self.dirs:  # 目录
+                return True, 0
+            # 建立索引之后微信可能又写入了文件，目录 mtime 变了就重新列出这个目录
+            entry = self.recheck(root, rel_dir, entry)
+            if entry is None:
+                return False, None
+            size = entry['files'].get(name)
+        return True, size
+
+    def recheck(self, root, rel_dir, entry) -> dict | None:
+        """
+        目录 mtime 没变时沿用原来的索引项，变了就重新列出
+        @return: 最新的索引项，目录无法访问时返回 None
+        """
+        abs_dir = os.path.join(root, rel_dir)
+        try:
+            mtime = os.stat(abs_dir).st_mtime_ns
+        except OSError:
+            return None
+        if mtime == entry['mtime']:
+            return entry
+        new_entry = self.list_dir(abs_dir, mtime)
+        if new_entry is None:
+            return None
+        with self.lock:
+            if self.root == root:
+                self.dirs[rel_dir] = new_entry
+        return new_entry
+
+    def exists(self, path) -> bool:
+        """
+        代替 os.path.exists，FileStorage 里的文件在内存里判断
+        """
+        indexed, size = self.lookup(path)
+        if indexed:
+            return size is not None
+        return bool(path) and os.path.exists(path)
+
+
+file_index = FileStorageIndex()
+
+
+def exists(path) -> bool:
+    return file_index.exists(path)
+
@@ -3,6 +3,7 @@ import traceback
 
 from app.log import logger
 from app.person import Me
+from app.util import file_index
 
 # 图片字节头信息，
 # [0][1]为jpg头信息，
@@ -45,7 +46,7 @@ def decode_dat(file_path, out_path) -> str:
     :param file_path: dat文件路径
     :return: 无
     """
-    if not os.path.exists(file_path):
+    if not file_index.exists(file_path):
         return None
     with open(file_path, 'rb') as file_in:
         data = file_in.read()
@@ -80,7 +81,7 @@ def decode_dat_path(file_path, out_path) -> str:
     :param file_path: dat文件路径
     :return: 无
     """
-    if not os.path.exists(file_path):
+    if not file_index.exists(file_path):
         return ''
     with open(file_path, 'rb') as file_in:
         data = file_in.read(2)
@@ -0,0 +1,246 @@
+"""
+音乐分享消息的链接解析
+
+get_website_name: 链接所在网站的名称（域名 -> 网页标题）
+get_audio_url: 音乐播放地址（dataurl -> 302 跳转后的真实地址）
+
+解析结果保存在缓存目录里，重复导出不会再访问网络。
+离线模式（config.OFFLINE_MODE）下只查缓存，缓存里没有就返回空字符串，不会卡在网络请求上。
+在线时可以先用 prefetch 把一批链接交给线程池并发解析，
+之后的 get_website_name / get_audio_url 直接取缓存或等待已经发出的请求。
+"""
+import json
+import os
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests
+from bs4 import BeautifulSoup
+
+from app import config
+from app.config import CACHE_DIR, NETWORK_TIMEOUT, NETWORK_WORKERS
+from app.log import logger
+
+CACHE_VERSION = 1
+SAVE_INTERVAL = 50  # 新增多少条解析结果写一次磁盘
+
+_local = threading.local()
+
+
+def get_session() -> requests.Session:
+    """
+    每个线程一个 Session，复用连接
+    """
+    session = getattr(_local, 'session', None)
+    if session is None:
+        session = requests.Session()
+        _local.session = session
+    return session
+
+
+def get_domain(url) -> str:
+    parsed_url = urlparse(url)
+    return f"{parsed_url.scheme}://{parsed_url.netloc}"
+
+
+def get_title(response) -> str:
+    soup = BeautifulSoup(response.content, "html.parser")
+    return soup.title.string.strip()
+
+
+def fetch_website_name(url) -> str | None:
+    """
+    访问网站获取名称
+    @param url:
+    @return: 网站名称，获取不到是空字符串；网络错误返回 None（不写入缓存，下次再试）
+    """
+    domain = get_domain(url)
+    session = get_session()
+    website_name = ""
+    try:
+        response = session.get(domain, allow_redirects=False, timeout=NETWORK_TIMEOUT)
+        if response.status_code == 200:
+            website_name = get_title(response)
+        elif response.status_code == 302:
+            domain = response.headers["Location"]
+            response = session.get(domain, allow_redirects=False, timeout=NETWORK_TIMEOUT)
+            website_name = get_title(response)
+        else:
+            response = session.get(url, allow_redirects=False, timeout=NETWORK_TIMEOUT)
+            if response.status_code == 200:
+                website_name = get_title(response)
+                index = website_name.find("-")
+                if index != -1:  # 如果找到了 "-"
+                    website_name = website_name[index + 1:].strip()
+    except requests.RequestException as e:
+        print(f"Get Website Info Error: {e}")
+        return None
+    except Exception as e:
+        print(f"Get Website Info Error: {e}")
+    return website_name
+
+
+def fetch_audio_url(url) -> str | None:
+    """
+    获取音乐的真实播放地址
+    @param url: 音乐分享消息里的 dataurl
+    @return: 播放地址，已失效是空字符串；网络错误返回 None（不写入缓存，下次再试）
+    """
+    path = ""
+    try:
+        response = get_session().get(url, allow_redirects=False, timeout=NETWORK_TIMEOUT)
+        # 检查响应状态码
+        if response.status_code == 302:
+            path = response.headers["Location"]
+        elif response.status_code == 200:
+            print("音乐文件已失效,url:" + url)
+        else:
+            print("音乐文件地址获取失败,url:" + url + ",状态码" + str(response.status_code))
+            return None
+    except requests.RequestException as e:
+        print(f"Get Audio Url Error: {e}")
+        return None
+    except Exception as e:
+        print(f"Get Audio Url Error: {e}")
+    return path
+
+
+class LinkResolver:
+    def __init__(self, cache_path=os.path.join(CACHE_DIR, 'link_cache.json')):
+        self.cache_path = cache_path
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.site_names = {}  # 域名 -> 网站名称
+        self.audio_urls = {}  # dataurl -> 播放地址
+        self.pending = {}  # (类型, key) -> Future
+        self.unsaved = 0
+        self.executor = None
+
+    def load(self):
+        if self.loaded:
+            return
+        self.loaded = True
+        if not os.path.exists(self.cache_path):
+            return
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except Exception:
+            logger.error(traceback.format_exc())
+            return
+        if data.get('version') != CACHE_VERSION:
+            return
+        self.site_names = data.get('site_names', {})
+        self.audio_urls = data.get('audio_urls', {})
+
+    def save(self):
+        with self.lock:
+            if not self.unsaved:
+                return
+            data = {
+                'version': CACHE_VERSION,
+                'site_names': dict(self.site_names),
+                'audio_urls': dict(self.audio_urls),
+            }
+            self.unsaved = 0
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            tmp_path = f'{self.cache_path}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+            os.replace(tmp_path, self.cache_path)
+        except Exception:
+            logger.error(traceback.format_exc())
+
+    def _submit(self, kind, key, fetch, url):
+        """
+        查缓存，没有就交给线程池（调用方持有 self.lock）
+        @return: (缓存结果, Future)，两者只有一个不是 None
+        """
+        cache = self.site_names if kind == 'site' else self.audio_urls
+        value = cache.get(key)
+        if value is not None:
+            return value, None
+        future = self.pending.get((kind, key))
+        if future is None:
+            if config.OFFLINE_MODE:
+                return '', None
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=NETWORK_WORKERS, thread_name_prefix='link_resolver')
+            future = self.executor.submit(self._resolve, kind, key, fetch, url)
+            self.pending[(kind, key)] = future
+        return None, future
+
+    def _resolve(self, kind, key, fetch, url):
+        value = fetch(url)
+        with self.lock:
+            self.pending.pop((kind, key), None)
+            if value is not None:
+                cache = self.site_names if kind == 'site' else self.audio_urls
+                cache[key] = value
+                self.unsaved += 1
+            need_save = self.unsaved >= SAVE_INTERVAL
+        if need_save:
+            self.save()
+        return value or ''
+
+    def _get(self, kind, key, fetch, url):
+        with self.lock:
+            self.load()
+            value, future = self._submit(kind, key, fetch, url)
+        if future is None:
+            return value
+        return future.result()
+
+    def get_website_name(self, url) -> str:
+        if not url:
+            return ''
+        return self._get('site', get_domain(url), fetch_website_name, url)
+
+    def get_audio_url(self, url) -> str:
+        if not url:
+            return ''
+        return self._get('audio', url, fetch_audio_url, url)
+
+    def prefetch(self, link_urls=(), audio_urls=()):
+        """
+        把一批链接交给线程池并发解析，不等待结果
+        @param link_urls: 需要网站名称的链接
+        @param audio_urls: 需要播放地址的 dataurl
+        @return:
+        """
+        with self.lock:
+            self.load()
+            for url in link_urls:
+                if url:
+                    self._submit('site', get_domain(url), fetch_website_name, url)
+            for url in audio_urls:
+                if url:
+                    self._submit('audio', url, fetch_audio_url, url)
+
+    def wait(self):
+        """
+        等待已经发出的请求全部完成并写入缓存
+        @return:
+        """
+        with self.lock:
+            futures = list(self.pending.values())
+        for future in futures:
+            try:
+                future.result()
+            except Exception:
+                logger.error(traceback.format_exc())
+        self.save()
+
+
+link_resolver = LinkResolver()
+
+
+def get_website_name(url) -> str:
+    return link_resolver.get_website_name(url)
+
+
+def get_audio_url(url) -> str:
+    return link_resolver.get_audio_url(url)
@@ -3,6 +3,7 @@ import traceback
 import shutil
 
 from app.log import log, logger
+from app.util.downloader import download_manager
 from app.util.protocbuf.msg_pb2 import MessageBytesExtra
 import requests
 from urllib.parse import urlparse, parse_qs
@@ -38,12 +39,8 @@ def get_music_path(url, file_title, output_path=root_path) -> str:
                 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/87.0.4280.40 Safari/537.36 Edg/87.0.664.24'
             }
             requests.packages.urllib3.disable_warnings()
-            response = requests.get(url,headers=header,verify=False)
-            if response.status_code == 200:
-                with open(music_path, 'wb') as f:
-                    f.write(response.content)
-            else:
-                music_path = ''
+            music_path = download_manager.download(url, music_path, headers=header, verify=False)
+            if music_path == '':
                 print("音乐" + file_name + "获取失败：请求地址：" + url)
         else:
             music_path = ''
@@ -1,5 +1,9 @@
 import os
-import winreg
+
+try:
+    import winreg
+except ImportError:  # 非 Windows（比如用 gunicorn 部署报告服务时）
+    winreg = None
 
 from app.person import Me
 from app.util import image
@@ -34,6 +38,8 @@ def mkdir(path):
 
 
 def wx_path():
+    if winreg is None:
+        return '.'
     try:
         is_w_dir = False
 
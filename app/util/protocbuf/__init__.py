@@ -1,3 +1,5 @@
 from .msg_pb2 import MessageBytesExtra
+from .bytes_extra import get_fields, get_field, get_sender, get_senders, get_thumb_path, get_file_path
 
-__all__ = ['MessageBytesExtra']
\ No newline at end of file
+__all__ = ['MessageBytesExtra', 'get_fields', 'get_field', 'get_sender', 'get_senders', 'get_thumb_path',
+           'get_file_path']
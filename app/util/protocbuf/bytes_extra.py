@@ -0,0 +1,195 @@
+"""
+MSG.BytesExtra 的快速解析
+
+BytesExtra 是 MessageBytesExtra（见 msg.proto）序列化后的结果，导出时通常只用到其中几个字段：
+    message2.field1 == 1: 发送人 wxid（群聊）
+    message2.field1 == 3: 缩略图路径（通话消息里是通话类型）
+    message2.field1 == 4: 原图/文件路径（通话消息里是通话时长）
+    message2.field1 == 7: msgsource（xml，通常是最长的一段，直接跳过）
+这里直接按 protobuf 编码格式遍历字节，只解码需要的字段，不创建 protobuf 对象，
+结果和 MessageBytesExtra().ParseFromString() 后遍历 message2 一致（同一字段出现多次时取最后一个）。
+"""
+
+SENDER = 1
+MD5 = 2
+THUMB_PATH = 3
+FILE_PATH = 4
+
+_MESSAGE2_TAG = 0x1a  # field 3, wire type 2
+_FIELD1_TAG = 0x08  # field 1, wire type 0
+_FIELD2_TAG = 0x12  # field 2, wire type 2
+_FIELD_SETS = {field: frozenset((field,)) for field in (SENDER, MD5, THUMB_PATH, FILE_PATH)}
+
+
+def _read_varint(buf, pos):
+    b = buf[pos]
+    pos += 1
+    if b < 0x80:
+        return b, pos
+    result = b & 0x7f
+    shift = 7
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _skip_field(buf, pos, wire_type):
+    if wire_type == 0:
+        return _read_varint(buf, pos)[1]
+    if wire_type == 2:
+        length, pos = _read_varint(buf, pos)
+        return pos + length
+    if wire_type == 1:
+        return pos + 8
+    if wire_type == 5:
+        return pos + 4
+    raise ValueError(f'不支持的 wire type:{wire_type}')
+
+
+def _parse_message2(buf, pos, end):
+    """
+    按通用方式解析一个 SubMessage2
+    @return: (field1, field2 起始位置, field2 结束位置)
+    """
+    field1 = 0
+    start = stop = end
+    while pos < end:
+        tag, pos = _read_varint(buf, pos)
+        if tag == _FIELD1_TAG:
+            field1, pos = _read_varint(buf, pos)
+        elif tag == _FIELD2_TAG:
+            length, pos = _read_varint(buf, pos)
+            start = pos
+            stop = pos = pos + length
+        else:
+            pos = _skip_field(buf, pos, tag & 7)
+    if pos != end:
+        raise ValueError('BytesExtra 数据不完整')
+    return field1, start, stop
+
+
+def _find_spans(buf, fields) -> dict:
+    """
+    遍历 BytesExtra，记录需要的字段在 buf 里的位置
+    微信写出的 SubMessage2 基本都是 08 <field1> 12 <长度> <field2>，这种情况直接按位置取，
+    其他情况再走通用解析；不需要的字段（比如很长的 msgsource）只跳过不解码
+    @param buf: BytesExtra
+    @param fields: 需要的 message2.field1
+    @return: {field1: (起始位置, 结束位置)}
+    """
+    spans = {}
+    pos = 0
+    n = len(buf)
+    while pos < n:
+        tag = buf[pos]
+        if tag >= 0x80 or tag & 7 != 2:  # 不是单字节 tag 的 length-delimited 字段
+            tag, pos = _read_varint(buf, pos)
+            pos = _skip_field(buf, pos, tag & 7)
+            continue
+        b = buf[pos + 1]
+        if b < 0x80:
+            length = b
+            pos += 2
+        else:
+            length, pos = _read_varint(buf, pos + 1)
+        end = pos + length
+        if end > n:
+            raise ValueError('BytesExtra 数据不完整')
+        if tag == _MESSAGE2_TAG:
+            if length >= 2 and buf[pos] == _FIELD1_TAG and buf[pos + 1] < 0x80:
+                field1 = buf[pos + 1]
+                if field1 in fields:
+                    if length == 2:  # field2 为空
+                        spans[field1] = (end, end)
+                    elif buf[pos + 2] == _FIELD2_TAG and buf[pos + 3] < 0x80 and pos + 4 + buf[pos + 3] == end:
+                        spans[field1] = (pos + 4, end)
+                    else:
+                        field1, start, stop = _parse_message2(buf, pos, end)
+                        spans[field1] = (start, stop)
+            else:
+                field1, start, stop = _parse_message2(buf, pos, end)
+                if field1 in fields:
+                    spans[field1] = (start, stop)
+        pos = end
+    return spans
+
+
+def get_fields(bytes_extra, fields=(SENDER, THUMB_PATH, FILE_PATH)) -> dict:
+    """
+    一次遍历取出多个字段
+    @param bytes_extra:
+    @param fields: 需要的 message2.field1
+    @return: {field1: field2}，不存在的字段不在结果里；数据损坏时返回空字典
+    """
+    result = {}
+    if not bytes_extra:
+        return result
+    try:
+        spans = _find_spans(bytes_extra, fields)
+    except (IndexError, ValueError):
+        return result
+    for field1, (start, stop) in spans.items():
+        result[field1] = str(bytes_extra[start:stop], 'utf-8', 'replace')
+    return result
+
+
+def get_field(bytes_extra, field, default='') -> str:
+    """
+    @param bytes_extra:
+    @param field: message2.field1
+    @param default:
+    @return: 对应的 field2
+    """
+    if not bytes_extra:
+        return default
+    try:
+        span = _find_spans(bytes_extra, _FIELD_SETS.get(field) or (field,)).get(field)
+    except (IndexError, ValueError):
+        return default
+    if span is None:
+        return default
+    return str(bytes_extra[span[0]:span[1]], 'utf-8', 'replace')
+
+
+def get_sender(bytes_extra) -> str:
+    """
+    群聊消息的发送人 wxid，原样返回（可能带有 :xxx 后缀）
+    @param bytes_extra:
+    @return: 不存在时返回空字符串
+    """
+    return get_field(bytes_extra, SENDER)
+
+
+def get_thumb_path(bytes_extra) -> str:
+    return get_field(bytes_extra, THUMB_PATH)
+
+
+def get_file_path(bytes_extra) -> str:
+    return get_field(bytes_extra, FILE_PATH)
+
+
+def get_senders(rows, index=10) -> list:
+    """
+    批量获取发送人 wxid
+    @param rows: 消息行（取 row[index] 作为 BytesExtra），也可以直接是 BytesExtra 列表（index=None）
+    @param index: BytesExtra 在行里的位置，get_messages 是 10，get_messages_all 也是 10
+    @return: 和 rows 一一对应的 wxid 列表
+    """
+    fields = _FIELD_SETS[SENDER]
+    senders = []
+    for row in rows:
+        bytes_extra = row if index is None else row[index]
+        wxid = ''
+        if bytes_extra:
+            try:
+                span = _find_spans(bytes_extra, fields).get(SENDER)
+            except (IndexError, ValueError):
+                span = None
+            if span is not None:
+                wxid = str(bytes_extra[span[0]:span[1]], 'utf-8', 'replace')
+        senders.append(wxid)
+    return senders
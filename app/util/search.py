@@ -1,14 +1,170 @@
+"""
+联系人搜索
+
+每个联系人的备注、昵称、微信号、拼音首字母（MicroMsg 里的 PYInitial、RemarkPYInitial）都写入两种索引：
+    前缀树：输入的是某个字段的开头时直接找到
+    n-gram 倒排表：输入在字段中间或者有错字时，按共同的单字/二元组个数选出候选
+只对候选计算编辑距离排序，不用每次输入都对全部联系人打分。
+"""
+from collections import Counter
 from typing import List
 
-from fuzzywuzzy import process
+try:
+    from Levenshtein import ratio as _levenshtein_ratio
+except ImportError:
+    _levenshtein_ratio = None
+
+MAX_KEY_LENGTH = 32  # 前缀树里每个字段最多保存的字数
+MAX_CANDIDATES = 50  # n-gram 召回后参与编辑距离排序的候选数
+MAX_POSTING = 1000  # 出现在太多联系人里的二元组不用来召回（还有别的二元组时）
+
+
+def normalize(text) -> str:
+    if not text:
+        return ''
+    return ''.join(text.lower().split()).replace('_', '')
+
+
+def grams(text) -> set:
+    """
+    单字和相邻二元组
+    """
+    return set(text) | {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+def edit_ratio(a, b) -> float:
+    """
+    编辑距离相似度，0 ~ 1
+    """
+    if _levenshtein_ratio is not None:
+        return _levenshtein_ratio(a, b)
+    if not a or not b:
+        return 0.0
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            cost = 0 if char_a == char_b else 2  # 和 Levenshtein.ratio 一样，替换算两次
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost))
+        previous = current
+    total = len(a) + len(b)
+    return (total - previous[-1]) / total
+
+
+def match_score(key, fields) -> float:
+    """
+    完全相同 > 开头相同 > 包含 > 编辑距离，前三种命中时不再计算编辑距离
+    """
+    score = 0
+    for field in fields:
+        if field == key:
+            return 100
+        if field.startswith(key):
+            score = max(score, 90 + 5 * len(key) / len(field))
+        elif key in field:
+            score = max(score, 80 + 5 * len(key) / len(field))
+    if score:
+        return score
+    return 75 * max((edit_ratio(key, field) for field in fields), default=0)
+
+
+class ContactSearchIndex:
+    def __init__(self):
+        self.fields: List[List[str]] = []  # 序号 -> 归一化后的字段
+        self.trie = {}  # 字 -> 子节点，子节点的 None 键是经过这个节点的序号集合
+        self.postings = {}  # 单字/二元组 -> 序号集合
+
+    def __len__(self):
+        return len(self.fields)
+
+    def add(self, *fields) -> int:
+        """
+        添加一个联系人，序号按添加顺序从 0 开始
+        @param fields: 备注、昵称、微信号、拼音首字母等，可以是空值
+        @return: 序号
+        """
+        index = len(self.fields)
+        keys = []
+        for field in fields:
+            key = normalize(field)
+            if key and key not in keys:
+                keys.append(key)
+        self.fields.append(keys)
+        for key in keys:
+            node = self.trie
+            for char in key[:MAX_KEY_LENGTH]:
+                node = node.setdefault(char, {})
+                node.setdefault(None, set()).add(index)
+            for gram in grams(key):
+                self.postings.setdefault(gram, set()).add(index)
+        return index
+
+    def add_contact(self, contact) -> int:
+        return self.add(contact.remark, contact.nickName, contact.alias,
+                        getattr(contact, 'remark_py_initial', None), getattr(contact, 'py_initial', None))
+
+    def prefix(self, key) -> set:
+        node = self.trie
+        for char in key[:MAX_KEY_LENGTH]:
+            node = node.get(char)
+            if node is None:
+                return set()
+        return node.get(None, set())
+
+    def candidates(self, key) -> set:
+        """
+        前缀命中的全部保留，再按共同的 n-gram 个数补充候选
+        """
+        result = set(self.prefix(key))
+        if len(key) > 1:
+            query_grams = {key[i:i + 2] for i in range(len(key) - 1)}
+        else:
+            query_grams = {key}
+        postings = sorted((self.postings[gram] for gram in query_grams if gram in self.postings), key=len)
+        if not postings:
+            return result
+        # 从最少见的二元组开始，常见的二元组（比如 wxid）只在没有别的可用时使用
+        postings = [posting for posting in postings if len(posting) <= MAX_POSTING] or postings[:1]
+        counter = Counter()
+        for posting in postings:
+            counter.update(posting)
+        for index, _ in counter.most_common(MAX_CANDIDATES):
+            result.add(index)
+        return result
+
+    def search(self, key, limit=10) -> List[int]:
+        """
+        @param key: 输入的关键词
+        @param limit:
+        @return: 按匹配程度从高到低排列的序号
+        """
+        key = normalize(key)
+        if not key:
+            return []
+        scored = []
+        for index in self.candidates(key):
+            score = match_score(key, self.fields[index])
+            scored.append((-score, index))
+        scored.sort()
+        return [index for _, index in scored[:limit]]
+
+    def best(self, key) -> int:
+        """
+        @return: 最匹配的序号，没有匹配的返回 -1
+        """
+        result = self.search(key, limit=1)
+        return result[0] if result else -1
 
 
 def search_by_content(key, choices: List[List]):
-    result = []
-    for i, choice in enumerate(choices):
-        res = process.extractOne(key, choice)
-        result.append((res, i))
-    result.sort(key=lambda x: x[0][1], reverse=True)
-    k = result[0][1]
-    item = result[0][0][0]
-    return choices[k].index(item)
+    """
+    @param key: 关键词
+    @param choices: [字段1列表, 字段2列表, ...]，每个列表的第 i 项属于第 i 个联系人
+    @return: 最匹配的联系人序号，没有匹配的返回 -1
+    """
+    index = ContactSearchIndex()
+    for fields in zip(*choices):
+        index.add(*fields)
+    return index.best(key)
@@ -0,0 +1,142 @@
+"""
+年度报告、图表接口的结果缓存
+
+每个页面/接口的结果以 (路由, wxid, 时间范围) 为键保存在缓存目录的 SQLite 里，
+同时记下生成时数据库的指纹（解密后各个数据库文件的大小和修改时间），重新解密后指纹变化，旧结果自动失效。
+响应带 ETag，浏览器再次请求时内容没变直接返回 304。
+解密完成后可以在后台把首页和聊得最多的几个联系人的报告先生成好。
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import traceback
+
+from app.config import CACHE_DIR, DB_DIR, INFO_FILE_PATH
+from app.log import logger
+
+CACHE_VERSION = 1
+
+
+def db_fingerprint() -> str:
+    """
+    数据库指纹：解密目录里各个 .db 文件和个人信息文件的大小、修改时间
+    """
+    items = []
+    try:
+        with os.scandir(DB_DIR) as it:
+            for entry in it:
+                if entry.name.endswith('.db'):
+                    stat = entry.stat()
+                    items.append((entry.name, stat.st_size, stat.st_mtime_ns))
+    except OSError:
+        pass
+    if os.path.exists(INFO_FILE_PATH):
+        stat = os.stat(INFO_FILE_PATH)
+        items.append(('info', stat.st_size, stat.st_mtime_ns))
+    items.sort()
+    return hashlib.md5(f'{CACHE_VERSION}:{items}'.encode()).hexdigest()
+
+
+def make_key(route, wxid=None, time_range=None) -> str:
+    return json.dumps([route, wxid or '', list(time_range) if time_range else None], ensure_ascii=False)
+
+
+class ReportEntry:
+    def __init__(self, etag, mimetype, body):
+        self.etag = etag
+        self.mimetype = mimetype
+        self.body = body
+
+
+class ReportCache:
+    def __init__(self, db_path=os.path.join(CACHE_DIR, 'report_cache.db')):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.DB = None
+        self.cursor = None
+        self.thread = None
+
+    def init_database(self):
+        if self.DB is not None:
+            return
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        self.DB = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.cursor = self.DB.cursor()
+        self.cursor.execute('''
+            create table if not exists reports(
+                key text primary key, fingerprint text, etag text, mimetype text, body blob, created integer
+            )
+        ''')
+        self.DB.commit()
+
+    def get(self, key, fingerprint=None) -> ReportEntry | None:
+        """
+        @param key: make_key 的结果
+        @param fingerprint: 当前的数据库指纹，默认现算
+        @return: 没有缓存或者缓存已经过期时返回 None
+        """
+        fingerprint = fingerprint or db_fingerprint()
+        with self.lock:
+            self.init_database()
+            self.cursor.execute('select etag,mimetype,body from reports where key=? and fingerprint=?',
+                                [key, fingerprint])
+            row = self.cursor.fetchone()
+        if row is None:
+            return None
+        return ReportEntry(row[0], row[1], bytes(row[2]))
+
+    def put(self, key, mimetype, body, fingerprint=None) -> ReportEntry:
+        """
+        保存结果，顺便清掉旧数据库生成的结果
+        @param body: bytes 或者 str
+        """
+        fingerprint = fingerprint or db_fingerprint()
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        etag = hashlib.md5(body).hexdigest()
+        with self.lock:
+            self.init_database()
+            try:
+                self.cursor.execute('delete from reports where fingerprint!=?', [fingerprint])
+                self.cursor.execute('insert or replace into reports values (?,?,?,?,?,?)',
+                                    [key, fingerprint, etag, mimetype, body, int(time.time())])
+                self.DB.commit()
+            except sqlite3.Error:
+                logger.error(traceback.format_exc())
+                self.DB.rollback()
+        return ReportEntry(etag, mimetype, body)
+
+    def clear(self):
+        with self.lock:
+            self.init_database()
+            self.cursor.execute('delete from reports')
+            self.DB.commit()
+
+    def start_precompute(self, func, *args):
+        """
+        在后台线程里执行预生成函数，已经在执行时直接返回
+        """
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self._run, args=(func, *args), name='report_precompute', daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def _run(func, *args):
+        try:
+            func(*args)
+        except:
+            logger.error(traceback.format_exc())
+
+    def close(self):
+        with self.lock:
+            if self.DB is not None:
+                self.DB.close()
+                self.DB = None
+                self.cursor = None
+
+
+report_cache = ReportCache()
@@ -1,3 +1,4 @@
+import functools
 import os
 import sys
 import time
@@ -10,20 +11,22 @@ from pyecharts.charts import Bar
 from app.DataBase import msg_db, micro_msg_db
 from app.DataBase.hard_link import decodeExtraBuf
 from app.analysis import analysis
-from app.config import SERVER_API_URL
+from app.analysis import full_text
+from app.analysis.ranking import get_contact_ranking
+from app.config import SERVER_API_URL, REPORT_TIME_RANGE, REPORT_PRECOMPUTE_CONTACTS
 from app.person import Contact, Me, ContactDefault
 from app.util.emoji import get_most_emoji
 from app.util.region_conversion import conversion_region_to_chinese
+from app.web_ui.report_cache import report_cache, db_fingerprint, make_key
 
 app = Flask(__name__)
 
 run_flag = False
-wxid = ''
+# 桌面程序打开报告前设置的默认联系人和时间范围，处理请求时只读取，每个请求的参数从链接里取
 contact: Contact = None
 start_time = '2023-1-01 00:00:00'
 end_time = '2023-12-31 23:59:59'
 time_range = (start_time, end_time)
-html: str = ''
 
 api_url = urljoin(SERVER_API_URL,'upload')
 
@@ -53,30 +56,72 @@ def get_contact(wxid) -> ContactDefault | Contact:
     return contact
 
 
+def request_time_range():
+    """
+    页面的时间范围：链接里带了 start、end 时用它，否则用打开页面前设置的 time_range
+    """
+    start = request.args.get('start')
+    end = request.args.get('end')
+    if start and end:
+        return [start, end]
+    return time_range
+
+
+def cached_report(func):
+    """
+    页面、图表接口的结果按 (路由, wxid, 时间范围, 数据库指纹) 缓存，响应带 ETag
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if request.method == 'POST':
+            key_wxid = request.json.get('wxid')
+            key_time_range = request.json.get('time_range', [])
+        else:
+            key_wxid = kwargs.get('wxid')
+            key_time_range = request_time_range()
+        fingerprint = db_fingerprint()
+        key = make_key(request.url_rule.rule, key_wxid, key_time_range)
+        entry = report_cache.get(key, fingerprint)
+        if entry is None:
+            response = make_response(func(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            entry = report_cache.put(key, response.mimetype, response.get_data(), fingerprint)
+        response = make_response(entry.body)
+        response.mimetype = entry.mimetype
+        response.set_etag(entry.etag)
+        return response.make_conditional(request)
+
+    return wrapper
+
+
 @app.route("/")
+@cached_report
 def index():
-    contact_topN_num = msg_db.get_chatted_top_contacts(time_range=time_range, top_n=9999999, contain_chatroom=True)
-    total_msg_num = sum(list(map(lambda x: x[1], contact_topN_num)))
+    time_range = request_time_range()
+    # 含群聊、不含群聊的排行和文字数都从一次汇总里取
+    ranking = get_contact_ranking(time_range)
+    total_msg_num = ranking.total_num(contain_chatroom=True)
     contact_topN = []
-    for wxid, num in contact_topN_num:
+    for wxid, num in ranking.items(contain_chatroom=True):
         contact = get_contact(wxid)
         text_length = 0
         contact_topN.append([contact, num, text_length])
     contacts_data = analysis.contacts_analysis(contact_topN)
     contact_topN = []
     send_msg_num = msg_db.get_send_messages_number_sum(time_range)
-    contact_topN_num = msg_db.get_chatted_top_contacts(time_range=time_range, top_n=9999999, contain_chatroom=False)
-
-    for wxid, num in contact_topN_num[:6]:
+    contact_topN_num = ranking.top(6, contain_chatroom=False)
+    text_lengths = ranking.text_lengths(wxid for wxid, num in contact_topN_num)
+    for wxid, num in contact_topN_num:
         contact = get_contact(wxid)
-        text_length = msg_db.get_message_length(wxid, time_range)
-        contact_topN.append([contact, num, text_length])
+        contact_topN.append([contact, num, text_lengths[wxid]])
 
     my_message_counter_data = analysis.my_message_counter(time_range=time_range)
     data = {
         'avatar': Me().smallHeadImgUrl,
         'contact_topN': contact_topN,
-        'contact_num': len(contact_topN_num),
+        'contact_num': ranking.contact_num(contain_chatroom=False),
         'send_msg_num': send_msg_num,
         'receive_msg_num': total_msg_num - send_msg_num,
     }
@@ -84,7 +129,9 @@ def index():
 
 
 @app.route("/christmas/<wxid>")
+@cached_report
 def christmas(wxid):
+    time_range = request_time_range()
     contact = get_contact(wxid)
     # 渲染模板，并传递图表的 HTML 到模板中
     try:
@@ -92,6 +139,9 @@ def christmas(wxid):
     except TypeError:
         first_time = '2023-01-01 00:00:00'
     data = {
+        'wxid': wxid,
+        'start_time': time_range[0],
+        'end_time': time_range[1],
         'ta_avatar_path': contact.smallHeadImgUrl,
         'my_avatar_path': Me().smallHeadImgUrl,
         'ta_nickname': contact.remark,
@@ -150,18 +200,28 @@ def christmas(wxid):
         'emoji_url': url,
         'emoji_num': num,
     }
-    global html
-    html = render_template("christmas.html", **data, **wordcloud_cloud_data, **time_data, **month_data, **calendar_data,
-                           **emoji_data)
-    return html
+    return render_template("christmas.html", **data, **wordcloud_cloud_data, **time_data, **month_data,
+                           **calendar_data, **emoji_data)
 
 
 @app.route('/upload')
 def upload():
-    global html
+    # 上传已经生成（缓存）的报告，联系人和时间范围由报告页面传过来
+    wxid = request.args.get('wxid')
+    if not wxid:
+        return jsonify({'success': False, 'errmsg': '缺少 wxid 参数'}), 400
+    entry = report_cache.get(make_key('/christmas/<wxid>', wxid, request_time_range()))
+    if entry is not None:
+        html_content = entry.body.decode('utf-8')
+    else:
+        # 缓存里没有（重新解密过或者写缓存失败），按同样的联系人和时间范围现场生成
+        page = christmas(wxid)
+        html_content = page.get_data(as_text=True) if page.status_code == 200 else ''
+    if not html_content:
+        return jsonify({'success': False, 'errmsg': '报告生成失败，请刷新页面后重试'}), 409
     data = {
-        'html_content': html,
-        'wxid': contact.wxid,
+        'html_content': html_content,
+        'wxid': wxid,
         'username': Me().wxid,
         'token':Me().token,
         'type': 'contact'
@@ -215,6 +275,31 @@ def test():
     return set_text('以下内容仅对VIP开放')
 
 
+def precompute(time_range_=None, top_n=REPORT_PRECOMPUTE_CONTACTS):
+    """
+    预先生成首页和聊天最多的几个联系人的报告，写入缓存
+    @param time_range_: 默认是 REPORT_TIME_RANGE
+    @param top_n: 联系人数
+    @return:
+    """
+    # 解密完成后数据库已经打开，这里不再重新打开，界面和索引线程还在使用这些连接
+    if not msg_db.open_flag:
+        return
+    time_range_ = time_range_ or REPORT_TIME_RANGE
+    query = {'start': time_range_[0], 'end': time_range_[1]}
+    client = app.test_client()
+    client.get('/', query_string=query)
+    for wxid_, num in get_contact_ranking(time_range_).top(top_n, contain_chatroom=False):
+        client.get(f'/christmas/{wxid_}', query_string=query)
+
+
+def start_precompute(time_range_=None):
+    """
+    在后台预先生成报告（解密完成后调用）
+    """
+    report_cache.start_precompute(precompute, time_range_)
+
+
 def run(port=21314):
     global run_flag
     if not run_flag:
@@ -243,6 +328,7 @@ def get_image(filename):
 
 
 @app.route('/month_count', methods=['POST'])
+@cached_report
 def get_chart_options():
     wxid = request.json.get('wxid')
     time_range = request.json.get('time_range', [])
@@ -251,6 +337,7 @@ def get_chart_options():
 
 
 @app.route('/wordcloud', methods=['POST'])
+@cached_report
 def get_wordcloud():
     wxid = request.json.get('wxid')
     time_range = request.json.get('time_range', [])
@@ -259,7 +346,56 @@ def get_wordcloud():
     return jsonify(world_cloud_data)
 
 
+@app.route('/ranking')
+def get_ranking():
+    """
+    聊天排行分页：?cursor=上一页返回的 next&size=每页人数&chatroom=1 包含群聊
+    """
+    time_range = request_time_range()
+    size = min(max(request.args.get('size', 20, type=int), 1), 100)
+    contain_chatroom = request.args.get('chatroom', 0, type=int) == 1
+    ranking = get_contact_ranking(time_range)
+    try:
+        page, next_cursor = ranking.page(request.args.get('cursor'), size, contain_chatroom)
+    except ValueError:
+        return jsonify({'error': 'cursor 格式不对'}), 400
+    text_lengths = ranking.text_lengths(wxid for wxid, num in page)
+    return jsonify({
+        'contacts': [{'wxid': wxid, 'num': num, 'text_length': text_lengths[wxid]} for wxid, num in page],
+        'next': next_cursor,
+    })
+
+
+@app.route('/search', methods=['POST'])
+def search_messages():
+    params = request.get_json(silent=True)
+    if not isinstance(params, dict):
+        return jsonify({'error': '请求内容不是 JSON 对象'}), 400
+    keyword = params.get('keyword', '')
+    wxid = params.get('wxid')
+    time_range = params.get('time_range', [])
+    types = params.get('types')
+    try:
+        limit = int(params.get('limit', 50))
+        offset = int(params.get('offset', 0))
+        if types is not None:
+            types = [int(type_) for type_ in types]
+    except (TypeError, ValueError):
+        return jsonify({'error': 'limit、offset、types 必须是整数'}), 400
+    if not isinstance(keyword, str) or (wxid is not None and not isinstance(wxid, str)):
+        return jsonify({'error': 'keyword、wxid 必须是字符串'}), 400
+    if time_range and (not isinstance(time_range, list) or len(time_range) != 2):
+        return jsonify({'error': 'time_range 必须是 [开始时间, 结束时间]'}), 400
+    if limit < 1 or offset < 0:
+        return jsonify({'error': 'limit 必须大于 0，offset 不能小于 0'}), 400
+    limit = min(limit, full_text.MAX_LIMIT)
+    results = full_text.search(keyword, wxid, time_range=time_range, types=types, limit=limit, offset=offset)
+    # 索引还没有建好
+    return jsonify({'ready': results is not None, 'results': results or []})
+
+
 @app.route('/charts/<wxid>')
+@cached_report
 def charts(wxid):
     # 渲染模板，并传递图表的 HTML 到模板中
     contact = get_contact(wxid)
@@ -277,6 +413,7 @@ def charts(wxid):
 
 
 @app.route('/calendar', methods=['POST'])
+@cached_report
 def get_calendar():
     wxid = request.json.get('wxid')
     time_range = request.json.get('time_range', [])
@@ -285,6 +422,7 @@ def get_calendar():
 
 
 @app.route('/message_counter', methods=['POST'])
+@cached_report
 def get_counter():
     wxid = request.json.get('wxid')
     time_range = request.json.get('time_range', [])
@@ -0,0 +1,54 @@
+"""
+报告服务的 WSGI/ASGI 入口，多人同时查看报告时用多个 worker 进程部署
+
+桌面程序里的 web.run() 是 Flask 自带的开发服务器，所有请求共用一个加锁的数据库连接。
+这里每个 worker 进程各自以只读方式打开解密后的数据库，请求之间互不阻塞；
+联系人、时间范围从链接参数里取（/christmas/<wxid>?start=...&end=...），不依赖模块里的全局变量。
+词项索引、全文索引、消息快照、报告缓存由桌面程序在解密后建立，worker 里只读取，不在后台重建。
+
+在项目根目录（app/Database/Msg 所在的目录）下运行：
+
+    # Linux / macOS
+    gunicorn -w 4 -b 0.0.0.0:21314 -c python:app.web_ui.wsgi app.web_ui.wsgi:app
+
+    # Windows 也可以用 uvicorn
+    uvicorn --workers 4 --host 0.0.0.0 --port 21314 app.web_ui.wsgi:asgi_app
+
+gunicorn 的 -c python:app.web_ui.wsgi 会用到下面的 post_fork，让 fork 出来的 worker 重新打开数据库，
+不和主进程共用连接；uvicorn 的每个 worker 进程各自导入这个模块，导入时打开。
+"""
+import sys
+
+from asgiref.wsgi import WsgiToAsgi
+
+from app.DataBase import close_db, init_db
+from app.analysis.columnar import column_snapshot
+from app.analysis.full_text import full_text_index
+from app.analysis.term_index import term_index
+from app.web_ui.web import app
+
+
+def init_worker():
+    """
+    在 worker 进程里以只读方式重新打开数据库和索引，检查索引是否可用（不存在或者没有同步的索引不用）
+    """
+    close_db()
+    init_db(read_only=True)
+    for index in (term_index, full_text_index, column_snapshot):
+        index.close()
+        index.read_only = True
+        index.check()
+
+
+def post_fork(server, worker):
+    """
+    gunicorn 的配置钩子
+    """
+    init_worker()
+
+
+if 'gunicorn' not in sys.modules:
+    # gunicorn 的主进程加载配置时也会导入这个模块，worker 在 post_fork 里打开
+    init_worker()
+
+asgi_app = WsgiToAsgi(app)
@@ -3,7 +3,8 @@ import sqlite3
 from datetime import datetime
 from pymongo import MongoClient, ASCENDING
 from typing import Dict, List
-from app.util.protocbuf.msg_pb2 import MessageBytesExtra
+from app.DataBase.chatroom_roster import get_roster
+from app.util.protocbuf import get_sender
 
 class MongoDBMigrator:
     def __init__(self, mongodb_uri: str = "mongodb://localhost:27017/", database_name: str = "wechat_msg"):
@@ -71,15 +72,7 @@ class MongoDBMigrator:
                 
                 # 解析bytes_extra字段获取user_name
                 if row[9] and not bool(row[4]):  # 只解析非自己发送的消息
-                    try:
-                        msgbytes = MessageBytesExtra()
-                        msgbytes.ParseFromString(row[9])
-                        for tmp in msgbytes.message2:
-                            if tmp.field1 == 1:
-                                message["user_name"] = tmp.field2
-                                break
-                    except Exception:
-                        pass  # 解析失败时保持user_name为空字符串
+                    message["user_name"] = get_sender(row[9])  # 解析失败时为空字符串
                 
                 messages_to_insert.append(message)
             
@@ -140,12 +133,15 @@ class MongoDBMigrator:
         
         cursor.execute("SELECT ChatRoomName, RoomData FROM ChatRoom")
         chatrooms = cursor.fetchall()
+        roster = get_roster(micromsg_db_path)
         
         chatrooms_to_insert = []
         for chatroom in chatrooms:
+            members = roster.get_members(chatroom[0]) or {}
             chatroom_doc = {
                 "chatroom_name": chatroom[0],
-                "room_data": chatroom[1]
+                "room_data": chatroom[1],
+                "members": [{"wxid": wxid, "display_name": name} for wxid, name in members.items()]
             }
             chatrooms_to_insert.append(chatroom_doc)
         
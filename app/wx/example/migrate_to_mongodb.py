@@ -10,6 +10,7 @@ from bson import ObjectId
 project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
 sys.path.insert(0, project_root)
 
+from app.DataBase.chatroom_roster import get_roster
 from app.util.protocbuf.msg_pb2 import MessageBytesExtra
 
 
@@ -30,6 +31,7 @@ class ChatDataMigrator:
         self.contact_cursor = None
         self.mongo_client = None
         self.db = None
+        self.roster = None
 
     def connect_databases(self) -> bool:
         """连接SQLite和MongoDB数据库，并创建必要的集合和索引"""
@@ -43,6 +45,8 @@ class ChatDataMigrator:
             self.msg_cursor = self.msg_conn.cursor()
             self.contact_conn = sqlite3.connect(self.contact_db_path)
             self.contact_cursor = self.contact_conn.cursor()
+            # 群成员的群昵称
+            self.roster = get_roster(self.contact_db_path)
 
             # 连接MongoDB
             self.mongo_client = MongoClient(self.mongo_uri)
@@ -128,7 +132,8 @@ class ChatDataMigrator:
                             message_data['sender_info'] = {
                                 'nickname': sender_info['nickname'],
                                 'remark': sender_info['remark'],
-                                'alias': sender_info['alias']
+                                'alias': sender_info['alias'],
+                                'group_nickname': self.roster.get_display_name(talker, group_sender_wxid)
                             }
                         break
             except Exception as e:
@@ -212,7 +217,8 @@ class ChatDataMigrator:
                         'content': content,
                         'create_time': datetime.fromtimestamp(create_time),
                         'nickname': None,  # 发送者昵称
-                        'remark': None     # 发送者备注名
+                        'remark': None,    # 发送者备注名
+                        'group_nickname': None  # 发送者的群昵称
                     }
                     
                     # 获取发送者的昵称和备注信息
@@ -252,6 +258,8 @@ class ChatDataMigrator:
                                         if result:
                                             message_doc['nickname'] = result[0]
                                             message_doc['remark'] = result[1]
+                                        message_doc['group_nickname'] = self.roster.get_display_name(
+                                            talker, group_sender_wxid)
                                     break
                         except Exception as e:
                             print(f"解析群消息发送者信息失败：{e}")
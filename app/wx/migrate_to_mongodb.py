@@ -6,7 +6,8 @@ import time
 import schedule
 from pymongo import MongoClient, ASCENDING
 
-from app.util.protocbuf.msg_pb2 import MessageBytesExtra
+from app.DataBase.chatroom_roster import get_roster
+from app.util.protocbuf import get_sender
 from app.wx.example.decrypt import decrypt_db, merge_databases_wrapper
 from app.wx.wx_decrypt import get_wechat_info
 
@@ -59,10 +60,11 @@ class MongoDBMigrator:
             }}
         )
     
-    def migrate_messages(self, msg_db_path: str):
-        """增量迁移消息数据"""
+    def migrate_messages(self, msg_db_path: str, micromsg_db_path: str = None):
+        """增量迁移消息数据，传入 micromsg_db_path 时会补上群消息发送人的群昵称"""
         if not os.path.exists(msg_db_path):
             raise FileNotFoundError(f"MSG数据库文件不存在: {msg_db_path}")
+        roster = get_roster(micromsg_db_path) if micromsg_db_path else None
         
         # 获取上次同步状态
         status = self._get_last_sync_status('messages')
@@ -104,20 +106,15 @@ class MongoDBMigrator:
                     'str_talker': row[10],
                     'compress_content': row[11],
                     'display_content': row[12],
-                    'user_name': ''
+                    'user_name': '',
+                    'display_name': ''
                 }
                 
                 # 解析bytes_extra字段获取user_name
                 if row[9] and not bool(row[4]):
-                    try:
-                        msgbytes = MessageBytesExtra()
-                        msgbytes.ParseFromString(row[9])
-                        for tmp in msgbytes.message2:
-                            if tmp.field1 == 1:
-                                message['user_name'] = tmp.field2
-                                break
-                    except Exception:
-                        pass
+                    message['user_name'] = get_sender(row[9])
+                    if roster and row[10].endswith('@chatroom'):
+                        message['display_name'] = roster.get_display_name(row[10], message['user_name'])
                 
                 messages_to_insert.append(message)
                 last_local_id = row[0]
@@ -183,11 +180,14 @@ class MongoDBMigrator:
         cursor.execute("SELECT ChatRoomName, RoomData FROM ChatRoom")
         chatrooms = cursor.fetchall()
         current_time = datetime.now()
+        roster = get_roster(micromsg_db_path)
         
         for chatroom in chatrooms:
+            members = roster.get_members(chatroom[0]) or {}
             chatroom_doc = {
                 'chatroom_name': chatroom[0],
                 'room_data': chatroom[1],
+                'members': [{'wxid': wxid, 'display_name': name} for wxid, name in members.items()],
                 'last_update_time': current_time
             }
             
@@ -233,7 +233,7 @@ def schedule_migrate_to_mongodb(msg_db_path: str, micromsg_db_path: str, mongodb
                 raise Exception("数据库合并失败")
             
             # 执行数据迁移
-            migrator.migrate_messages(msg_db_path)
+            migrator.migrate_messages(msg_db_path, micromsg_db_path)
             migrator.migrate_contacts(micromsg_db_path)
             migrator.migrate_chatrooms(micromsg_db_path)
             print(f"[{datetime.now()}] 数据同步完成")
@@ -313,7 +313,7 @@ def migrate_to_mongodb(msg_db_path: str, micromsg_db_path: str, mongodb_uri: str
         
         # 执行数据迁移
         print(f"[{datetime.now()}] 开始迁移消息数据...")
-        migrator.migrate_messages(msg_db_path)
+        migrator.migrate_messages(msg_db_path, micromsg_db_path)
         
         print(f"[{datetime.now()}] 开始迁移联系人数据...")
         migrator.migrate_contacts(micromsg_db_path)
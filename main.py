@@ -1,4 +1,5 @@
 import ctypes
+import multiprocessing
 import sys
 import time
 import traceback
@@ -104,6 +105,8 @@ class ViewController(QWidget):
 
 
 if __name__ == '__main__':
+    # 打包后用多进程导出时，子进程不能再启动界面
+    multiprocessing.freeze_support()
     app = QApplication(sys.argv)
     font = QFont('微软雅黑', 12)  # 使用 Times New Roman 字体，字体大小为 14
     app.setFont(font)